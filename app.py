@@ -18,32 +18,80 @@ from datetime import datetime
 from typing import List
 import random
 import string
+import hashlib
+import hmac
+import ipaddress
 from base64 import b64decode
+import time
+
+_import_start = time.perf_counter()
 
 # Third-party imports
 import streamlit as st
 from streamlit import runtime
 from streamlit.runtime.scriptrunner import get_script_run_ctx
-from streamlit_javascript import st_javascript
-import streamlit_authenticator as stauth
-import requests
-import yaml
-from yaml.loader import SafeLoader
 from PIL import Image
 from io import BytesIO
-from gtts import gTTS, gTTSError
-from langdetect import detect
+# gtts, langdetect, streamlit_authenticator and yaml are loaded on first use via libs.lazy_import
+# (gtts/langdetect inside tts_utils), as are the optional features' modules: retrieval_utils
+# (numpy), imagen_utils, fanout_utils and tts_utils
 
 # Local imports
 import libs
-from email_utils import send_mail
+from email_utils import send_mail, get_dispatcher
+import client_utils
+import log_utils
+import history_utils
+import context_utils
+import image_utils
+import cache_utils
+import geo_utils
+import usage_utils
+import metrics_utils
+import resilience_utils
+import request_utils
+import memory_utils
+import ratelimit_utils
 from google import genai
 from google.genai import types
 
+libs.IMPORT_TIMES["app.py eager imports"] = time.perf_counter() - _import_start
+
 VALID_USERS = st.secrets["valid_users"].split(',')
 TEXT2IMG_ENABLES = st.secrets["txt2img_enabled"]
 TOTAL_TRIALS = int(st.secrets["total_trials"])
 MAX_MESSAGES = int(st.secrets["max_cached_messages"])
+STREAM_RESPONSES = st.secrets.get("stream_responses", "yes") == "yes"
+MESSAGES_PAGE = int(st.secrets.get("visible_messages", 20))
+RETRIEVAL_TOP_K = int(st.secrets.get("retrieval_top_k", 6))
+# reverse proxies in front of the app whose X-Forwarded-For entries are trusted (see geo_utils.client_ip)
+TRUSTED_PROXIES = int(st.secrets.get("trusted_proxies", 1))
+# who may see the monitoring tab (see Is_Admin): authenticated usernames, a token given
+# as ?admin=<token> in the app URL, and client ips or networks, e.g. "127.0.0.1,10.0.0.0/8"
+ADMIN_USERS = [u for u in st.secrets.get("admin_users", "").split(',') if u]
+ADMIN_TOKEN = st.secrets.get("admin_token", "")
+ADMIN_NETWORKS = [ipaddress.ip_network(n.strip(), strict=False) for n in st.secrets.get("admin_ips", "").split(',') if n.strip()]
+# model call resilience: retries per model, hedge delay and per-attempt timeout (seconds, 0 = off)
+MODEL_RETRIES = int(st.secrets.get("model_retries", 2))
+MODEL_HEDGE_AFTER = float(st.secrets.get("model_hedge_after", 0)) or None
+MODEL_TIMEOUT = float(st.secrets.get("model_timeout", 0)) or None
+FALLBACK_CHAINS = resilience_utils.parse_chains(st.secrets.get("model_fallbacks")) or resilience_utils.FALLBACK_CHAINS
+# text models that can be asked side by side
+FANOUT_MODELS = {
+    "Gemini 2.5 flash": "gemini-2.5-flash",
+    "Gemini 2.5 Pro": "gemini-2.5-pro",
+    "Gemini 3.0 Pro (最强大脑)": "gemini-3-pro-preview",
+}
+CIRCUIT_OPTIONS = {"failure_threshold": int(st.secrets.get("circuit_failures", 5)),
+                   "reset_seconds": float(st.secrets.get("circuit_reset", 30))}
+# per-session memory budget (bytes); messages newer than MEMORY_KEEP_RECENT stay uncompressed
+SESSION_MEMORY_BUDGET = int(float(st.secrets.get("session_memory_mb", 32)) * 1024 * 1024)
+MEMORY_KEEP_RECENT = int(st.secrets.get("memory_keep_recent", 4))
+# shown when the shared rate limiter sheds a request
+BUSY_MESSAGE = "⏳ 当前使用人数过多，请稍后再试。(The service is busy, please try again in a minute.)"
+# roles whose answers may be served from the response cache: none unless listed in the
+# 'response_cache_roles' secret, e.g. "正则表达式生成器,中文老师,学术中英互译"
+RESPONSE_CACHE_ROLES = [r.strip() for r in st.secrets.get("response_cache_roles", "").split(',') if r.strip()]
 
 class Locale:    
     ai_role_options: List[str]
@@ -59,6 +107,9 @@ class Locale:
     chat_clear_btn: str
     clear_doc_btn: str
     enable_search_label: str
+    retrieval_label: str
+    fanout_label: str
+    first_wins_label: str
     chat_save_btn: str
     file_upload_label: str
     temperature_label: str
@@ -88,6 +139,9 @@ class Locale:
                 chat_clear_btn,
                 clear_doc_btn,
                 enable_search_label,
+                retrieval_label,
+                fanout_label,
+                first_wins_label,
                 chat_save_btn,
                 file_upload_label,
                 temperature_label,
@@ -116,6 +170,9 @@ class Locale:
         self.chat_clear_btn = chat_clear_btn
         self.clear_doc_btn = clear_doc_btn
         self.enable_search_label = enable_search_label
+        self.retrieval_label = retrieval_label
+        self.fanout_label = fanout_label
+        self.first_wins_label = first_wins_label
         self.chat_save_btn = chat_save_btn
         self.file_upload_label = file_upload_label
         self.temperature_label = temperature_label
@@ -164,6 +221,9 @@ en = Locale(
     chat_clear_btn="New Topic",
     clear_doc_btn=":x: Clear Doc",
     enable_search_label="Enable Web Search",
+    retrieval_label="Send relevant excerpts only",
+    fanout_label="Compare models",
+    first_wins_label="First answer wins",
     chat_save_btn="Save",
     file_upload_label="You can chat with an uploaded file (your file will never be saved anywhere)",
     temperature_label="Model Temperature",
@@ -194,6 +254,9 @@ zw = Locale(
     chat_clear_btn=":new: 新话题",
     clear_doc_btn=":x: 清空文件",
     enable_search_label="启用网络搜索",
+    retrieval_label="只发送文件相关片段",
+    fanout_label="多模型对比",
+    first_wins_label="先到先得",
     chat_save_btn="保存",
     file_upload_label="你可以询问一个上传的文件或图片（文件内容只在内存，不会被保留）",
     temperature_label="模型温度",
@@ -221,7 +284,7 @@ st.set_page_config(page_title="Echo Gemini AI",
 sendmail = True
 
 current_user = "**new_chat**"
-BASE_PROMPT = "You are a helpful assistant who can answer or handle all my queries!"
+BASE_PROMPT = request_utils.BASE_PROMPT
 
 # system messages and/or context
 set_context_all = {"不预设（通用）": ""}
@@ -246,53 +309,33 @@ def get_remote_ip() -> str | None:
 
 def get_client_ip() -> str:
     '''
-    workaround solution, via 'https://api.ipify.org?format=json' for get client ip
-    example:
-    ip_address = client_ip()  # now you have it in the host...
-    st.write(ip_address)  # so you can log it, etc.    
+    Client ip from the forwarded headers of this session's request, else the socket peer.
+    No network call is made.
     '''
-    url = 'https://api.ipify.org?format=json'
-
-    script = (f'await fetch("{url}").then('
-                'function(response) {'
-                    'return response.json();'
-                '})')
-
-    ip_address = ""
     try:
-        result = st_javascript(script)
-        if isinstance(result, dict) and 'ip' in result:
-            ip_address = result['ip']
-        else:
-            ip_address = "unknown_ip"
-    except:
-        pass
-        
-    return ip_address
+        headers = st.context.headers
+    except Exception:
+        headers = None
+    return geo_utils.client_ip(headers, get_remote_ip(), trusted_proxies=TRUSTED_PROXIES)
 
-@st.cache_data(show_spinner=False)
 def get_geolocation(ip_address: str) -> dict | None:
-    #reader = geolite2.reader()
-    #location = reader.get(ip_address)
-    #geolite2.close()
-
-    url =f'https://ipapi.co/{ip_address}/json/'
+    '''
+    Offline lookup in the local geolocation database ('geoip_db' secret), memoized per ip.
+    '''
+    return geo_utils.lookup(ip_address, st.secrets.get("geoip_db"))
 
+def Resolve_Identity() -> None:
+    '''
+    Resolve the client ip and location once per session.
+    '''
     try:
-        # Make the GET requests
-        response = requests.get(url)
-        response.raise_for_status()
-        data = response.json()
-
-        location = {
-            "city" : data.get("city"),
-            "region" : data.get("region"),
-            "country" : data.get("country_name"),
-            }
-        return location
-    except requests.RequestException as ex:
-        print(f"An error: {ex}")
-        return None
+        with metrics_utils.span("identity"):
+            st.session_state.user_ip = get_client_ip()
+            st.session_state.user_location = get_geolocation(st.session_state.user_ip)
+    except Exception as ex:
+        st.session_state.user_ip = "unknown_ip"
+        st.session_state.user_location = None
+        print(f"Exception getting user ip/location: {ex}")
 
 
 def randomword(length: int) -> str:
@@ -302,21 +345,9 @@ def randomword(length: int) -> str:
 def role_change_callback(arg: str) -> None:
     try:
         st.session_state[arg + current_user + "value"] = st.session_state[arg + current_user]
-
-        sys_msg = ""
-        for ctx in [
-            set_context_all[st.session_state["context_select" + current_user]],
-            st.session_state["context_input" + current_user],
-        ]:
-            if ctx != "":
-                sys_msg += ctx + '\n'
+        st.session_state.sys_prompt = request_utils.system_prompt(st.session_state["context_select" + current_user],
+                                                                  st.session_state["context_input" + current_user])
     except Exception as ex:
-        sys_msg = ""
-
-
-    if len(sys_msg.strip()) > 10:
-        st.session_state.sys_prompt = sys_msg
-    else:
         st.session_state.sys_prompt = BASE_PROMPT
 
 
@@ -326,30 +357,112 @@ def get_app_folder() -> str:
 
     return app_folder
 
-#@st.cache_data(show_spinner=False)
-def save_log(query: str, res: str, total_tokens: int) -> None:
+def get_audit_logger() -> log_utils.AuditLogger:
+    '''
+    Return the shared audit logger, configured from secrets.
     '''
-    Log an event or error
+    return log_utils.get_logger(st.secrets.get("log_file", get_app_folder() + "/gptGate.jsonl"),
+                                max_bytes=int(st.secrets.get("log_max_bytes", 10 * 1024 * 1024)),
+                                rotate_seconds=float(st.secrets.get("log_rotate_hours", 24)) * 3600,
+                                backups=int(st.secrets.get("log_backups", 10)),
+                                flush_interval=float(st.secrets.get("log_flush_interval", 2)),
+                                )
+
+def Get_Usage_Ledger() -> usage_utils.UsageLedger:
     '''
-    now = datetime.now() # current date and time
-    date_time = now.strftime("%m/%d/%Y, %H:%M:%S")
-    remote_ip = get_client_ip()
-    app_folder = get_app_folder()
+    Return the shared usage ledger (SQLite), configured from secrets.
+    '''
+    return usage_utils.get_ledger(st.secrets.get("usage_db", get_app_folder() + "/usage.db"),
+                                  flush_interval=float(st.secrets.get("usage_flush_interval", 1)))
+
+def Out_Of_Quota() -> bool:
+    '''
+    Trial users get TOTAL_TRIALS queries a day, counted in the usage ledger so the
+    quota holds across refreshes, sessions and app processes.
+    '''
+    if st.session_state.user in VALID_USERS:
+        return False
     try:
-        with open(app_folder + "/gptGate.log", "a", encoding='utf-8') as f:
-            f.write(f'[{date_time}] {st.session_state.user}:({remote_ip}):\n')
-            f.write(f'[You]: {query}\n')
-            f.write(f'[GPT]: {res}\n')
-            f.write(f'[Tokens]: {total_tokens}\n')
-            f.write(f"User ip: {st.session_state.user_ip}")
-            f.write(f"User Geo: {st.session_state.user_location}")
-            f.write(100 * '-' + '\n\n')
+        return Get_Usage_Ledger().queries_today(st.session_state.user) > TOTAL_TRIALS
     except Exception as ex:
-        print(f"Exception: {ex}")
-        pass
-        
-    print(f'[{date_time}]: {st.session_state.user}: {remote_ip}\n')
-    print(res+'\n')
+        print(f"Usage ledger unavailable: {ex!r}")
+        return st.session_state.total_queries > TOTAL_TRIALS
+
+def Record_Usage(model: str, usage=None, queries: int = 1, **tokens) -> None:
+    '''
+    Add a query and its token breakdown to the usage ledger (batched, no I/O here).
+    '''
+    try:
+        Get_Usage_Ledger().record(st.session_state.user, model, usage, queries=queries, **tokens)
+    except Exception as ex:
+        print(f"Usage ledger unavailable: {ex!r}")
+
+@st.cache_resource(show_spinner=False)
+def Get_Scheduler() -> ratelimit_utils.Scheduler:
+    '''
+    Return the process-wide rate limiter and scheduler of model calls, configured from
+    secrets. With 'rate_limit_db' the token buckets are shared with every other app
+    (and batch.py) process using the same file.
+    '''
+    store = ratelimit_utils.SqliteBuckets(st.secrets["rate_limit_db"]) if st.secrets.get("rate_limit_db") else None
+    return ratelimit_utils.Scheduler(limits=ratelimit_utils.parse_limits(st.secrets.get("model_limits")), store=store,
+                                     max_waiting=int(st.secrets.get("queue_max_waiting", 50)),
+                                     max_wait=float(st.secrets.get("queue_max_wait", 60)),
+                                     trial_share=float(st.secrets.get("queue_trial_share", 0.5)))
+
+def Request_Priority() -> int:
+    '''
+    Scheduling priority of this session's model calls: VALID_USERS go ahead of trial users.
+    '''
+    return ratelimit_utils.PRIORITY_USER if st.session_state.user in VALID_USERS else ratelimit_utils.PRIORITY_TRIAL
+
+def Request_Tokens(contents: list) -> int:
+    '''
+    Local estimate of the tokens a request will use, debited on admission (see Settle_Request).
+    '''
+    return sum(history_utils.estimate_part_tokens(part) for content in contents for part in content.parts or [])
+
+def Admit_Request(scheduler: ratelimit_utils.Scheduler, model: str, tokens: int, priority: int, placeholder=None) -> None:
+    '''
+    Wait until the shared rate limiter lets a call to model through. The queue position
+    is shown in placeholder when called from the script thread. Takes only plain
+    values, so hedging worker threads may call it. Raises ratelimit_utils.Overloaded when shed.
+    '''
+    if get_script_run_ctx(suppress_warning=True) is None:
+        placeholder = None      # hedging worker thread: may not draw
+
+    def on_wait(position: int, eta: float) -> None:
+        placeholder.info(f"⏳ 排队中，第 {position + 1} 位，预计等待 {eta:.0f} 秒 (queued: #{position + 1}, ~{eta:.0f}s)")
+
+    waited = scheduler.admit(model, tokens, priority, on_wait=on_wait if placeholder is not None else None)
+    if waited > 0 and placeholder is not None:
+        placeholder.empty()
+
+def Settle_Request(scheduler: ratelimit_utils.Scheduler, model: str, tokens: int, usage=None) -> None:
+    '''
+    Correct the rate limiter's token count with the usage reported by the model.
+    '''
+    if usage is not None and usage.total_token_count is not None:
+        scheduler.settle(model, tokens, usage.total_token_count)
+
+def save_log(query: str, res: str, total_tokens: int, event: str = "chat", **fields) -> None:
+    '''
+    Log an event or error. The record is buffered and written by a background thread;
+    the client ip comes from the session, no lookup is made here. Extra fields are logged as given.
+    '''
+    with metrics_utils.span("save_log"):
+        get_audit_logger().log(event,
+                               user=st.session_state.user,
+                               user_ip=st.session_state.get("user_ip"),
+                               user_geo=st.session_state.get("user_location"),
+                               model=st.session_state.get("model_version"),
+                               query=query,
+                               response=res,
+                               tokens=total_tokens,
+                               **fields,
+                               )
+    metrics_utils.inc("events", event=event)
+    print(f'[{event}] {st.session_state.user}: {res[:200]!r}')
 
 
 def Display_Uploaded_Image(img_str: str) -> None:
@@ -360,29 +473,59 @@ def Display_Uploaded_Image(img_str: str) -> None:
     st.write(img)
 
 def Show_Audio_Player(ai_content: str) -> None:
-    sound_file = BytesIO()
-    try:
-        lang = detect(ai_content)
-        print("Language:", lang)
-        if lang in ['zh', 'zh-CN', 'en', 'de', 'fr'] :
-            tts = gTTS(text=ai_content, lang=lang)
-            #if st.session_state['locale'] is zw:
-            #    tts = gTTS(text=ai_content, lang='zh')
-            #else:
-            #    tts = gTTS(text=ai_content, lang='en')
-            tts.write_to_fp(sound_file)
-            st.session_state.gtts_placeholder.write(st.session_state.locale.stt_placeholder)
-            st.session_state.gtts_placeholder.audio(sound_file)
-    except gTTSError as err:
-        #st.session_state.gtts_placeholder.error(err)
-        save_log("Error", str(err), 0)
-    except Exception as ex:
-        #st.session_state.gtts_placeholder.error(err)
-        save_log("Error", str(ex), 0)
+    '''
+    Offer the answer as audio. Nothing is synthesized until the user presses play.
+    '''
+    st.session_state.tts_text = ai_content
+    st.session_state.tts_future = None
+    st.session_state.tts_error = None
+
+def Start_Speech() -> None:
+    tts_utils = libs.lazy_import("tts_utils")
+    st.session_state.tts_error = None
+    st.session_state.tts_future = tts_utils.synthesize_async(st.session_state.tts_text)
+
+def Audio_Player() -> None:
+    '''
+    Play button for the last answer; on press, synthesis runs in the background and
+    Audio_Progress polls it on a timer until the audio is ready. The timer is only
+    registered while synthesis is pending, so nothing polls once the audio is shown.
+    A failed synthesis is logged once and the play button comes back for a retry.
+    '''
+    future = st.session_state.tts_future
+    if future is not None and future.done() and future.exception() is not None:
+        save_log("Error", str(future.exception()), 0, event="error")
+        st.session_state.tts_error = str(future.exception())
+        st.session_state.tts_future = future = None
+
+    if future is None:
+        with st.container():
+            if st.session_state.tts_error:
+                st.caption(f"⚠️ 语音合成失败 (speech synthesis failed): {st.session_state.tts_error}")
+            st.button(f"🔊 {st.session_state.locale.stt_placeholder}", key="tts_play", on_click=Start_Speech)
+    elif not future.done():
+        Audio_Progress()
+    else:
+        audio = future.result()
+        if audio:
+            st.audio(audio, format="audio/mp3")
+
+@st.fragment(run_every=0.5)
+def Audio_Progress() -> None:
+    '''
+    Shown while synthesis is pending, without blocking the script thread. When the
+    audio is ready, one full rerun replaces this fragment with the player and stops the timer.
+    '''
+    future = st.session_state.tts_future
+    if future is None or future.done():
+        st.rerun()
+    st.caption(st.session_state.locale.stt_placeholder + " ...")
 
 def Login() -> tuple[str, bool, str]:
+    yaml = libs.lazy_import("yaml")
+    stauth = libs.lazy_import("streamlit_authenticator")
     with open('./config.yaml') as file:
-        config = yaml.load(file, Loader=SafeLoader)
+        config = yaml.load(file, Loader=yaml.SafeLoader)
 
     random_key = randomword(10)
     authenticator = stauth.Authenticate(
@@ -427,9 +570,12 @@ def Login() -> tuple[str, bool, str]:
 
 
 def Clear_Chat() -> None:
+    st.session_state.context_cache.cleanup(create_client())
     st.session_state.history = []
     st.session_state.messages = []
-    st.session_state.contents = []
+    st.session_state.messages_shown = MESSAGES_PAGE
+    st.session_state.chat_history.clear()
+    st.session_state.tts_text = ""
     st.session_state.user_text = ""
     st.session_state.loaded_content = ""
     st.session_state.loaded_image = None
@@ -441,9 +587,10 @@ def Clear_Chat() -> None:
 
 def Delete_Files() -> None:
 
+    st.session_state.context_cache.cleanup(create_client())
     st.session_state.loaded_content = ""
     st.session_state.loaded_image = None
-    st.session_state.contents = []
+    st.session_state.chat_history.clear()
     st.session_state.key = str(random.randint(1000, 10000000))      # HACK use the following two lines to reset update the file_uploader key
     st.rerun()
 
@@ -456,195 +603,610 @@ def Model_Changed() -> None:
 
     Delete_Files()
     
-def Show_Images(desc: str, images: list) -> None:
-    for image in images:
-        st.image(image, caption=desc)
-
-def Show_Messages(placeholder) -> None:
+def Render_Message(message: dict) -> dict:
+    '''
+    Format a chat message once and keep the result on the message: the HTML of the
+    header and text, and any image as encoded bytes (so it is not re-encoded on reruns).
+    '''
+    render = message.get("render")
+    if render is not None:
+        return render
+
+    if message['role'] == 'user':
+        role = 'You'
+        alignment = "right"
+    elif message['role'] == 'model':
+        role = 'AI'
+        alignment = "left"
+    else:
+        role = message['role']
+        alignment = "left"
+
+    image = None
+    columns = None
+    if isinstance(message['parts'], list) and isinstance(message['parts'][0], dict) and "columns" in message['parts'][0]:
+        columns = [(f"<b>{label}</b> <span class='tiny-font'>{status}</span>", f"<div>{text}</div>")
+                   for label, text, status in message['parts'][0]["columns"]]
+    if isinstance(message['parts'], list):
+        if isinstance(message['parts'][0], dict) and "text" in message['parts'][0]:
+            text = message['parts'][0]['text']
+        else:
+            text = f"{message['parts'][0]}"
+    elif isinstance(message['parts'], dict):
+        text = message['parts'].get('text')
+        image = message['parts'].get('image')
+    else:
+        text = f"{message['parts']}"
+
+    if isinstance(image, Image.Image):
+        with BytesIO() as buffer:
+            image.save(buffer, format="PNG")
+            image = buffer.getvalue()
+
+    render = {
+        "header": f"<div style='text-align: {alignment};'><b>{role}</b>:</div>",
+        "text": f"<div style='text-align: {alignment};'>{text}</div>" if text is not None else None,
+        "image": image,
+        "columns": columns,
+    }
+    message["render"] = render
+    return render
+
+def Session_Memory() -> int:
+    '''
+    Approximate bytes held by this session's state (shared clients and caches excluded).
+    messages_view is left out: it is a copy of the shown page, refreshed only at the
+    next render, so evicting messages would not shrink it.
+    '''
+    state = {key: st.session_state[key] for key in st.session_state.keys() if key != "messages_view"}
+    return memory_utils.measure(state, deep_types=(history_utils.ChatHistory,))
 
+def Enforce_Memory_Budget() -> None:
+    '''
+    Keep the session within SESSION_MEMORY_BUDGET: old chat history turns and messages
+    are compressed, then the oldest messages and history turns are evicted while the
+    session is still over budget. The size is reported for the admin view.
+    '''
+    history = st.session_state.chat_history
+    history.compact(MEMORY_KEEP_RECENT)
+    result = memory_utils.enforce_budget(st.session_state.messages, SESSION_MEMORY_BUDGET, Session_Memory,
+                                         render=Render_Message, keep_recent=MEMORY_KEEP_RECENT)
+    size = result["after"]
+    while size > SESSION_MEMORY_BUDGET and history.drop_oldest():
+        size = Session_Memory()
+    if result["evicted"] or size > SESSION_MEMORY_BUDGET:
+        print(f"Session memory of {st.session_state.user}: {result}, now {size}")
+    ctx = get_script_run_ctx()
+    if ctx is not None:
+        memory_utils.report(ctx.session_id, st.session_state.user, size,
+                            messages=len(st.session_state.messages), turns=len(history.turns))
+
+def Show_Older_Messages() -> None:
+    st.session_state.messages_shown += MESSAGES_PAGE
+
+def Messages_View(shown: list) -> list:
+    '''
+    The shown messages as display segments: one ("html", text) per message, packed
+    (see memory_utils.pack), and ("image", bytes) for its picture. Each message is
+    its own markdown block, so an unclosed tag or code fence cannot spill into the others.
+    '''
+    segments = []
+    for message in shown:
+        render = Render_Message(message)
+        html = [render["header"]]
+        if render.get("columns"):
+            html.append("<div style='display: flex; gap: 1em;'>" +
+                        "".join(f"<div style='flex: 1; min-width: 0;'>{header}{memory_utils.unpack(text)}</div>"
+                                for header, text in render["columns"]) + "</div>")
+        elif render["text"] is not None:
+            html.append(memory_utils.unpack(render["text"]))
+        segments.append(("html", memory_utils.pack("\n".join(html))))
+        if render["image"] is not None:
+            segments.append(("image", render["image"]))
+    return segments
+
+@st.fragment
+def Show_Messages() -> None:
+    '''
+    Show the newest messages first. Only the latest messages_shown are rendered;
+    older ones are paged in on demand, which reruns this fragment only. The view is
+    rebuilt only when the messages or the page size change, and is sent as one
+    markdown block per message; image bytes map to the same media URL, so unchanged
+    images are not re-sent.
+    '''
     #print(f"Number of messages: {len(st.session_state.messages)}")
-    #with placeholder:
-    for message in st.session_state.messages[::-1]: # reverse order
-    #for message in st.session_state.messages[1:]:
-        #print(f"Show Message: {message}")
-        if message['role'] == 'user':
-            role = 'You'
-            alignment = "right"
-        elif message['role'] == 'model':
-            role = 'AI'
-            alignment = "left"
+    messages = st.session_state.messages
+    key = (id(messages), len(messages), id(messages[-1]) if messages else None, st.session_state.messages_shown)
+    view = st.session_state.get("messages_view")
+    if view is None or view[0] != key:
+        shown = messages[::-1][:st.session_state.messages_shown]  # reverse order
+        view = st.session_state.messages_view = (key, Messages_View(shown), len(messages) - len(shown))
+    _, segments, hidden = view
+    for kind, value in segments:
+        if kind == "image":
+            st.image(value)
         else:
-            role = message['role']
-            alignment = "left"
-
-        st.markdown(f"<div style='text-align: {alignment};'><b>{role}</b>:</div>", unsafe_allow_html=True)
-
-        #print(f"Show Message Parts: {message['parts']}")
+            st.markdown(memory_utils.unpack(value), unsafe_allow_html=True)
 
-        if isinstance(message['parts'], list):
-            if "text" in message['parts'][0]:
-                text = message['parts'][0]['text']
-            else:
-                text = f"{message['parts'][0]}"
-            #with st.align(alignment):
-            #    st.write(text, unsafe_allow_html=True)
-            st.markdown(f"<div style='text-align: {alignment};'>{text}</div>", unsafe_allow_html=True)
-        elif isinstance(message['parts'], dict):
-            if "text" in message['parts']:
-                text = message['parts']['text']
-                #with st.align(alignment):
-                #    st.write(text, unsafe_allow_html=True)
-                st.markdown(f"<div style='text-align: {alignment};'>{text}</div>", unsafe_allow_html=True)
-            if "image" in message['parts']:
-                st.image(message['parts']["image"])
-        else:
-            text = f"{message['parts']}"
-            #with st.align(alignment):
-                #st.write(text, unsafe_allow_html=True)
-            st.markdown(f"<div style='text-align: {alignment};'>{text}</div>", unsafe_allow_html=True)
+    if hidden > 0:
+        st.button(f"⋯ ({hidden})", key="olderMessages", on_click=Show_Older_Messages)
 
 
-def Imagen_Creation(prompt: str, npics: int) -> tuple[bool, list]:
+def Imagen_Creation(prompt: str, npics: int) -> tuple[bool, list, bool]:
     '''
+    Draw npics pictures for the prompt, shown side by side as each one arrives. The
+    pictures are requested in parallel and kept as JPEG bytes; identical requests
+    are answered from a shared cache for 'imagen_cache_ttl' seconds.
+    Returns (success, images, served from cache).
     '''
-    isOK = False
-    generated_images = []
-
-    #-- Using imagen-3.0-generate-002 Model ------
+    imagen_utils = libs.lazy_import("imagen_utils")
+    config = imagen_utils.build_config()
+    key = imagen_utils.cache_key(prompt, npics, config)
+    imagen_cache = Get_Imagen_Cache()
+    images = imagen_cache.get(key)
+    columns = st.columns(npics)
+    if images is not None:
+        for column, image in zip(columns, images):
+            column.image(image, caption=prompt)
+        return True, images, True
+
+    images = []
+    scheduler = Get_Scheduler()
+    admitted = 0
     try:
-        response = st.session_state.client.models.generate_images(
-            model='imagen-4.0-generate-001', #'imagen-3.0-generate-002',
-            prompt = prompt,
-            config=genai.types.GenerateImagesConfig(number_of_images= npics,
-                                              output_mime_type="image/jpeg",
-                                              personGeneration = "allow_adult",
-                                                )
-            ) 
-
-        for generated_image in response.generated_images:
-            image = Image.open(BytesIO(generated_image.image.image_bytes))
-            st.image(image)
-            generated_images.append(image)
-            isOK = True
+        with metrics_utils.span("queue"):
+            waiting_box = st.empty()
+            for _ in range(npics):
+                Admit_Request(scheduler, imagen_utils.IMAGEN_MODEL, 0, Request_Priority(), waiting_box)
+                admitted += 1
+        with metrics_utils.span("imagen"):
+            for image in imagen_utils.generate(st.session_state.client, prompt, npics, config):
+                columns[len(images)].image(image, caption=prompt)
+                images.append(image)
+    except ratelimit_utils.Overloaded as e:
+        print(f"Request shed: {e}")
+        for _ in range(admitted):
+            scheduler.refund(imagen_utils.IMAGEN_MODEL)     # never sent: give the request slots back
+        metrics_utils.inc("model_shed", model=imagen_utils.IMAGEN_MODEL)
     except Exception as e:
         print(f"Imagen-4.0 model returned error! str({e})")
 
-    return isOK, generated_images    
+    if len(images) == npics:
+        imagen_cache.put(key, images)
+    return len(images) > 0, images, False
 
-def Model_Completion(contents: list, sys_prompt: str = BASE_PROMPT, temperature: float = 0.7) -> tuple[dict, int]:
+@st.cache_resource(show_spinner=False)
+def Get_Imagen_Cache() -> cache_utils.LRUCache:
+    '''
+    Process-wide cache of generated pictures (JPEG bytes) per prompt and config.
     '''
+    return cache_utils.LRUCache(max_bytes=int(st.secrets.get("imagen_cache_mb", 32)) * 1024 * 1024,
+                                ttl=float(st.secrets.get("imagen_cache_ttl", 3600)))
+
+@st.cache_resource(show_spinner=False)
+def Get_Response_Cache() -> tuple[cache_utils.LRUCache, cache_utils.SingleFlight]:
+    '''
+    Process-wide exact-match response cache and single-flight group, shared by all sessions.
+    '''
+    response_cache = cache_utils.LRUCache(max_bytes=int(st.secrets.get("response_cache_mb", 64)) * 1024 * 1024,
+                                          ttl=float(st.secrets.get("response_cache_ttl", 3600)),
+                                          size_fn=lambda result: cache_utils.sizeof(result[0]) * 2)
+    return response_cache, cache_utils.SingleFlight()
+
+def Response_Cache_Key(model: str, sys_prompt: str, temperature: float, contents: list, document: str, search: bool) -> str:
+    '''
+    Normalized key of a request: model, system prompt, temperature, search flag and a hash of the contents.
+    '''
+    digest = hashlib.sha256()
+    for value in (model, (sys_prompt or "").strip(), f"{temperature:.2f}", str(search), document or ""):
+        digest.update(value.encode("utf-8"))
+        digest.update(b"\0")
+    for content in contents:
+        digest.update(content.model_dump_json(exclude_none=True).encode("utf-8"))
+    return digest.hexdigest()
+
+def Collect_Response(responses, placeholder=None) -> tuple[str, list, object, list]:
+    '''
+    Walk the chunks of a (streamed or blocking) generate_content response and gather
+    the text and image parts. When a placeholder is given, the text is rendered into
+    it as each chunk arrives.
+
+    Returns the full text, the generated images, the last usage metadata and the
+    model parts (streamed text merged, thought signatures kept) for the chat history.
+    '''
+    text = ""
+    images = []
+    usage = None
+    parts = []
+    start = time.perf_counter()
+    for chunk in responses:
+        if start is not None:
+            metrics_utils.observe("model_first_chunk", time.perf_counter() - start)
+            start = None
+        if chunk.usage_metadata is not None:
+            usage = chunk.usage_metadata
+        if not chunk.candidates or chunk.candidates[0].content is None:
+            continue
+        for part in chunk.candidates[0].content.parts or []:
+            if part.text is not None and not part.thought:
+                text += part.text
+                if placeholder is not None:
+                    placeholder.markdown(text + " ▌", unsafe_allow_html=True)
+                if parts and parts[-1].text is not None and parts[-1].thought_signature is None:
+                    parts[-1] = types.Part(text=parts[-1].text + part.text, thought_signature=part.thought_signature)
+                else:
+                    parts.append(part)
+            elif part.inline_data is not None:
+                images.append(part.inline_data.data)       # kept encoded; st.image takes bytes
+                parts.append(part)
+
+    if placeholder is not None:
+        placeholder.empty()     # the full answer is rendered by Show_Messages
+
+    return text, images, usage, parts
+
+def Model_Completion(contents: list, sys_prompt: str = BASE_PROMPT, temperature: float = 0.7, stream: bool = STREAM_RESPONSES, cached_content: str = None) -> tuple[dict, int]:
+    '''
+    Send the chat contents (built by st.session_state.chat_history) to the selected model
+    and return the answer and total tokens used. The answer is added to the chat history.
+    With stream=True the answer is rendered token by token into st.session_state.chats_placeholder.
+    cached_content names a context cache already holding the system prompt (and document).
+
+    Failed calls are retried and may fall back to another model (see resilience_utils);
+    st.session_state.last_served records which model and path served the answer.
     '''    
     #print("DEBUG incoming contents:", contents)
 
-    if(len(contents) > MAX_MESSAGES+1):
-        contents.pop(1)
-        contents.pop(1)
-
-    safety_settings = [
-        {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-        {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-        {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
-        {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
-    ]
+    image_model = "2.5 image" in st.session_state.model_version or "3 Pro image" in st.session_state.model_version
+    flash_exp_model = "2.0 flash" in st.session_state.model_version
 
     tokens = 0
     ret_content = {}
+    st.session_state.last_usage = None
+    st.session_state.last_served = None
     try:
-        if "2.5 image" in st.session_state.model_version or "3 Pro image" in st.session_state.model_version:
-            response = st.session_state.client.models.generate_content(
-                #model = "gemini-2.5-flash-image",
-                model = st.session_state.llm,
-                contents = contents,
-                config=genai.types.GenerateContentConfig(response_modalities=['Text', 'Image'],
-                                                         safety_settings=safety_settings,
-                                                         )
-                )
-
-            for part in response.parts:
-                if part.text is not None:
-                    print(part.text)
-                    ret_content["text"] = part.text
-                    #st.write(part.text)
-                    st.session_state["contents"].append(part.text)
-                elif part.inline_data is not None:
-                    image = Image.open(BytesIO(part.inline_data.data))
-                    #image.save("generated_image.png")
+        #model = "gemini-2.5-flash-image",
+        model = "models/gemini-2.0-flash-exp" if flash_exp_model else st.session_state.llm
+        config = request_utils.build_config(sys_prompt, temperature,
+                                            search=st.session_state.enable_search,
+                                            cached_content=cached_content,
+                                            image_output=image_model or flash_exp_model,
+                                            timeout=MODEL_TIMEOUT)
+        fallbacks = FALLBACK_CHAINS.get(model, [])
+        chat_history = st.session_state.chat_history
+        inline = {}     # contents for fallbacks, built when one is tried
+
+        def fallback_request() -> tuple:
+            if not inline:
+                built = {"contents": contents, "config": config, "estimate": None}
+                if cached_content is not None:
+                    # the context cache belongs to the requested model: fallbacks get the document inline
+                    built["contents"], built["estimate"] = chat_history.inline_contents(sys_prompt)
+                    built["config"] = config.model_copy(update={"cached_content": None, "system_instruction": sys_prompt})
+                built["tokens"] = Request_Tokens(built["contents"])
+                inline.update(built)
+            return inline["contents"], inline["config"], inline["tokens"]
+
+        client = st.session_state.client
+        placeholder = st.session_state.chats_placeholder if stream else None
+        served = {"model": model, "requested": model, "attempts": [], "fallback": False, "hedged": False}
+
+        # read on the script thread: request() may run in a hedging worker thread
+        waiting_box = st.session_state.chats_placeholder
+        scheduler = Get_Scheduler()
+        priority = Request_Priority()
+        estimate = Request_Tokens(contents)
+
+        def request(candidate: str) -> tuple:
+            # may run in a hedging worker thread: no st.* calls unless streaming
+            if candidate == model:
+                request_contents, request_config, tokens = contents, config, estimate
+            else:
+                request_contents, request_config, tokens = fallback_request()
+            with metrics_utils.span("queue"):
+                Admit_Request(scheduler, candidate, tokens, priority, waiting_box)
+            metrics_utils.inc("model_requests", model=candidate)
+            try:
+                with metrics_utils.span("model_completion"):
+                    if placeholder is not None:
+                        responses = client.models.generate_content_stream(model=candidate, contents=request_contents, config=request_config)
+                        result = Collect_Response(responses, placeholder)
+                    else:
+                        response = client.models.generate_content(model=candidate, contents=request_contents, config=request_config)
+                        result = Collect_Response([response])
+            except Exception as ex:
+                if getattr(ex, "code", None) == 429:
+                    scheduler.penalize(candidate)     # hold everyone back, not just this session
+                raise
+            Settle_Request(scheduler, candidate, tokens, result[2])
+            return result
+
+        def call() -> tuple:
+            result, path = resilience_utils.call(request, model, fallbacks=fallbacks, retries=MODEL_RETRIES,
+                                                 hedge_after=None if stream else MODEL_HEDGE_AFTER,
+                                                 breaker_options=CIRCUIT_OPTIONS)
+            served.update(path)
+            return result
+
+        role = st.session_state["context_select" + current_user + "value"]
+        if role in RESPONSE_CACHE_ROLES and not st.session_state.enable_search and not (image_model or flash_exp_model):
+            # deterministic roles: identical requests are answered from the cache, and concurrent
+            # identical requests share one in-flight call
+            response_cache, single_flight = Get_Response_Cache()
+            document = st.session_state.chat_history.document if cached_content is not None else ""
+            cache_key = Response_Cache_Key(model, sys_prompt, temperature, contents, document, st.session_state.enable_search)
+            result = response_cache.get(cache_key)
+            shared = result is not None
+            if result is None:
+                result, shared = single_flight.do(cache_key, call)
+                if not shared and result[0]:
+                    response_cache.put(cache_key, result)
+            text, images, usage, parts = result
+            if shared:
+                usage = None    # nothing was spent for this session
+                served["attempts"].append("response cache")
+                print(f"Response cache: {response_cache.stats()}, coalesced: {single_flight.shared}")
+        else:
+            text, images, usage, parts = call()
+
+        chat_history.add_turn("model", parts)
+        chat_history.record_usage(usage, inline.get("estimate") if served["model"] != model else None)
+        st.session_state.last_usage = usage
+        st.session_state.last_served = served
+        metrics_utils.inc("model_served", model=served["model"], fallback=served["fallback"], hedged=served["hedged"])
+
+        if image_model or flash_exp_model:
+            if text:
+                print(text)
+                ret_content["text"] = text
+            for image in images:
+                if image_model:
                     st.image(image)
-                    ret_content["image"] = image
-                    st.session_state["contents"].append(image)
-        elif "2.0 flash" in st.session_state.model_version:
-            response = st.session_state.client.models.generate_content(
-                model = "models/gemini-2.0-flash-exp",
-                contents = contents,
-                config=genai.types.GenerateContentConfig(response_modalities=['Text', 'Image'],
-                                                         safety_settings=safety_settings,
-                                                         )
-                )
-
-            for part in response.candidates[0].content.parts:
-                if part.text is not None:
-                    print(part.text)
-                    ret_content["text"] = part.text
-                    #st.write(part.text)
-                    st.session_state["contents"].append(part.text)
-                elif part.inline_data is not None:
-                    image = Image.open(BytesIO(part.inline_data.data))
-                    #image.show()
-                    ret_content["image"] = image
-                    st.session_state["contents"].append(image)
-                    #st.image(image)
+                ret_content["image"] = image
+        # If the AI role is '汉语新解' or '诗词卡片', remove the code marks
+        elif st.session_state["context_select" + current_user + "value"] in ['汉语新解', '诗词卡片']:
+            ret_content["text"] = libs.remove_contexts(text)
         else:
-            if st.session_state.enable_search:
-                response = st.session_state.client.models.generate_content(
-                    model = st.session_state.llm,
-                    contents = contents,
-                    config=genai.types.GenerateContentConfig(response_modalities=['Text'],
-                                                            system_instruction=sys_prompt,
-                                                            temperature=temperature,
-                                                            tools=[
-                                                                types.Tool(google_search=types.GoogleSearch())
-                                                            ],
-                                                            )
-                    )
-            else:
-                response = st.session_state.client.models.generate_content(
-                    model = st.session_state.llm,
-                    contents = contents,
-                    config=genai.types.GenerateContentConfig(response_modalities=['Text'],
-                                                            system_instruction=sys_prompt,
-                                                            temperature=temperature,
-                                                            )
-                    )
-                            
-            # If the AI role is '汉语新解' or '诗词卡片', remove the code marks
-            if st.session_state["context_select" + current_user + "value"] in ['汉语新解', '诗词卡片']:
-                ret_content = libs.remove_contexts(response.text)
-            else:
-                ret_content["text"] = response.text
+            ret_content["text"] = text
 
         print(f"AI model returned: {ret_content}")
-        print(response.usage_metadata)
+        print(usage)
+        print(f"Client connections: {client_utils.connection_stats()}")
+        print(f"Served by: {served}")
         # ( prompt_token_count: 11, candidates_token_count: 73, total_token_count: 84 )
-        tokens = response.usage_metadata.total_token_count
+        if usage is not None and usage.total_token_count is not None:
+            tokens = usage.total_token_count
+            st.session_state.cached_tokens += usage.cached_content_token_count or 0
+    except ratelimit_utils.Overloaded as e:
+        print(f"Request shed: {e}")
+        metrics_utils.inc("model_shed", model=st.session_state.llm)
+        st.session_state.chats_placeholder.empty()
+        ret_content = {"text": BUSY_MESSAGE, "shed": True}
     except Exception as e:
+        metrics_utils.inc("model_errors", model=st.session_state.llm)
         ret_content["text"] = f"AI model returned error! str({e})"
 
     # construct chat histrory
 
     return ret_content, tokens
 
+def Model_FanOut(contents: list, labels: list, sys_prompt: str = BASE_PROMPT, temperature: float = 0.7, first_wins: bool = False) -> tuple[dict, int]:
+    '''
+    Stream the same contents from several models at once, each into its own column,
+    and return the answer and total tokens like Model_Completion. The first complete
+    answer goes into the chat history; all answers are kept for display. With
+    first_wins the slower models are cancelled as soon as one has answered.
+    '''
+    config = request_utils.build_config(sys_prompt, temperature, search=st.session_state.enable_search, timeout=MODEL_TIMEOUT)
+    requests = {label: (FANOUT_MODELS[label], contents, config) for label in labels}
+    scheduler = Get_Scheduler()
+    estimate = Request_Tokens(contents)
+    admitted = {}
+    try:
+        with metrics_utils.span("queue"):
+            for label, (model, _, _) in requests.items():
+                Admit_Request(scheduler, model, estimate, Request_Priority(), st.session_state.chats_placeholder)
+                admitted[label] = estimate
+    except ratelimit_utils.Overloaded as e:
+        print(f"Request shed: {e}")
+        for label, tokens in admitted.items():
+            scheduler.refund(FANOUT_MODELS[label], tokens)     # never sent: give the slot and tokens back
+        metrics_utils.inc("model_shed", model="fanout")
+        st.session_state.chats_placeholder.empty()
+        return {"text": BUSY_MESSAGE, "shed": True}, 0
+    for model, _, _ in requests.values():
+        metrics_utils.inc("model_requests", model=model)
+
+    fanout_utils = libs.lazy_import("fanout_utils")
+    fan = fanout_utils.FanOut(st.session_state.client, requests, first_wins=first_wins)
+    boxes = {}
+    with st.session_state.chats_placeholder.container():
+        for label, column in zip(labels, st.columns(len(labels))):
+            column.markdown(f"**{label}**")
+            boxes[label] = column.empty()
+    try:
+        with metrics_utils.span("model_fanout"):
+            for label, text, done in fan.stream():
+                boxes[label].markdown(text + ("" if done else " ▌"), unsafe_allow_html=True)
+    finally:
+        fan.cancel()    # e.g. the user pressed stop: close the remaining streams
+    st.session_state.chats_placeholder.empty()     # the answers are rendered by Show_Messages
+
+    tokens = 0
+    columns = []
+    for label in labels:
+        result = fan.results.get(label, {"text": "", "error": None, "cancelled": True, "seconds": 0, "usage": None})
+        usage = result["usage"]
+        Settle_Request(scheduler, FANOUT_MODELS[label], admitted[label], usage)
+        if usage is not None and usage.total_token_count is not None:
+            tokens += usage.total_token_count
+            st.session_state.cached_tokens += usage.cached_content_token_count or 0
+        if label != fan.winner and not result["cancelled"]:
+            Record_Usage(FANOUT_MODELS[label], usage)     # the winner is recorded by the caller
+        if result["error"] is not None:
+            status, text = "⚠️", f"AI model returned error! str({result['error']})"
+        elif result["cancelled"]:
+            status, text = "⏹", result["text"]
+        else:
+            status, text = f"{result['seconds']:.1f}s", result["text"]
+        columns.append((label, text, status))
+
+    if fan.winner is None:
+        metrics_utils.inc("model_errors", model="fanout")
+        return {"text": "AI model returned error! " + "; ".join(text for _, text, _ in columns), "columns": columns}, tokens
+
+    winner = fan.results[fan.winner]
+    st.session_state.chat_history.add_turn("model", winner["parts"])
+    st.session_state.chat_history.record_usage(winner["usage"])
+    st.session_state.last_usage = winner["usage"]
+    st.session_state.last_served = {"model": winner["model"], "requested": ",".join(FANOUT_MODELS[label] for label in labels),
+                                    "attempts": [f"{FANOUT_MODELS[label]}: {status}" for label, _, status in columns],
+                                    "fallback": False, "hedged": False, "fanout": True}
+    metrics_utils.inc("model_served", model=winner["model"], fanout=True)
+    print(f"Fan-out served by: {st.session_state.last_served}")
+    return {"text": winner["text"], "columns": columns}, tokens
+
+@st.cache_resource(show_spinner=False)
+def Report_Import_Times() -> None:
+    '''
+    Print the breakdown of the eager imports once per process, at startup. Modules
+    loaded later through libs.lazy_import are printed as they load and listed in the admin view.
+    '''
+    print(libs.import_report())
+
+@st.cache_resource(show_spinner=False)
+def Setup_Extraction_Cache() -> None:
+    '''
+    Size the shared document extraction cache from secrets, once per process.
+    '''
+    libs.configure_extraction_cache(max_bytes=int(st.secrets.get("extract_cache_mb", 128)) * 1024 * 1024,
+                                    disk_folder=st.secrets.get("extract_cache_dir"))
+    if "pdf_max_chars" in st.secrets:
+        libs.PDF_MAX_CHARS = int(st.secrets["pdf_max_chars"])
+    if "pdf_workers" in st.secrets:
+        libs.PDF_WORKERS = int(st.secrets["pdf_workers"])
+
+@st.cache_resource(show_spinner=False)
+def Start_Metrics() -> None:
+    '''
+    Register the shared caches' stats as gauges and start the Prometheus exporters
+    ('metrics_port' and/or 'metrics_file' secrets), once per process.
+    '''
+    response_cache, _ = Get_Response_Cache()
+    metrics_utils.register_gauges("client", client_utils.connection_stats)
+    metrics_utils.register_gauges("audit_log", log_utils.log_stats)
+    metrics_utils.register_gauges("extraction_cache", lambda: libs.EXTRACTION_CACHE.stats())
+    metrics_utils.register_gauges("retrieval_index", lambda: sys.modules["retrieval_utils"].index_stats()
+                                  if "retrieval_utils" in sys.modules else {})     # loaded on first use
+    metrics_utils.register_gauges("response_cache", response_cache.stats)
+    metrics_utils.register_gauges("imagen_cache", Get_Imagen_Cache().stats)
+    metrics_utils.register_gauges("circuit_open", lambda: {model: int(state != "closed")
+                                                           for model, state in resilience_utils.breaker_states().items()},
+                                  label="model")
+    metrics_utils.register_gauges("scheduler", Get_Scheduler().stats)
+    metrics_utils.register_gauges("scheduler_waiting", Get_Scheduler().waiting, label="model")
+    metrics_utils.register_gauges("session_memory", memory_utils.session_stats)
+    metrics_utils.register_gauges("mail", lambda: get_dispatcher().stats() if get_dispatcher() else {})
+    started = metrics_utils.start_exporters(port=st.secrets.get("metrics_port"),
+                                            path=st.secrets.get("metrics_file"),
+                                            interval=float(st.secrets.get("metrics_interval", 15)),
+                                            host=st.secrets.get("metrics_host", "127.0.0.1"))
+    print(f"Metrics exported to: {started}")
+
+def Is_Admin() -> bool:
+    '''
+    An admin is a user signed in through the authenticator (Login) whose username is
+    in ADMIN_USERS, a visitor whose URL carries ?admin=<admin_token>, or a client whose
+    ip (resolved through the trusted proxies only) is in ADMIN_NETWORKS. The ID typed
+    into the welcome box proves nothing and never counts.
+    '''
+    if st.session_state.get("authentication_status") is True and st.session_state.get("username") in ADMIN_USERS:
+        return True
+    if ADMIN_TOKEN and hmac.compare_digest(st.query_params.get("admin", ""), ADMIN_TOKEN):
+        return True
+    try:
+        ip = ipaddress.ip_address(st.session_state.get("user_ip", ""))
+    except ValueError:
+        return False
+    return any(ip in network for network in ADMIN_NETWORKS)
+
+def Show_Admin() -> None:
+    '''
+    Admin-only view of the process metrics: stage latencies, counters, cache gauges and recent requests.
+    '''
+    snapshot = metrics_utils.REGISTRY.snapshot()
+    st.markdown("**Latency (s)**")
+    st.dataframe([{"stage": stage, **summary} for stage, summary in snapshot["stages"].items()], use_container_width=True)
+    st.markdown("**Recent requests**")
+    rows = []
+    for trace in reversed(snapshot["traces"]):
+        row = {"time": datetime.fromtimestamp(trace["at"]).strftime("%H:%M:%S"), "user": trace.get("user"),
+               "model": trace.get("model"), "total": round(trace["seconds"], 3)}
+        for stage, seconds in trace["spans"]:
+            row[stage] = round(row.get(stage, 0) + seconds, 3)
+        rows.append(row)
+    st.dataframe(rows, use_container_width=True)
+    c1, c2 = st.columns(2)
+    with c1:
+        st.markdown("**Counters**")
+        st.json(snapshot["counters"], expanded=False)
+    with c2:
+        st.markdown("**Gauges**")
+        st.json(snapshot["gauges"], expanded=False)
+    st.markdown("**Session memory**")
+    st.dataframe([{"session": row["session"], "user": row["user"], "KB": row["bytes"] // 1024, "messages": row.get("messages"),
+                   "turns": row.get("turns"), "updated": datetime.fromtimestamp(row["updated"]).strftime("%H:%M:%S")}
+                  for row in memory_utils.sessions()], use_container_width=True)
+    st.markdown("**Import times (ms)**")
+    st.dataframe([{"module": name, "ms": round(seconds * 1000, 1)}
+                  for name, seconds in sorted(libs.IMPORT_TIMES.items(), key=lambda kv: -kv[1])], use_container_width=True)
+    st.download_button("metrics.prom", metrics_utils.REGISTRY.prometheus_text(), file_name="metrics.prom", mime="text/plain")
+
 @st.cache_resource(show_spinner=False)
 def Main_Title(text: str) -> None:
     st.markdown(f'<h1 style="background-color:#ffffff;color:#049ca4;font-weight:bold;font-size:22px;border-radius:2%;">{text}</h1>', unsafe_allow_html=True)
 
-#@st.cache_data(show_spinner=False)
 def create_client() -> genai.Client:
     '''
-    Create and return a Gemini API client.
+    Return the process-wide Gemini API client. It is shared by all sessions so that
+    reruns reuse the pooled HTTP connections instead of opening new ones.
     '''
-    client = genai.Client(api_key=st.secrets["api_key"])
+    if st.secrets.get("gemini_backend", "gemini") == "fake":
+        # offline stand-in (demos, benchmarks): recorded or synthetic answers, no api_key needed
+        fake_gemini = libs.lazy_import("fake_gemini")
+        return fake_gemini.get_client(responses_path=st.secrets.get("fake_responses"),
+                                      latency=float(st.secrets.get("fake_latency", 0.5)),
+                                      chunk_latency=float(st.secrets.get("fake_chunk_latency", 0.02)),
+                                      chunk_chars=int(st.secrets.get("fake_chunk_chars", 40)),
+                                      images=int(st.secrets.get("fake_images", 1)),
+                                      error_rate=float(st.secrets.get("fake_error_rate", 0)),
+                                      )
+    client = client_utils.get_client(api_key=st.secrets["api_key"],
+                                     timeout=float(st.secrets.get("http_timeout", 120)),
+                                     max_connections=int(st.secrets.get("http_max_connections", 100)),
+                                     max_keepalive=int(st.secrets.get("http_max_keepalive", 20)),
+                                     keepalive_expiry=float(st.secrets.get("http_keepalive_expiry", 60)),
+                                     )
     return client
 
+def Use_Retrieval() -> bool:
+    '''
+    Retrieval mode applies when it is switched on and the document is larger than the excerpts would be.
+    '''
+    if not st.session_state.retrieval_mode:
+        return False
+    retrieval_utils = libs.lazy_import("retrieval_utils")
+    document = st.session_state.loaded_content.strip()
+    return len(document) > RETRIEVAL_TOP_K * retrieval_utils.CHUNK_CHARS
+
+def History_Budget() -> int:
+    '''
+    Prompt token budget for the selected model; the 'history_token_budget' secret overrides it.
+    '''
+    if "history_token_budget" in st.secrets:
+        return int(st.secrets["history_token_budget"])
+    return history_utils.token_budget(st.session_state.llm)
+
 ##############################################
 ################ MAIN ########################
 ##############################################
@@ -654,13 +1216,6 @@ def main(argv: list) -> None:
     #st.header(st.session_state.locale.title)
     Main_Title(st.session_state.locale.title)
     st.markdown(f"Hello {st.session_state.user}", unsafe_allow_html=True)
-    try:
-        st.session_state.user_ip = get_client_ip()
-        st.session_state.user_location = get_geolocation(st.session_state.user_ip)
-    except Exception as ex:
-        st.session_state.user_ip = "unknown_ip"
-        st.session_state.user_location = "unknown_location"
-        print(f"Exception getting user ip/location: {ex}")
 
     st.session_state.client = create_client()
     
@@ -680,7 +1235,7 @@ def main(argv: list) -> None:
         st.session_state.llm = "gemini-3-pro-preview"
         st.session_state.search_disabled = False
     elif "2.5 Pro" in st.session_state.model_version:
-        st.session_state.llm = "ggemini-2.5-pro"
+        st.session_state.llm = "gemini-2.5-pro"
         st.session_state.search_disabled = False
     elif "2.5 flash" in st.session_state.model_version:
         st.session_state.llm = "gemini-2.5-flash"
@@ -697,13 +1252,22 @@ def main(argv: list) -> None:
 
     st.sidebar.button(st.session_state.locale.chat_clear_btn, on_click=Clear_Chat)
     st.session_state.temperature = st.sidebar.slider(label=st.session_state.locale.temperature_label, min_value=0.1, max_value=2.0, value=0.7, step=0.05)
+    with st.sidebar.expander(st.session_state.locale.fanout_label):
+        st.session_state.fanout_models = st.multiselect(label=st.session_state.locale.fanout_label, options=list(FANOUT_MODELS),
+                                                        key="fanout_select", label_visibility="collapsed")
+        st.session_state.fanout_first_wins = st.checkbox(label=st.session_state.locale.first_wins_label, key="fanout_first_wins_check")
     st.sidebar.markdown("<p class='tiny-font'>注意：若接下来的话题与之前的不相关，请点击“新话题”按钮，以确保新话题不会受之前内容的影响，同时也有助于节省字符传输量。谢谢！</p>", unsafe_allow_html=True)
     st.sidebar.markdown(f"<p class='tiny-font'>{st.session_state.locale.support_message}", unsafe_allow_html=True)
 
     sys_role_placeholder = st.write("AI的角色: **" + st.session_state["context_select" + current_user + "value"] + "**")
-    tab_input, tab_context = st.tabs(
-        ["💬 聊天", "🤖 AI角色预设"]
-    )
+    tab_names = ["💬 聊天", "🤖 AI角色预设"]
+    if Is_Admin():
+        tab_names.append("📊 监控")
+    tab_input, tab_context, *tab_admin = st.tabs(tab_names)
+
+    for tab in tab_admin:
+        with tab:
+            Show_Admin()
 
     with tab_context:
         set_context_list = list(set_context_all.keys())
@@ -741,22 +1305,28 @@ def main(argv: list) -> None:
         # #with chats_placeholder:
         # Show_Messages(chats_placeholder)
 
-        pil_image = None
+        image_part = None
 
         with st.session_state.uploading_file_placeholder:
             uploaded_file = st.file_uploader(label=st.session_state.locale.file_upload_label, type=['docx', 'txt', 'pdf', 'csv', 'jpg','jpeg', 'png', 'webp'], key=st.session_state.key, accept_multiple_files=False,)
             if uploaded_file is not None:
                 mime_type = uploaded_file.type
                 if uploaded_file.name.split(".")[-1] in ['jpeg', 'jpg', 'png', 'webp']:
-                        pil_image = Image.open(uploaded_file)
-                        st.session_state.loaded_image, ierror = libs.GetContexts(uploaded_file)
+                        # oriented, downsized and re-encoded once; this is what the model receives
+                        profile = image_utils.profile_for_role(st.session_state["context_select" + current_user + "value"])
+                        image_part, image_report = image_utils.prepare_image(uploaded_file.getvalue(), **profile)
+                        with metrics_utils.span("get_contexts"):
+                            st.session_state.loaded_image, ierror = libs.GetContexts(uploaded_file)
                         if ierror != 0:
                             st.session_state.uploaded_filename_placeholder.warning(st.session_state.loaded_content)
                         else:
-                            with st.session_state.uploaded_filename_placeholder:
+                            with st.session_state.uploaded_filename_placeholder.container():
                                 Display_Uploaded_Image(st.session_state.loaded_image)
+                                st.caption(f"{image_report['original_width']}x{image_report['original_height']} → {image_report['width']}x{image_report['height']}, "
+                                           f"{image_report['original_bytes'] // 1024} KB → {image_report['prepared_bytes'] // 1024} KB")
                 else:
-                    st.session_state.loaded_content, ierror = libs.GetContexts(uploaded_file)
+                    with metrics_utils.span("get_contexts"):
+                        st.session_state.loaded_content, ierror = libs.GetContexts(uploaded_file)
                     if ierror != 0:
                         st.session_state.uploaded_filename_placeholder.warning(st.session_state.loaded_content)
                     else:
@@ -766,81 +1336,119 @@ def main(argv: list) -> None:
                         st.session_state.enable_search = False
                         st.session_state.search_disabled = True
         with st.session_state.buttons_placeholder:
-            c1, c2 = st.columns(2)
+            c1, c2, c3 = st.columns(3)
             with c1:
                 st.session_state.new_topic_button = st.button(label=st.session_state.locale.chat_clear_btn, key="newTopic", on_click=Clear_Chat)
             with c2:
                 st.session_state.enable_search = st.checkbox(label=st.session_state.locale.enable_search_label, disabled=st.session_state.search_disabled, value=st.session_state.enable_search)
+            with c3:
+                st.session_state.retrieval_mode = st.checkbox(label=st.session_state.locale.retrieval_label, disabled=st.session_state.loaded_content.strip() == "", value=st.session_state.retrieval_mode)
 
         user_input = st.session_state.input_placeholder.text_area(label=st.session_state.locale.chat_placeholder, value=st.session_state.user_text, max_chars=8000, key="1")
+        st.session_state.out_quota = Out_Of_Quota()
         send_button = st.button(st.session_state.locale.chat_run_btn, disabled=st.session_state.out_quota)
         if send_button :
-            parts = []
-            print(f"{st.session_state.user}: {user_input}")
-            if(user_input.strip() != ''):
-                prompt = user_input.strip()
-                prefixes = ["!!!", "！！！"]
-                if(prompt.startswith(tuple(prefixes))):
-                    if (TEXT2IMG_ENABLES == "yes"): 
-                        #-- Using imagen-3.0-generate-002 Model ------
-                        prompt = " ".join(prompt.split()[1:])
-                        print(f"DEBUG: {prompt}")
-                        with st.spinner('Wait ...'):
-                            isOK, ret_images = Imagen_Creation(prompt, 2)
-                            if(isOK == True):
-                                st.session_state.total_tokens += 1500
-                                save_log(prompt, "image generated", st.session_state.total_tokens)
-                                Show_Images(prompt, ret_images)
-                            else:
-                                save_log(prompt, "画画失败。请等下再试！", st.session_state.total_tokens)
-                                st.markdown(f"画画失败。请等下再试！", unsafe_allow_html=True)
-                    else:
-                        st.markdown(f"画画暂时没有开放，请以后再试！", unsafe_allow_html=True)
-                        save_log(prompt, "画画暂时没有开放，请以后再试！", st.session_state.total_tokens)
-                else:
-                    print(f"I am using the model: {st.session_state.model_version}")
-                    parts.append(prompt)
-                    if st.session_state.loaded_content.strip() != "":
-                        print("Context supplied!")
-                        parts.append(st.session_state.loaded_content.strip())
-                    if st.session_state.loaded_image != None:
-                        print("Image supplied!")
-                        parts.append(pil_image)
-
-                    st.session_state.messages += [{"role": "user", "parts": parts}]
-                    #print(f"DEBUG0: {st.session_state.messages}\n")
-
-                    with st.spinner('Wait ...'):
-                        if "2.0 flash" in st.session_state.model_version or "2.5 image" in st.session_state.model_version:
-                            st.session_state.contents += parts
-                            answer, tokens = Model_Completion(st.session_state.contents)
+            # one trace per request: the stages below are kept as its latency breakdown
+            with metrics_utils.trace("send", user=st.session_state.user, model=st.session_state.llm):
+                parts = []
+                print(f"{st.session_state.user}: {user_input}")
+                if(user_input.strip() != ''):
+                    prompt = user_input.strip()
+                    prefixes = ["!!!", "！！！"]
+                    if(prompt.startswith(tuple(prefixes))):
+                        if (TEXT2IMG_ENABLES == "yes"): 
+                            #-- Using imagen-3.0-generate-002 Model ------
+                            prompt = " ".join(prompt.split()[1:])
+                            print(f"DEBUG: {prompt}")
+                            with st.spinner('Wait ...'):
+                                isOK, ret_images, cached = Imagen_Creation(prompt, 2)
+                                if(isOK == True):
+                                    if not cached:
+                                        st.session_state.total_tokens += 1500
+                                        Record_Usage("imagen", queries=0, total_tokens=1500)
+                                    save_log(prompt, "image generated", st.session_state.total_tokens, images=len(ret_images), cached=cached)
+                                else:
+                                    save_log(prompt, "画画失败。请等下再试！", st.session_state.total_tokens)
+                                    st.markdown(f"画画失败。请等下再试！", unsafe_allow_html=True)
                         else:
-                            st.session_state.contents += parts
-                            answer, tokens = Model_Completion(st.session_state.contents, st.session_state.sys_prompt, st.session_state.temperature)
-                        st.session_state.total_queries += 1
-                        st.session_state.total_tokens += tokens
-
-                        #print(f"RETURNED ANSWER: {answer}\n")
+                            st.markdown(f"画画暂时没有开放，请以后再试！", unsafe_allow_html=True)
+                            save_log(prompt, "画画暂时没有开放，请以后再试！", st.session_state.total_tokens)
+                    elif Out_Of_Quota():
+                        st.session_state.out_quota = True
+                    else:
+                        print(f"I am using the model: {st.session_state.model_version}")
+                        parts.append(prompt)
+                        if st.session_state.loaded_content.strip() != "":
+                            print("Context supplied!")
+                            parts.append(st.session_state.loaded_content.strip())
+                        if st.session_state.loaded_image != None:
+                            print("Image supplied!")
+                            parts.append(image_part)
+
+                        st.session_state.messages += [{"role": "user", "parts": parts}]
+                        #print(f"DEBUG0: {st.session_state.messages}\n")
 
-                        if 'text' in answer:
-                            generated_text = answer["text"]
-                            Show_Audio_Player(generated_text)
-                        else:
-                            generated_text = "No text generated!"
+                        with st.spinner('Wait ...'):
+                            # the document is pinned in the history rather than repeated in every turn,
+                            # or, in retrieval mode, only its most relevant chunks go with the question
+                            if Use_Retrieval():
+                                st.session_state.chat_history.set_document("")
+                                with metrics_utils.span("retrieval"):
+                                    context = libs.lazy_import("retrieval_utils").retrieve(st.session_state.loaded_content, prompt, RETRIEVAL_TOP_K)
+                                st.session_state.chat_history.add_turn("user", [prompt, context, image_part])
+                            else:
+                                st.session_state.chat_history.set_document(st.session_state.loaded_content)
+                                st.session_state.chat_history.add_turn("user", [prompt, image_part])
+                            if len(st.session_state.fanout_models) > 1 and not ("image" in st.session_state.model_version or "2.0 flash" in st.session_state.model_version):
+                                # one prompt, several models side by side
+                                contents = st.session_state.chat_history.build_contents(History_Budget(), st.session_state.sys_prompt)
+                                answer, tokens = Model_FanOut(contents, st.session_state.fanout_models, st.session_state.sys_prompt,
+                                                              st.session_state.temperature, st.session_state.fanout_first_wins)
+                            elif "2.0 flash" in st.session_state.model_version or "2.5 image" in st.session_state.model_version:
+                                contents = st.session_state.chat_history.build_contents(History_Budget())
+                                answer, tokens = Model_Completion(contents)
+                            else:
+                                cache_name = None
+                                if not st.session_state.enable_search and "image" not in st.session_state.model_version:
+                                    cache_name = st.session_state.context_cache.get(st.session_state.client, st.session_state.llm,
+                                                                                    st.session_state.sys_prompt,
+                                                                                    st.session_state.chat_history.document)
+                                contents = st.session_state.chat_history.build_contents(History_Budget(), st.session_state.sys_prompt,
+                                                                                        include_document=cache_name is None)
+                                answer, tokens = Model_Completion(contents, st.session_state.sys_prompt, st.session_state.temperature,
+                                                                  cached_content=cache_name)
+                            if not answer.get("shed"):
+                                # a shed request was never sent: it does not count against the quota
+                                st.session_state.total_queries += 1
+                                served = st.session_state.last_served
+                                Record_Usage(served["model"] if served else st.session_state.llm, st.session_state.last_usage)
+                            st.session_state.total_tokens += tokens
+
+                            #print(f"RETURNED ANSWER: {answer}\n")
+
+                            if 'text' in answer:
+                                generated_text = answer["text"]
+                                Show_Audio_Player(generated_text)
+                            else:
+                                generated_text = "No text generated!"
 
-                        if "2.0 flash" in st.session_state.model_version:
-                            st.session_state.messages += [{"role": "model", "parts": answer}]
-                        else:
-                            st.session_state.messages += [{"role": "model", "parts": [answer]}]
+                            if "2.0 flash" in st.session_state.model_version:
+                                st.session_state.messages += [{"role": "model", "parts": answer}]
+                            else:
+                                st.session_state.messages += [{"role": "model", "parts": [answer]}]
 
-                    #print(f"DEBUG2: {st.session_state.messages}")
+                        #print(f"DEBUG2: {st.session_state.messages}")
 
-                    #with chats_placeholder:
-                    Show_Messages(st.session_state.chats_placeholder)
+                        save_log(prompt, generated_text, st.session_state.total_tokens, served_by=st.session_state.last_served)
+                        if sendmail:
+                            with metrics_utils.span("send_mail"):
+                                send_mail(prompt, answer, st.session_state.total_tokens)
 
-                    save_log(prompt, generated_text, st.session_state.total_tokens)
-                    if sendmail:
-                        send_mail(prompt, answer, st.session_state.total_tokens)
+        # rendered on every rerun so paging through older messages works
+        if st.session_state.messages:
+            Show_Messages()
+        with metrics_utils.span("memory"):
+            Enforce_Memory_Budget()
 
         #cost = 8*0.015 * st.session_state.total_tokens /1000
         #if st.session_state.user_id in ["wenli2000", "yezheng", "yayuan181"]:
@@ -849,6 +1457,10 @@ def main(argv: list) -> None:
         #    #small_print = f"你目前用掉 {st.session_state.total_tokens} 字符 (约人民币{cost:.4f}元)"
         #    small_print = f"你目前用掉 {st.session_state.total_tokens} 字符"
         small_print = f"你目前用掉 {st.session_state.total_tokens} 字符"
+        if st.session_state.cached_tokens > 0:
+            small_print += f" (其中缓存 {st.session_state.cached_tokens})"
+        if st.session_state.last_served and st.session_state.last_served["fallback"]:
+            small_print += f" · 上一个回答由 {st.session_state.last_served['model']} 提供"
         st.markdown("""
             <style>
             .tiny-font {font-size:11px !important;}
@@ -856,13 +1468,21 @@ def main(argv: list) -> None:
             """, unsafe_allow_html=True)
         st.markdown(f'<p class="tiny-font">{small_print}</p>', unsafe_allow_html=True)
 
-        if st.session_state.user not in VALID_USERS and st.session_state.total_queries > TOTAL_TRIALS:
+        if st.session_state.tts_text:
+            with st.session_state.gtts_placeholder:
+                Audio_Player()
+
+        if st.session_state.out_quota or Out_Of_Quota():
             st.session_state.out_quota = True
             st.warning("# 你已经超过了今天的试用额度。请稍后再试！或联系管理员 tqye@yahoo.com 申请一个账号。")
 
 ##############################
 if __name__ == "__main__":
 
+    Report_Import_Times()
+    Setup_Extraction_Cache()
+    Start_Metrics()
+
     # Initiaiise session_state elements
     if "user" not in st.session_state:
         st.session_state.user = ""
@@ -874,16 +1494,13 @@ if __name__ == "__main__":
         st.session_state.user_text = ""
 
     if "user_ip" not in st.session_state:
-        st.session_state.user_ip = get_client_ip()
+        Resolve_Identity()
 
     if "user_id" not in st.session_state:
         try:
-            st.session_state.user_id = get_geolocation(st.session_state.user_ip)["city"]
+            st.session_state.user_id = st.session_state.user_location["city"]
         except:
-            st.session_state.user_id = get_geolocation(st.session_state.user_ip)
-
-    if "user_location" not in st.session_state:
-        st.session_state.user_location = None
+            st.session_state.user_id = st.session_state.user_location
 
     if "model_version" not in st.session_state:
         st.session_state.model_version = "Gemini 2.5 flash"
@@ -906,6 +1523,16 @@ if __name__ == "__main__":
                 {"role": "model", "parts": "Great to meet you. How can I assist you?"},
             ]
 
+    if "retrieval_mode" not in st.session_state:
+        # off unless 'retrieval_default' = "yes": excerpts change the answers users are used to
+        st.session_state.retrieval_mode = st.secrets.get("retrieval_default", "no") == "yes"
+
+    # last answer offered as audio, and its synthesis job once play was pressed
+    if "tts_text" not in st.session_state:
+        st.session_state.tts_text = ""
+        st.session_state.tts_future = None
+        st.session_state.tts_error = None
+
     if "enable_search" not in st.session_state:
         st.session_state.enable_search = False
 
@@ -915,6 +1542,14 @@ if __name__ == "__main__":
     if 'total_tokens' not in st.session_state:
         st.session_state.total_tokens = 0
 
+    if 'cached_tokens' not in st.session_state:
+        st.session_state.cached_tokens = 0
+
+    # explicit Gemini context cache for large documents / role prompts
+    if "context_cache" not in st.session_state:
+        st.session_state.context_cache = context_utils.ContextCache(ttl=int(st.secrets.get("context_cache_ttl", 600)),
+                                                                    min_tokens=int(st.secrets.get("context_cache_min_tokens", context_utils.MIN_CACHE_TOKENS)))
+
     if 'tokens' not in st.session_state:
         st.session_state["tokens"] = 0
 
@@ -924,9 +1559,13 @@ if __name__ == "__main__":
     if "messages" not in st.session_state:
         st.session_state.messages = []
 
-    # used by 2.0 flash exp model
-    if "contents" not in st.session_state:
-        st.session_state.contents = []
+    if "messages_shown" not in st.session_state:
+        st.session_state.messages_shown = MESSAGES_PAGE
+
+    # turns sent to the model, trimmed to a per-model token budget
+    if "chat_history" not in st.session_state:
+        st.session_state.chat_history = history_utils.ChatHistory(max_turns=MAX_MESSAGES,
+                                                                  summarize=st.secrets.get("history_summary", "no") == "yes")
 
     if "sys_prompt" not in st.session_state:
         st.session_state.sys_prompt = BASE_PROMPT
@@ -937,6 +1576,12 @@ if __name__ == "__main__":
     if 'out_quota' not in st.session_state:
         st.session_state.out_quota = False
 
+    if 'last_usage' not in st.session_state:
+        st.session_state.last_usage = None
+
+    if 'last_served' not in st.session_state:
+        st.session_state.last_served = None
+
     #if (txt2img_enabled == True):
     #    pipe = get_sd_model_pipe(model_id)
     
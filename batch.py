@@ -0,0 +1,340 @@
+###########################################################################
+# Headless batch processing for AskGemini
+#
+# Runs prompts from a JSONL or CSV file through a role preset without the UI:
+#
+#   python batch.py paragraphs.jsonl -o translated.jsonl --role 学术中英互译
+#   python batch.py chapters.csv -o polished.csv --role 英语学术润色 --model gemini-2.5-pro --concurrency 4 --rpm 30
+#   python batch.py paragraphs.jsonl -o translated.jsonl --role 学术中英互译 --batch-api
+#
+# Input is read as a stream, one record per line/row; the prompt is taken from
+# --field (default 'prompt') and the record id from --id-field (default 'id',
+# else the line number). Results are appended to the output as they complete,
+# and a rerun with the same output skips records that already succeeded.
+# With --batch-api the whole input goes to one Gemini Batch API job (cheaper,
+# finishes within hours); the job name is kept next to the output so a rerun
+# resumes waiting for it (a job that ends without results is not resumed; its
+# name is moved to <output>.batch.failed). With --limits-db the requests also go through the
+# app's shared rate limiter (the app's 'rate_limit_db' file) at the lowest
+# priority, so a batch job never crowds out interactive users.
+############################################################################
+import argparse
+import asyncio
+import csv
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from typing import Any, Dict, Iterator, Optional, Set
+
+from google.genai import types
+
+import libs
+import history_utils
+import ratelimit_utils
+import request_utils
+import resilience_utils
+import usage_utils
+
+OUTPUT_FIELDS = ["id", "text", "model", "error"] + list(usage_utils.FIELDS[1:])
+DONE_STATES = {"JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED", "JOB_STATE_PARTIALLY_SUCCEEDED"}
+
+
+def read_records(path: str, field: str, id_field: str) -> Iterator[Dict[str, str]]:
+    '''
+    Yield {"id", "prompt", "document"} from a JSONL or CSV file ('-' reads JSONL from stdin).
+    '''
+    csv_input = path.lower().endswith(".csv")
+    f = sys.stdin if path == "-" else open(path, encoding="utf-8-sig", newline="")
+    try:
+        rows = csv.DictReader(f) if csv_input else (json.loads(line) for line in f if line.strip())
+        for number, row in enumerate(rows, start=1):
+            if isinstance(row, str):
+                row = {field: row}
+            prompt = row.get(field) or row.get("text") or ""
+            if not prompt.strip():
+                continue
+            yield {"id": str(row.get(id_field) or number), "prompt": prompt, "document": row.get("document") or ""}
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+class ResultWriter:
+    '''
+    Append results to a JSONL or CSV file, flushing each one so progress survives a crash.
+    '''
+
+    def __init__(self, path: str):
+        self.csv = path.lower().endswith(".csv")
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.f = open(path, "a", encoding="utf-8", newline="")
+        if self.csv:
+            self.writer = csv.DictWriter(self.f, fieldnames=OUTPUT_FIELDS, extrasaction="ignore")
+            if new_file:
+                self.writer.writeheader()
+
+    def write(self, result: Dict[str, Any]) -> None:
+        if self.csv:
+            self.writer.writerow({**result, **result.get("usage", {})})
+        else:
+            self.f.write(json.dumps(result, ensure_ascii=False) + "\n")
+        self.f.flush()
+
+    def close(self) -> None:
+        self.f.close()
+
+
+def completed_ids(path: str) -> Set[str]:
+    '''
+    Ids already answered without error in an existing output (the resume checkpoint).
+    '''
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8", newline="") as f:
+        rows = csv.DictReader(f) if path.lower().endswith(".csv") else (json.loads(line) for line in f if line.strip())
+        for row in rows:
+            if row.get("error"):
+                done.discard(str(row.get("id")))
+            else:
+                done.add(str(row.get("id")))
+    return done
+
+
+class RateLimiter:
+    '''
+    Spread requests evenly to at most rpm per minute and, given a shared scheduler,
+    wait for its admission at batch priority.
+    '''
+
+    def __init__(self, rpm: float, scheduler: Optional[ratelimit_utils.Scheduler] = None):
+        self.interval = 60.0 / rpm if rpm else 0.0
+        self.next_at = 0.0
+        self.lock = asyncio.Lock()
+        self.scheduler = scheduler
+
+    async def wait(self, model: str = "", tokens: int = 0) -> None:
+        if self.interval:
+            async with self.lock:
+                now = time.monotonic()
+                delay = self.next_at - now
+                self.next_at = max(now, self.next_at) + self.interval
+            if delay > 0:
+                await asyncio.sleep(delay)
+        while self.scheduler is not None:
+            try:
+                await asyncio.to_thread(self.scheduler.admit, model, tokens, ratelimit_utils.PRIORITY_BATCH)
+                return
+            except ratelimit_utils.Overloaded:
+                await asyncio.sleep(random.uniform(1.0, 5.0))   # the app is busy: back off
+
+    async def settle(self, model: str, tokens: int, usage: Any) -> None:
+        '''
+        Correct the shared scheduler's token count with the usage the model reported.
+        '''
+        if self.scheduler is not None and usage is not None and usage.total_token_count is not None:
+            await asyncio.to_thread(self.scheduler.settle, model, tokens, usage.total_token_count)
+
+
+async def answer(client: Any, record: Dict[str, str], args: argparse.Namespace, config: types.GenerateContentConfig,
+                 limiter: RateLimiter) -> Dict[str, Any]:
+    contents = request_utils.build_contents(record["prompt"], record["document"])
+    tokens = history_utils.estimate_text_tokens(record["prompt"] + record["document"])
+    error = None
+    for attempt in range(args.retries + 1):
+        if attempt > 0:
+            await asyncio.sleep(random.uniform(0, min(30.0, 2 ** attempt)))
+        await limiter.wait(args.model, tokens)
+        try:
+            response = await client.aio.models.generate_content(model=args.model, contents=contents, config=config)
+            await limiter.settle(args.model, tokens, response.usage_metadata)
+            return {"id": record["id"], "text": response.text or "", "model": args.model, "error": "",
+                    "usage": usage_utils.usage_breakdown(response.usage_metadata)}
+        except Exception as ex:
+            error = ex
+            if not resilience_utils.is_retryable(ex):
+                break
+    return {"id": record["id"], "text": "", "model": args.model, "error": f"{error}", "usage": {}}
+
+
+async def run_online(client: Any, args: argparse.Namespace) -> Dict[str, int]:
+    '''
+    Answer the records with at most args.concurrency requests in flight, reading the
+    input only as fast as the workers take records.
+    '''
+    config = request_utils.build_config(request_utils.system_prompt(args.role, args.context), args.temperature)
+    scheduler = None
+    if args.limits_db:
+        scheduler = ratelimit_utils.Scheduler(limits=ratelimit_utils.parse_limits(args.model_limits),
+                                              store=ratelimit_utils.SqliteBuckets(args.limits_db))
+    limiter = RateLimiter(args.rpm, scheduler)
+    done = completed_ids(args.output) if not args.restart else set()
+    writer = ResultWriter(args.output)
+    queue: asyncio.Queue = asyncio.Queue(maxsize=args.concurrency * 2)
+    stats = {"done": 0, "failed": 0, "skipped": 0}
+    start = time.monotonic()
+
+    async def worker() -> None:
+        while True:
+            record = await queue.get()
+            if record is None:
+                return
+            result = await answer(client, record, args, config, limiter)
+            writer.write(result)
+            stats["failed" if result["error"] else "done"] += 1
+            if args.progress and (stats["done"] + stats["failed"]) % args.progress == 0:
+                rate = (stats["done"] + stats["failed"]) / (time.monotonic() - start)
+                print(f"{stats} ({rate:.1f}/s)", file=sys.stderr)
+
+    workers = [asyncio.create_task(worker()) for _ in range(args.concurrency)]
+    try:
+        for record in read_records(args.input, args.field, args.id_field):
+            if record["id"] in done:
+                stats["skipped"] += 1
+                continue
+            await queue.put(record)
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+    finally:
+        writer.close()
+    return stats
+
+
+def batch_request(record: Dict[str, str], config: types.GenerateContentConfig) -> Dict[str, Any]:
+    '''
+    One line of a Batch API input file: the same request the online path sends.
+    '''
+    contents = request_utils.build_contents(record["prompt"], record["document"])
+    request = {"contents": [content.model_dump(mode="json", exclude_none=True) for content in contents],
+               "generation_config": {"temperature": config.temperature}}
+    if config.system_instruction:
+        request["system_instruction"] = {"parts": [{"text": config.system_instruction}]}
+    return {"key": record["id"], "request": request}
+
+
+def run_batch_api(client: Any, args: argparse.Namespace) -> Dict[str, int]:
+    config = request_utils.build_config(request_utils.system_prompt(args.role, args.context), args.temperature)
+    state_path = args.output + ".batch"
+    stats = {"done": 0, "failed": 0, "skipped": 0}
+
+    if os.path.exists(state_path):
+        with open(state_path, encoding="utf-8") as f:
+            job_name = f.read().strip()
+        print(f"Resuming batch job {job_name}", file=sys.stderr)
+    else:
+        done = completed_ids(args.output) if not args.restart else set()
+        with tempfile.NamedTemporaryFile("w", suffix=".jsonl", encoding="utf-8", delete=False) as f:
+            requests_path = f.name
+            for record in read_records(args.input, args.field, args.id_field):
+                if record["id"] in done:
+                    stats["skipped"] += 1
+                    continue
+                f.write(json.dumps(batch_request(record, config), ensure_ascii=False) + "\n")
+        try:
+            uploaded = client.files.upload(file=requests_path, config=types.UploadFileConfig(mime_type="jsonl"))
+        finally:
+            os.remove(requests_path)
+        job = client.batches.create(model=args.model, src=uploaded.name,
+                                    config=types.CreateBatchJobConfig(display_name=f"askgemini-{os.path.basename(args.output)}"))
+        job_name = job.name
+        with open(state_path, "w", encoding="utf-8") as f:
+            f.write(job_name)
+        print(f"Created batch job {job_name}", file=sys.stderr)
+
+    job = client.batches.get(name=job_name)
+    while job.state.name not in DONE_STATES:
+        print(f"{job_name}: {job.state.name}", file=sys.stderr)
+        time.sleep(args.poll)
+        job = client.batches.get(name=job_name)
+    if job.dest is None or not job.dest.file_name:
+        # the job is over: keep its name for reference, but do not resume it again
+        os.replace(state_path, state_path + ".failed")
+        raise RuntimeError(f"Batch job {job_name} ended in {job.state.name}: {job.error}")
+
+    writer = ResultWriter(args.output)
+    try:
+        for line in client.files.download(file=job.dest.file_name).decode("utf-8").splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            response = types.GenerateContentResponse.model_validate(item["response"]) if item.get("response") else None
+            error = item.get("error") or (None if response is not None else "no response")
+            writer.write({"id": item.get("key"), "text": (response.text or "") if response else "", "model": args.model,
+                          "error": json.dumps(error, ensure_ascii=False) if error else "",
+                          "usage": usage_utils.usage_breakdown(response.usage_metadata) if response else {}})
+            stats["failed" if error else "done"] += 1
+    finally:
+        writer.close()
+    os.remove(state_path)
+    return stats
+
+
+def get_api_key(args: argparse.Namespace) -> Optional[str]:
+    '''
+    --api-key, else GEMINI_API_KEY / GOOGLE_API_KEY, else api_key in the app's .streamlit/secrets.toml.
+    '''
+    if args.api_key:
+        return args.api_key
+    key = os.environ.get("GEMINI_API_KEY") or os.environ.get("GOOGLE_API_KEY")
+    if key:
+        return key
+    secrets_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".streamlit", "secrets.toml")
+    if os.path.exists(secrets_path):
+        import tomllib
+        with open(secrets_path, "rb") as f:
+            return tomllib.load(f).get("api_key")
+    return None
+
+
+def parse_args(argv: list) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Run prompts from a JSONL/CSV file through a Gemini model and role preset.")
+    parser.add_argument("input", help="JSONL or CSV input, '-' for JSONL on stdin")
+    parser.add_argument("-o", "--output", required=True, help="JSONL or CSV output; also the resume checkpoint")
+    parser.add_argument("--role", default="", help="role preset from libs.set_sys_context, e.g. 学术中英互译")
+    parser.add_argument("--context", default="", help="extra system context, appended to the role prompt")
+    parser.add_argument("--model", default="gemini-2.5-flash")
+    parser.add_argument("--temperature", type=float, default=0.7)
+    parser.add_argument("--field", default="prompt", help="input field holding the prompt")
+    parser.add_argument("--id-field", default="id", help="input field holding the record id")
+    parser.add_argument("--concurrency", type=int, default=8, help="requests in flight")
+    parser.add_argument("--rpm", type=float, default=60, help="requests per minute, 0 for no limit")
+    parser.add_argument("--limits-db", help="shared rate limiter file of the app (secret 'rate_limit_db')")
+    parser.add_argument("--model-limits", help="rpm/tpm per model as in the app secret 'model_limits'")
+    parser.add_argument("--retries", type=int, default=3)
+    parser.add_argument("--progress", type=int, default=50, help="report progress every N records, 0 for never")
+    parser.add_argument("--restart", action="store_true", help="ignore results already in the output")
+    parser.add_argument("--batch-api", action="store_true", help="submit one Gemini Batch API job instead")
+    parser.add_argument("--poll", type=float, default=60, help="seconds between batch job status checks")
+    parser.add_argument("--api-key")
+    parser.add_argument("--fake", action="store_true", help="use the offline fake backend (fake_gemini)")
+    args = parser.parse_args(argv)
+    if args.role and args.role not in libs.set_sys_context:
+        parser.error(f"unknown role {args.role!r}; choose from: {', '.join(libs.set_sys_context)}")
+    return args
+
+
+def main(argv: list) -> int:
+    args = parse_args(argv)
+    if args.fake:
+        import fake_gemini
+        client = fake_gemini.get_client()
+    else:
+        import client_utils
+        client = client_utils.get_client(api_key=get_api_key(args), max_connections=max(10, args.concurrency * 2),
+                                         max_keepalive=args.concurrency)
+
+    start = time.monotonic()
+    if args.batch_api:
+        stats = run_batch_api(client, args)
+    else:
+        stats = asyncio.run(run_online(client, args))
+    print(f"Finished in {time.monotonic() - start:.1f}s: {stats}", file=sys.stderr)
+    return 1 if stats["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,55 @@
+"""
+Document extraction (cold and cached) and retrieval indexing of uploads.
+"""
+import pytest
+
+import libs
+import retrieval_utils
+from conftest import Upload, make_docx, make_pdf, sample_text
+
+
+@pytest.fixture(scope="module")
+def uploads():
+    return {
+        "pdf": Upload("sample.pdf", make_pdf(pages=64)),
+        "docx": Upload("sample.docx", make_docx(paragraphs=200)),
+        "txt": Upload("sample.txt", sample_text(200_000).encode("utf-8")),
+    }
+
+
+@pytest.mark.parametrize("kind", ["pdf", "docx", "txt"])
+def bench_extract_cold(benchmark, uploads, kind):
+    content, error = benchmark(libs._Extract_Contexts, uploads[kind])
+    assert error == 0 and content
+
+
+def bench_extract_text_windows_latin1(benchmark):
+    # CRLF line ends are normalised and a non-UTF-8 byte is replaced, never an error
+    data = ("\r\n".join(sample_text(200, seed=i) for i in range(1000)) + "\r\ncaf\xe9").encode("latin-1", errors="replace")
+    content, error = benchmark(libs._Extract_Contexts, Upload("windows.txt", data))
+    assert error == 0 and "\r" not in content and content.endswith("caf\ufffd")
+
+
+def bench_extract_text_bad_bytes_replaced():
+    # the old text-mode read decoded strictly and failed the upload; now only the bad bytes are lost
+    content, error = libs._Extract_Contexts(Upload("mixed.txt", "größe ".encode("utf-8") + b"\xff\xfe" + "ok".encode("utf-8")))
+    assert error == 0 and content == "größe \ufffd\ufffdok"
+
+
+@pytest.mark.parametrize("kind", ["pdf", "docx", "txt"])
+def bench_extract_cached(benchmark, uploads, kind):
+    libs.GetContexts(uploads[kind])
+    content, error = benchmark(libs.GetContexts, uploads[kind])
+    assert error == 0 and content
+
+
+def bench_retrieval_index(benchmark):
+    text = sample_text(500_000)
+    index = benchmark(retrieval_utils.BM25Index, text)
+    assert index.nbytes() > 0
+
+
+def bench_retrieval_search(benchmark):
+    index = retrieval_utils.BM25Index(sample_text(500_000))
+    hits = benchmark(index.search, "cache latency 模型 文档", 6)
+    assert hits
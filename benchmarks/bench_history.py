@@ -0,0 +1,62 @@
+"""
+History trimming: building the contents sent to the model from a long chat.
+"""
+import pytest
+from google.genai import types
+
+import history_utils
+from conftest import sample_text
+
+
+def long_history(turns: int, document_chars: int = 0) -> history_utils.ChatHistory:
+    history = history_utils.ChatHistory(max_turns=None)
+    history.set_document(sample_text(document_chars, seed=99) if document_chars else "")
+    for i in range(turns):
+        history.add_turn("user", [sample_text(400, seed=i)])
+        history.add_turn("model", [sample_text(2000, seed=i + 10000)])
+    return history
+
+
+@pytest.mark.parametrize("turns", [20, 200])
+def bench_build_contents(benchmark, turns):
+    history = long_history(turns)
+    budget = history_utils.token_budget("gemini-2.5-flash")
+    contents = benchmark(history.build_contents, budget, "You are a helpful assistant.")
+    assert contents
+
+
+def bench_build_contents_tight_budget(benchmark):
+    # most turns fall outside the window and are summarized
+    history = long_history(200, document_chars=50_000)
+    history.summarize = True
+    contents = benchmark(history.build_contents, 8_000, "You are a helpful assistant.")
+    assert contents
+
+
+def bench_add_turn(benchmark):
+    history = history_utils.ChatHistory(max_turns=40)
+    text = sample_text(2000)
+    benchmark(history.add_turn, "model", [text])
+
+
+def bench_estimate_tokens(benchmark):
+    text = sample_text(100_000)
+    assert benchmark(history_utils.estimate_text_tokens, text) > 0
+
+
+def bench_scale_with_context_cache():
+    # turns answered by the cached model: preparing inline contents for a fallback
+    # must not change the estimate the usage is calibrated against
+    history = long_history(0, document_chars=50_000)
+    sys_prompt = "You are a helpful assistant."
+    for i in range(10):
+        history.add_turn("user", [sample_text(400, seed=i)])
+        contents = history.build_contents(100_000, sys_prompt, include_document=False)
+        history.inline_contents(sys_prompt)
+        prompt = sum(history_utils.estimate_part_tokens(p) for c in contents for p in c.parts)
+        cached = history.document_tokens + history_utils.estimate_text_tokens(sys_prompt)
+        usage = types.GenerateContentResponseUsageMetadata(prompt_token_count=prompt + cached,
+                                                           cached_content_token_count=cached)
+        history.add_turn("model", [sample_text(2000, seed=i + 10000)])
+        history.record_usage(usage)
+        assert 0.9 < history.scale < 1.1, history.scale
@@ -0,0 +1,35 @@
+"""
+Building the mail digest of queued chat messages, with model images attached.
+"""
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+import email_utils
+from conftest import sample_text
+
+
+def jpeg(size: int = 512) -> bytes:
+    with BytesIO() as buffer:
+        Image.new("RGB", (size, size), "red").save(buffer, format="JPEG")
+        return buffer.getvalue()
+
+
+@pytest.mark.parametrize("kind", ["bytes", "pil"])
+def bench_digest_with_images(benchmark, kind):
+    data = jpeg()
+    image = data if kind == "bytes" else Image.open(BytesIO(data))
+    items = [{"user": "bench", "message": sample_text(500, seed=i), "image": image} for i in range(10)]
+    msg = benchmark(email_utils.build_digest_message, "from@example.com", "to@example.com", items)
+    attached = [part for part in msg.get_payload() if part.get_content_maintype() == "image"]
+    assert len(attached) == len(items)
+    if kind == "bytes":
+        assert attached[0].get_payload(decode=True) == data
+
+
+def bench_encode_image_bytes_as_is(benchmark):
+    data = jpeg()
+    assert benchmark(email_utils.encode_image, data) == data
+    assert email_utils.encode_image(bytearray(data)) == data
+    assert email_utils.encode_image("not an image") is None
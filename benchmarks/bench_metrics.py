@@ -0,0 +1,21 @@
+"""
+Rendering the Prometheus exposition text of a busy registry.
+"""
+import re
+
+import metrics_utils
+
+SAMPLE = re.compile(r'^[a-zA-Z_:][a-zA-Z0-9_:]*(\{([a-zA-Z_][a-zA-Z0-9_]*="([^"\\]|\\.)*",?)*\})? \S+$')
+
+
+def bench_prometheus_text(benchmark):
+    registry = metrics_utils.Registry()
+    for model in ("gemini-2.5-flash", "gemini-3-pro-preview", "imagen-4.0-generate-001"):
+        for stage in ("queue", "model_completion", "send"):
+            registry.observe(stage, 0.1)
+        registry.inc("model_requests", model=model)
+    registry.register_gauges("circuit_open", lambda: {"gemini-3-pro-preview": 1}, label="model")
+    registry.register_gauges("client", lambda: {"connections.open": 3, "pool-size": 10})
+    text = benchmark(registry.prometheus_text)
+    for line in text.splitlines():
+        assert line.startswith("#") or SAMPLE.match(line), line
@@ -0,0 +1,30 @@
+"""
+Rerun cost of the chat page with a long conversation on screen.
+"""
+import pytest
+
+from conftest import sample_text
+
+
+def conversation(pairs: int) -> list:
+    messages = []
+    for i in range(pairs):
+        messages.append({"role": "user", "parts": [sample_text(200, seed=i)]})
+        messages.append({"role": "model", "parts": [{"text": sample_text(2000, seed=i + 1000)}]})
+    return messages
+
+
+@pytest.mark.parametrize("shown", [20, 100])
+def bench_rerun_with_messages(benchmark, app_factory, shown):
+    at = app_factory(state={"messages": conversation(50), "messages_shown": shown})
+    benchmark(at.run)
+    assert not at.exception
+
+
+def bench_memory_budget_with_messages_view(app_factory):
+    # the rendered page kept for reruns is not charged to the session: a chat that
+    # fits the budget keeps all its messages
+    at = app_factory({"session_memory_mb": "0.15"}, state={"messages": conversation(50), "messages_shown": 100})
+    at.run()
+    assert not at.exception
+    assert len(at.session_state["messages"]) == 100
@@ -0,0 +1,42 @@
+"""
+The full send path (prompt to rendered answer) against the fake backend.
+"""
+import pytest
+
+from conftest import send
+
+
+@pytest.mark.parametrize("stream", ["yes", "no"])
+def bench_send(benchmark, app_factory, stream):
+    def setup():
+        return (app_factory({"stream_responses": stream}),), {}
+
+    at = benchmark.pedantic(lambda at: send(at, "Explain what a context cache is."), setup=setup, rounds=20)
+    assert len(at.session_state["messages"]) == 2
+
+
+def bench_send_long_chat(benchmark, app_factory):
+    at = app_factory()
+    for i in range(10):
+        send(at, f"Question number {i}?")
+    benchmark.pedantic(send, args=(at, "One more question?"), rounds=10)
+    assert not at.exception
+
+
+def bench_send_image_model(benchmark, app_factory):
+    def setup():
+        at = app_factory()
+        at.selectbox[0].select("Gemini 2.5 image").run()
+        return (at,), {}
+
+    benchmark.pedantic(lambda at: send(at, "Draw a red circle."), setup=setup, rounds=10)
+
+
+def bench_send_hedged(benchmark, app_factory):
+    # hedged requests run in worker threads, which have no Streamlit script context
+    def setup():
+        return (app_factory({"stream_responses": "no", "model_hedge_after": "0.01", "fake_latency": "0.05"}),), {}
+
+    at = benchmark.pedantic(lambda at: send(at, "Explain what a hedged request is."), setup=setup, rounds=5)
+    answer = at.session_state["messages"][-1]["parts"][0]["text"]
+    assert not answer.startswith("AI model returned error"), answer
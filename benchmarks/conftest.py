@@ -0,0 +1,137 @@
+"""
+Shared fixtures for the offline benchmarks: app secrets pointing at the fake
+Gemini backend, an AppTest factory, and generated sample documents.
+"""
+import os
+import random
+from io import BytesIO
+
+import pytest
+
+APP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py")
+RESPONSES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "responses.jsonl")
+
+WORDS = ("gemini model token latency cache history document stream image answer question "
+         "模型 缓存 历史 文档 问题 回答 图片 延迟").split()
+
+
+def sample_text(chars: int, seed: int = 0) -> str:
+    rng = random.Random(seed)
+    out, size = [], 0
+    while size < chars:
+        sentence = " ".join(rng.choice(WORDS) for _ in range(12)) + ". "
+        out.append(sentence)
+        size += len(sentence)
+        if rng.random() < 0.1:
+            out.append("\n")
+    return "".join(out)[:chars]
+
+
+def make_pdf(pages: int, lines_per_page: int = 40, seed: int = 0) -> bytes:
+    """
+    A minimal, valid text PDF (Helvetica, one content stream per page).
+    """
+    rng = random.Random(seed)
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for _ in range(pages):
+        lines = [" ".join(rng.choice(WORDS[:11]) for _ in range(10)) for _ in range(lines_per_page)]
+        text = "BT /F1 10 Tf 12 TL 40 800 Td " + " ".join(f"({line}) '" for line in lines) + " ET"
+        stream = text.encode("latin-1")
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        content_id = len(objects)
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+                       b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % content_id)
+        kids.append(len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(b"%d 0 R" % k for k in kids), len(kids))
+
+    out = BytesIO()
+    out.write(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(out.tell())
+        out.write(b"%d 0 obj\n%s\nendobj\n" % (number, body))
+    xref = out.tell()
+    out.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+    for offset in offsets:
+        out.write(b"%010d 00000 n \n" % offset)
+    out.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref))
+    return out.getvalue()
+
+
+def make_docx(paragraphs: int, seed: int = 0) -> bytes:
+    from docx import Document
+    document = Document()
+    for i in range(paragraphs):
+        document.add_paragraph(sample_text(300, seed + i))
+    table = document.add_table(rows=20, cols=4)
+    for row in table.rows:
+        for cell in row.cells:
+            cell.text = sample_text(20, seed)
+    with BytesIO() as buffer:
+        document.save(buffer)
+        return buffer.getvalue()
+
+
+class Upload:
+    """
+    The parts of Streamlit's UploadedFile that libs.GetContexts uses.
+    """
+
+    def __init__(self, name: str, data: bytes):
+        self.name = name
+        self.data = data
+
+    def getvalue(self) -> bytes:
+        return self.data
+
+    def getbuffer(self) -> memoryview:
+        return memoryview(self.data)
+
+
+@pytest.fixture(scope="session")
+def secrets(tmp_path_factory):
+    folder = tmp_path_factory.mktemp("askgemini")
+    return {
+        "valid_users": "bench",
+        "txt2img_enabled": "yes",
+        "total_trials": "1000000",
+        "max_cached_messages": "40",
+        "gemini_backend": "fake",
+        "fake_responses": RESPONSES,
+        "fake_latency": "0",
+        "fake_chunk_latency": "0",
+        "usage_db": str(folder / "usage.db"),
+        "log_file": str(folder / "log.jsonl"),
+    }
+
+
+@pytest.fixture
+def app_factory(secrets):
+    """
+    Build an AppTest of app.py logged in as 'bench', with optional secret overrides
+    and preset session state, after its first run.
+    """
+    from streamlit.testing.v1 import AppTest
+
+    def factory(overrides=None, state=None):
+        at = AppTest.from_file(APP, default_timeout=120)
+        at.secrets.update(secrets)
+        at.secrets.update(overrides or {})
+        at.session_state["user"] = "bench"
+        for key, value in (state or {}).items():
+            at.session_state[key] = value
+        at.run()
+        assert not at.exception, at.exception
+        return at
+    return factory
+
+
+def send(at, prompt: str):
+    """
+    Type a prompt and press the send button, as a user would.
+    """
+    at.text_area[0].input(prompt)
+    next(button for button in at.button if "提交" in button.label).click().run()
+    assert not at.exception, at.exception
+    return at
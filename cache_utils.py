@@ -0,0 +1,181 @@
+"""
+Small, thread-safe caches shared by the AskGemini modules.
+"""
+from typing import Any, Callable, Dict, Optional, Tuple
+import gzip
+import os
+import threading
+import time
+from collections import OrderedDict
+
+def sizeof(value: Any) -> int:
+    """
+    Rough payload size in bytes of a cached value.
+    """
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, str):
+        return len(value.encode("utf-8", errors="ignore"))
+    if isinstance(value, (list, tuple)):
+        return sum(sizeof(v) for v in value)
+    if isinstance(value, dict):
+        return sum(sizeof(v) for v in value.values())
+    return 64
+
+
+class LRUCache:
+    """
+    In-memory LRU cache bounded by total payload bytes and, optionally, by entry age.
+    """
+
+    def __init__(self, max_bytes: int, ttl: Optional[float] = None, size_fn: Callable[[Any], int] = sizeof):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size_fn = size_fn
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()      # key -> (value, size, stored_at)
+        self._lock = threading.Lock()
+
+    def get(self, key: str, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, size, stored_at = entry
+            if self.ttl is not None and time.monotonic() - stored_at > self.ttl:
+                del self._data[key]
+                self.bytes -= size
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: str, value: Any) -> None:
+        size = self.size_fn(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._data[key] = (value, size, time.monotonic())
+            self.bytes += size
+            while self.bytes > self.max_bytes and self._data:
+                _, (_, evicted, _) = self._data.popitem(last=False)
+                self.bytes -= evicted
+
+    def pop(self, key: str) -> Any:
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                return None
+            self.bytes -= entry[1]
+            return entry[0]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {"entries": len(self._data), "bytes": self.bytes, "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0}
+
+
+class DiskCache:
+    """
+    Gzipped text files in a folder, one per key. Survives restarts.
+    """
+
+    def __init__(self, folder: str):
+        self.folder = folder
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(folder, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.folder, key + ".gz")
+
+    def get(self, key: str) -> Optional[str]:
+        try:
+            with gzip.open(self._path(key), "rt", encoding="utf-8") as f:
+                value = f.read()
+            self.hits += 1
+            return value
+        except FileNotFoundError:
+            self.misses += 1
+        except Exception as ex:
+            print(f"Reading disk cache {key} failed: {ex!r}")
+            self.misses += 1
+        return None
+
+    def put(self, key: str, value: str) -> None:
+        path = self._path(key)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with gzip.open(tmp, "wt", encoding="utf-8") as f:
+                f.write(value)
+            os.replace(tmp, path)
+        except Exception as ex:
+            print(f"Writing disk cache {key} failed: {ex!r}")
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0}
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls with the same key: the first caller runs the function,
+    the others wait for and share its result (or its exception).
+    """
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self.shared = 0
+        self._calls: Dict[str, "SingleFlight._Call"] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """
+        Return (result, shared). shared is True when the result came from another caller's call.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = SingleFlight._Call()
+            else:
+                self.shared += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is None:
+                return call.result, True
+            if isinstance(call.error, Exception):
+                raise call.error
+            return fn(), False      # leader was interrupted (e.g. a Streamlit rerun): run our own call
+
+        try:
+            call.result = fn()
+        except BaseException as ex:
+            call.error = ex
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
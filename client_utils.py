@@ -0,0 +1,88 @@
+"""
+Shared Gemini API client for AskGemini app.
+
+One genai.Client (and its async twin client.aio) is built per process and shared by
+every Streamlit session, so the HTTP connection pool survives reruns and new sessions
+do not pay a fresh TLS handshake.
+"""
+from typing import Optional, Dict
+import threading
+import weakref
+import httpx
+from google import genai
+from google.genai import types
+
+_client: Optional[genai.Client] = None
+_client_lock = threading.Lock()
+
+_stats_lock = threading.Lock()
+_stats = {"requests": 0, "new_connections": 0, "reused_connections": 0}
+_seen_streams = weakref.WeakSet()
+
+def _track_connection(response: httpx.Response) -> None:
+    """
+    Count whether a response came over a new or a pooled connection.
+    """
+    stream = response.extensions.get("network_stream")
+    with _stats_lock:
+        _stats["requests"] += 1
+        try:
+            if stream is not None and stream in _seen_streams:
+                _stats["reused_connections"] += 1
+            else:
+                _stats["new_connections"] += 1
+                if stream is not None:
+                    _seen_streams.add(stream)
+        except TypeError:
+            _stats["new_connections"] += 1
+
+async def _track_connection_async(response: httpx.Response) -> None:
+    _track_connection(response)
+
+def build_http_options(timeout: float = 120.0, max_connections: int = 100, max_keepalive: int = 20, keepalive_expiry: float = 60.0) -> types.HttpOptions:
+    """
+    Build HttpOptions with a bounded, keep-alive connection pool for both sync and async clients.
+    Timeout is in seconds (HttpOptions itself expects milliseconds).
+    """
+    limits = httpx.Limits(max_connections=max_connections,
+                          max_keepalive_connections=max_keepalive,
+                          keepalive_expiry=keepalive_expiry)
+    return types.HttpOptions(
+        timeout=int(timeout * 1000),
+        client_args={"limits": limits, "event_hooks": {"response": [_track_connection]}},
+        async_client_args={"limits": limits, "event_hooks": {"response": [_track_connection_async]}},
+    )
+
+def get_client(api_key: str, **http_args) -> genai.Client:
+    """
+    Return the process-wide genai.Client, creating it on first use.
+    genai.Client is thread-safe, so the same instance is handed to every session.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = genai.Client(api_key=api_key, http_options=build_http_options(**http_args))
+    return _client
+
+def reset_client() -> None:
+    """
+    Drop the shared client (e.g. after an API key change). The next get_client() builds a new one.
+    """
+    global _client
+    with _client_lock:
+        old, _client = _client, None
+    if old is not None:
+        try:
+            old.close()
+        except Exception as ex:
+            print(f"Closing genai client failed: {ex!r}")
+
+def connection_stats() -> Dict[str, float]:
+    """
+    Return request and connection counters, including the connection reuse ratio.
+    """
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["reuse_ratio"] = stats["reused_connections"] / stats["requests"] if stats["requests"] else 0.0
+    return stats
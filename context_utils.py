@@ -0,0 +1,108 @@
+"""
+Explicit Gemini context caching for AskGemini app.
+
+A large uploaded document and/or a long role prompt is stored once per conversation
+as a CachedContent. Later requests reference it by name instead of resending it,
+which cuts prompt processing time and input token cost.
+"""
+from typing import Optional
+import hashlib
+import time
+from google import genai
+from google.genai import types
+import history_utils
+
+MIN_CACHE_TOKENS = 4096     # below this, caching is not worth it (and the API rejects small caches)
+
+class ContextCache:
+    """
+    One CachedContent per session, keyed by (model, system prompt, document).
+
+    get() returns the cache name to pass as GenerateContentConfig.cached_content, creating
+    the cache when the key changes and extending its TTL when it is about to expire.
+    """
+
+    def __init__(self, ttl: int = 600, min_tokens: int = MIN_CACHE_TOKENS):
+        self.ttl = ttl
+        self.min_tokens = min_tokens
+        self.name = None
+        self.key = None
+        self.expires_at = 0.0
+        self.cached_tokens = 0
+
+    @staticmethod
+    def make_key(model: str, sys_prompt: str, document: str) -> str:
+        digest = hashlib.sha256()
+        for value in (model, sys_prompt or "", document or ""):
+            digest.update(value.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def eligible(self, sys_prompt: str, document: str) -> bool:
+        tokens = history_utils.estimate_text_tokens(sys_prompt or "") + history_utils.estimate_text_tokens(document or "")
+        return tokens >= self.min_tokens
+
+    def get(self, client: genai.Client, model: str, sys_prompt: str, document: str) -> Optional[str]:
+        """
+        Return the name of a live cache holding sys_prompt and document, or None when
+        they are too small to cache or the cache could not be created.
+        """
+        if not self.eligible(sys_prompt, document):
+            self.cleanup(client)
+            return None
+
+        key = self.make_key(model, sys_prompt, document)
+        now = time.time()
+        if self.name is not None and self.key == key and now < self.expires_at:
+            if self.expires_at - now < self.ttl / 3:
+                self._refresh(client)
+            return self.name
+
+        self.cleanup(client)
+        try:
+            contents = []
+            if document:
+                contents.append(types.Content(role="user", parts=[types.Part.from_text(text=document)]))
+            cache = client.caches.create(
+                model=model,
+                config=types.CreateCachedContentConfig(
+                    contents=contents or None,
+                    system_instruction=sys_prompt or None,
+                    ttl=f"{self.ttl}s",
+                    display_name="askgemini-" + key[:12],
+                ),
+            )
+        except Exception as ex:
+            print(f"Creating context cache failed: {ex!r}")
+            return None
+
+        self.name = cache.name
+        self.key = key
+        self.expires_at = now + self.ttl
+        if cache.usage_metadata is not None and cache.usage_metadata.total_token_count:
+            self.cached_tokens = cache.usage_metadata.total_token_count
+        print(f"Context cache created: {self.name} ({self.cached_tokens} tokens)")
+        return self.name
+
+    def _refresh(self, client: genai.Client) -> None:
+        try:
+            client.caches.update(name=self.name, config=types.UpdateCachedContentConfig(ttl=f"{self.ttl}s"))
+            self.expires_at = time.time() + self.ttl
+        except Exception as ex:
+            print(f"Refreshing context cache failed: {ex!r}")
+            self.name = None
+
+    def cleanup(self, client: genai.Client) -> None:
+        """
+        Delete the cache, if any. Safe to call repeatedly.
+        """
+        if self.name is None:
+            return
+        try:
+            client.caches.delete(name=self.name)
+        except Exception as ex:
+            print(f"Deleting context cache failed: {ex!r}")
+        self.name = None
+        self.key = None
+        self.expires_at = 0.0
+        self.cached_tokens = 0
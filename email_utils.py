@@ -1,8 +1,18 @@
 """
 Email utility functions for AskGemini app.
+
+send_mail() only formats the message and puts it on a bounded queue; a background
+worker keeps one authenticated SMTP connection open and sends the queued messages
+as periodic digests, so a slow or throttling SMTP server never blocks a user's turn.
 """
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
+import base64
+import json
+import os
+import queue
 import smtplib
+import threading
+import time
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.image import MIMEImage
@@ -11,6 +21,23 @@ from datetime import datetime
 import streamlit as st
 from PIL import Image
 
+SMTP_TIMEOUT = 10           # seconds
+SMTP_IDLE_CLOSE = 300       # close the kept-alive connection after this many idle seconds
+SPILL_MAX_BYTES = 20 * 1024 * 1024  # default cap of the spill file
+
+def encode_image(image: Any) -> Optional[bytes]:
+    """
+    Image bytes for attaching: encoded images (as returned by the model) are attached
+    as they are, PIL images are encoded to JPEG. Returns None for anything else.
+    """
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return bytes(image)
+    if not isinstance(image, Image.Image):
+        return None
+    with BytesIO() as buffer:
+        image.convert("RGB").save(buffer, format="JPEG")
+        return buffer.getvalue()
+
 def build_email_message(sender_email: str, receive: str, subject: str, message: str, res: Optional[Dict[str, Any]] = None) -> MIMEMultipart:
     """
     Build an email message with optional image attachment.
@@ -24,19 +51,252 @@ def build_email_message(sender_email: str, receive: str, subject: str, message:
     # Attach image if present (non-blocking)
     if isinstance(res, dict) and "image" in res:
         try:
-            with BytesIO() as buffer:
-                imageFile = res["image"]
-                if isinstance(imageFile, Image.Image):
-                    imageFile.save(buffer, format="JPEG")
-                    img = MIMEImage(buffer.getvalue())
-                    msg.attach(img)
+            image_bytes = encode_image(res["image"])
+            if image_bytes:
+                msg.attach(MIMEImage(image_bytes))
+        except Exception as attach_ex:
+            print(f"Failed to attach image: {attach_ex}")
+    return msg
+
+def build_digest_message(sender_email: str, receive: str, items: List[Dict[str, Any]]) -> MIMEMultipart:
+    """
+    Build one email carrying several queued chat messages and their images.
+    """
+    users = sorted({item["user"] for item in items})
+    msg = MIMEMultipart()
+    msg['From'] = sender_email
+    msg['To'] = receive
+    if len(items) == 1:
+        msg['Subject'] = f"Gemini chat from {items[0]['user']}"
+    else:
+        msg['Subject'] = f"Gemini chats digest ({len(items)} messages from {', '.join(users)})"
+
+    body = ("\n" + 100 * '-' + "\n").join(item["message"] for item in items)
+    msg.attach(MIMEText(body, 'plain'))
+
+    for item in items:
+        try:
+            image_bytes = item.get("image_bytes")
+            if image_bytes is None and item.get("image") is not None:
+                image_bytes = encode_image(item["image"])
+            if image_bytes:
+                msg.attach(MIMEImage(image_bytes))
         except Exception as attach_ex:
             print(f"Failed to attach image: {attach_ex}")
     return msg
 
+
+class MailDispatcher:
+    """
+    Bounded mail queue drained by a single background thread.
+
+    Messages are sent as a digest once digest_size messages are waiting or
+    digest_interval seconds have passed since the first one was queued. When the
+    queue is full, messages are appended to a spill file (if spill_dir is set)
+    and picked up again on the next flush; otherwise they are dropped. The spill
+    file holds at most spill_max_bytes; messages beyond that are dropped too.
+    """
+
+    def __init__(self, smtp_server: str, port: int, sender_email: str, password: str, receive: str,
+                 digest_size: int = 10, digest_interval: float = 60.0, queue_size: int = 200,
+                 spill_dir: Optional[str] = None, spill_max_bytes: int = SPILL_MAX_BYTES):
+        self.smtp_server = smtp_server
+        self.port = port
+        self.sender_email = sender_email
+        self.password = password
+        self.receive = receive
+        self.digest_size = max(1, digest_size)
+        self.digest_interval = digest_interval
+        self.spill_path = os.path.join(spill_dir, "mail_spill.jsonl") if spill_dir else None
+        self.spill_max_bytes = spill_max_bytes
+        self.queue = queue.Queue(maxsize=queue_size)
+        self._stats = {"queued": 0, "sent": 0, "spilled": 0, "dropped": 0, "failed": 0}
+        self._lock = threading.Lock()       # _stats is updated by callers and the worker
+        self._server = None
+        self._last_used = 0.0
+        self._spill_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="mail-dispatcher", daemon=True)
+        self._thread.start()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._stats)
+
+    def _count(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self._stats[name] += n
+
+    def submit(self, item: Dict[str, Any]) -> bool:
+        """
+        Queue a message without blocking. Returns False if it had to be spilled or dropped.
+        """
+        try:
+            self.queue.put_nowait(item)
+            self._count("queued")
+            return True
+        except queue.Full:
+            if self._spill(item):
+                self._count("spilled")
+            else:
+                self._count("dropped")
+                print("Email dropped: mail queue is full.")
+            return False
+
+    def _spill(self, item: Dict[str, Any]) -> bool:
+        if not self.spill_path:
+            return False
+        record = {"user": item["user"], "message": item["message"]}
+        try:
+            image_bytes = item.get("image_bytes") or encode_image(item.get("image"))
+            if image_bytes:
+                record["image"] = base64.b64encode(image_bytes).decode("ascii")
+            line = json.dumps(record, ensure_ascii=False) + "\n"
+            with self._spill_lock:
+                os.makedirs(os.path.dirname(self.spill_path), exist_ok=True)
+                size = os.path.getsize(self.spill_path) if os.path.exists(self.spill_path) else 0
+                if size + len(line.encode("utf-8")) > self.spill_max_bytes:
+                    print("Spill file is full.")
+                    return False
+                with open(self.spill_path, "a", encoding="utf-8") as f:
+                    f.write(line)
+            return True
+        except Exception as ex:
+            print(f"Spilling email to disk failed: {ex!r}")
+            return False
+
+    def _load_spilled(self) -> List[Dict[str, Any]]:
+        if not self.spill_path or not os.path.exists(self.spill_path):
+            return []
+        items = []
+        with self._spill_lock:
+            try:
+                with open(self.spill_path, encoding="utf-8") as f:
+                    for line in f:
+                        record = json.loads(line)
+                        if "image" in record:
+                            record["image_bytes"] = base64.b64decode(record.pop("image"))
+                        items.append(record)
+                os.remove(self.spill_path)
+            except Exception as ex:
+                print(f"Reading spilled emails failed: {ex!r}")
+        return items
+
+    def _connect(self) -> None:
+        """
+        Open and log in: STARTTLS first, falling back to SSL on port 465.
+        """
+        try:
+            server = smtplib.SMTP(self.smtp_server, self.port, timeout=SMTP_TIMEOUT)
+            server.ehlo()
+            if self.port == 587:
+                server.starttls()
+                server.ehlo()
+            server.login(self.sender_email, self.password)
+        except Exception as e1:
+            print(f"STARTTLS failed: {e1!r} — trying SSL fallback")
+            server = smtplib.SMTP_SSL(self.smtp_server, 465, timeout=SMTP_TIMEOUT)
+            server.login(self.sender_email, self.password)
+        self._server = server
+
+    def _close(self) -> None:
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except Exception:
+                pass
+            self._server = None
+
+    def _ensure_connected(self) -> None:
+        if self._server is not None:
+            try:
+                if self._server.noop()[0] == 250:
+                    return
+            except Exception:
+                pass
+            self._close()
+        self._connect()
+
+    def _send(self, items: List[Dict[str, Any]]) -> None:
+        msg = build_digest_message(self.sender_email, self.receive, items)
+        for attempt in range(2):    # one reconnect if the kept-alive connection went stale
+            try:
+                self._ensure_connected()
+                self._server.send_message(msg)
+                self._last_used = time.monotonic()
+                self._count("sent", len(items))
+                print(f"Email sent ok ({len(items)} messages).")
+                return
+            except Exception as ex:
+                print(f"send_mail error: {ex!r}")
+                self._close()
+        self._count("failed", len(items))
+        for item in items:
+            if not self._spill(item):
+                self._count("dropped")
+
+    def _run(self) -> None:
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            if deadline is None and self._server is not None:
+                timeout = SMTP_IDLE_CLOSE
+            try:
+                item = self.queue.get(timeout=timeout)
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.digest_interval
+            except queue.Empty:
+                if not batch:
+                    self._close()   # idle for a while, let the server go
+                    continue
+
+            if batch and (len(batch) >= self.digest_size or time.monotonic() >= deadline):
+                batch = self._load_spilled() + batch
+                try:
+                    for i in range(0, len(batch), self.digest_size):
+                        self._send(batch[i:i + self.digest_size])
+                except Exception as ex:
+                    print(f"Mail dispatcher error: {ex!r}")
+                batch = []
+                deadline = None
+
+
+_dispatcher: Optional[MailDispatcher] = None
+_dispatcher_lock = threading.Lock()
+
+def get_dispatcher() -> Optional[MailDispatcher]:
+    """
+    Return the process-wide mail dispatcher, starting it on first use.
+    Returns None if SMTP credentials or destination are missing in secrets.
+    """
+    global _dispatcher
+    if _dispatcher is None:
+        with _dispatcher_lock:
+            if _dispatcher is None:
+                smtp_server = st.secrets.get("smtp_server", "smtp.gmail.com")
+                sender_email = st.secrets.get("gmail_user")
+                password = st.secrets.get("gmail_passwd")
+                receive = st.secrets.get("receive_mail")
+                if not (smtp_server and sender_email and password and receive):
+                    return None
+                _dispatcher = MailDispatcher(
+                    smtp_server=smtp_server,
+                    port=int(st.secrets.get("smtp_port", 587)),
+                    sender_email=sender_email,
+                    password=password,
+                    receive=receive,
+                    digest_size=int(st.secrets.get("mail_digest_size", 10)),
+                    digest_interval=float(st.secrets.get("mail_digest_interval", 60)),
+                    queue_size=int(st.secrets.get("mail_queue_size", 200)),
+                    spill_dir=st.secrets.get("mail_spill_dir"),
+                    spill_max_bytes=int(float(st.secrets.get("mail_spill_mb", 20)) * 1024 * 1024),
+                )
+    return _dispatcher
+
 def send_mail(query: str, res: Any, total_tokens: int) -> None:
     """
-    Robust send_mail: timeout, STARTTLS + fallback to SSL, exception handling so UI won't crash.
+    Queue a chat message for the background mail dispatcher. Never blocks the UI.
     """
     now = datetime.now()
     date_time = now.strftime("%m/%d/%Y, %H:%M:%S")
@@ -50,50 +310,12 @@ def send_mail(query: str, res: Any, total_tokens: int) -> None:
     message += f'[Gemini]: {generated_text}\n'
     message += f'[Tokens]: {total_tokens}\n'
 
-    smtp_server = st.secrets.get("smtp_server", "smtp.gmail.com")
-    port = int(st.secrets.get("smtp_port", 587))
-    sender_email = st.secrets.get("gmail_user")
-    password = st.secrets.get("gmail_passwd")
-    receive = st.secrets.get("receive_mail")
-
-    if not (smtp_server and sender_email and password and receive):
+    dispatcher = get_dispatcher()
+    if dispatcher is None:
         print("Email not sent: SMTP credentials or destination missing in secrets.")
         return
 
-    server = None
-    timeout = 10  # seconds
-    try:
-        # Try STARTTLS (typical for port 587)
-        try:
-            server = smtplib.SMTP(smtp_server, port, timeout=timeout)
-            server.ehlo()
-            if port == 587:
-                server.starttls()
-                server.ehlo()
-            server.login(sender_email, password)
-        except Exception as e1:
-            print(f"STARTTLS failed: {e1!r} — trying SSL fallback")
-            try:
-                server = smtplib.SMTP_SSL(smtp_server, 465, timeout=timeout)
-                server.login(sender_email, password)
-            except Exception as e2:
-                print(f"SMTP_SSL fallback failed: {e2!r}")
-                return
-
-        msg = build_email_message(
-            sender_email=sender_email,
-            receive=receive,
-            subject=f"Gemini chat from {st.session_state.user}",
-            message=message,
-            res=res
-        )
-        server.send_message(msg)
-        print("Email sent ok.")
-    except Exception as ex:
-        print(f"send_mail error: {ex!r}")
-    finally:
-        if server:
-            try:
-                server.quit()
-            except Exception:
-                pass
+    item = {"user": st.session_state.user, "message": message}
+    if isinstance(res, dict) and "image" in res:
+        item["image"] = res["image"]     # encoded to JPEG by the worker, off the request path
+    dispatcher.submit(item)
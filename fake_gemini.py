@@ -0,0 +1,254 @@
+"""
+Local stand-in for the Gemini API, for running AskGemini offline.
+
+FakeClient has the parts of genai.Client the app uses (models.generate_content,
+generate_content_stream, generate_images, caches, and the async client.aio) and
+answers with real google.genai types. Answers are replayed from a JSONL file of
+recorded responses, one object per line:
+
+    {"text": "...", "images": 1, "prompt_tokens": 120, "candidates_tokens": 80, "thoughts_tokens": 0}
+
+(every field optional), or echo the prompt when no recording is given. Latency,
+streaming chunk size and pacing, token counts, image parts and error rates are
+configurable, so runs are reproducible.
+"""
+from typing import Any, Dict, Iterator, List, Optional
+import asyncio
+import itertools
+import json
+import random
+import threading
+import time
+from io import BytesIO
+from PIL import Image
+from google.genai import errors, types
+import history_utils
+
+DEFAULT_ANSWER_CHARS = 800
+FILLER = "The quick brown fox jumps over the lazy dog. 敏捷的棕色狐狸跳过了懒狗。 "
+
+def load_responses(path: str) -> List[Dict[str, Any]]:
+    """
+    Read recorded responses from a JSONL file.
+    """
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def _contents_text(contents: Any) -> str:
+    if contents is None:
+        return ""
+    if isinstance(contents, str):
+        return contents
+    if isinstance(contents, types.Part):
+        return contents.text or ""
+    if isinstance(contents, types.Content):
+        return " ".join(part.text or "" for part in contents.parts or [])
+    if isinstance(contents, (list, tuple)):
+        return " ".join(_contents_text(item) for item in contents)
+    return ""
+
+def _image_bytes(index: int, size: tuple, mime_type: str = "image/jpeg") -> bytes:
+    color = ((index * 67) % 256, (index * 131) % 256, (index * 199) % 256)
+    with BytesIO() as buffer:
+        Image.new("RGB", size, color).save(buffer, format="JPEG" if mime_type == "image/jpeg" else "PNG")
+        return buffer.getvalue()
+
+
+class FakeClient:
+    """
+    Drop-in replacement for genai.Client backed by recorded or synthetic responses.
+
+    latency: seconds before the first (or only) chunk; chunk_latency: seconds between
+    streamed chunks; chunk_chars: characters per streamed chunk; images: image parts
+    added to each answer of an image model; error_rate/error_code: fraction of calls
+    failing with an APIError of that status code.
+    """
+
+    def __init__(self, responses: Optional[List[Dict[str, Any]]] = None, latency: float = 0.0,
+                 chunk_latency: float = 0.0, chunk_chars: int = 40, answer_chars: int = DEFAULT_ANSWER_CHARS,
+                 images: int = 1, image_size: tuple = (512, 512), error_rate: float = 0.0,
+                 error_code: int = 503, seed: int = 0):
+        self.responses = responses or []
+        self.latency = latency
+        self.chunk_latency = chunk_latency
+        self.chunk_chars = max(1, chunk_chars)
+        self.answer_chars = answer_chars
+        self.images = images
+        self.image_size = tuple(image_size)
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.calls = 0
+        self._cursor = itertools.count()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.models = _Models(self)
+        self.caches = _Caches()
+        self.aio = _AsyncClient(self)
+
+    def close(self) -> None:
+        pass
+
+    def _next(self, contents: Any, model: str) -> Dict[str, Any]:
+        with self._lock:
+            self.calls += 1
+            failed = self._random.random() < self.error_rate
+            index = next(self._cursor)
+        if failed:
+            raise errors.APIError(self.error_code, {"error": {"code": self.error_code, "message": "fake backend error",
+                                                              "status": "UNAVAILABLE"}})
+        prompt = _contents_text(contents)
+        if self.responses:
+            record = dict(self.responses[index % len(self.responses)])
+        else:
+            echo = f"[{model}] {prompt[-200:]}\n\n"
+            record = {"text": echo + (FILLER * (self.answer_chars // len(FILLER) + 1))[:max(0, self.answer_chars - len(echo))]}
+        record.setdefault("text", "")
+        record.setdefault("images", self.images)
+        if "image" not in (model or ""):
+            record["images"] = 0    # only image models answer with pictures
+        record.setdefault("prompt_tokens", history_utils.estimate_text_tokens(prompt))
+        record.setdefault("candidates_tokens", history_utils.estimate_text_tokens(record["text"]))
+        record.setdefault("thoughts_tokens", 0)
+        record["index"] = index
+        return record
+
+    def _usage(self, record: Dict[str, Any], cached_tokens: int = 0) -> types.GenerateContentResponseUsageMetadata:
+        total = record["prompt_tokens"] + record["candidates_tokens"] + record["thoughts_tokens"]
+        return types.GenerateContentResponseUsageMetadata(
+            prompt_token_count=record["prompt_tokens"],
+            candidates_token_count=record["candidates_tokens"],
+            thoughts_token_count=record["thoughts_tokens"] or None,
+            cached_content_token_count=cached_tokens or None,
+            total_token_count=total,
+        )
+
+    def _response(self, parts: List[types.Part], usage=None, finished: bool = True) -> types.GenerateContentResponse:
+        return types.GenerateContentResponse(
+            candidates=[types.Candidate(content=types.Content(role="model", parts=parts),
+                                        finish_reason=types.FinishReason.STOP if finished else None)],
+            usage_metadata=usage,
+        )
+
+    def _image_parts(self, record: Dict[str, Any]) -> List[types.Part]:
+        return [types.Part.from_bytes(data=_image_bytes(record["index"] + i, self.image_size), mime_type="image/jpeg")
+                for i in range(record["images"])]
+
+    def _cached_tokens(self, config: Any) -> int:
+        name = getattr(config, "cached_content", None)
+        return self.caches.tokens.get(name, 0) if name else 0
+
+    def _chunks(self, record: Dict[str, Any], config: Any) -> Iterator[tuple]:
+        """
+        (delay, response) pairs of a streamed answer; usage comes with the last chunk.
+        """
+        text = record["text"]
+        pieces = [text[i:i + self.chunk_chars] for i in range(0, len(text), self.chunk_chars)] or [""]
+        usage = self._usage(record, self._cached_tokens(config))
+        for i, piece in enumerate(pieces):
+            last = i == len(pieces) - 1
+            parts = [types.Part(text=piece)] + (self._image_parts(record) if last else [])
+            yield (self.latency if i == 0 else self.chunk_latency), self._response(parts, usage if last else None, last)
+
+    def _complete(self, record: Dict[str, Any], config: Any) -> types.GenerateContentResponse:
+        parts = ([types.Part(text=record["text"])] if record["text"] else []) + self._image_parts(record)
+        return self._response(parts, self._usage(record, self._cached_tokens(config)))
+
+    def _images(self, prompt: str, config: Any) -> types.GenerateImagesResponse:
+        record = self._next(prompt, "imagen")
+        count = getattr(config, "number_of_images", None) or 1
+        mime_type = getattr(config, "output_mime_type", None) or "image/jpeg"
+        return types.GenerateImagesResponse(generated_images=[
+            types.GeneratedImage(image=types.Image(image_bytes=_image_bytes(record["index"] + i, self.image_size, mime_type),
+                                                   mime_type=mime_type))
+            for i in range(count)])
+
+
+class _Models:
+    def __init__(self, client: FakeClient):
+        self._client = client
+
+    def generate_content(self, model: str, contents: Any, config: Any = None) -> types.GenerateContentResponse:
+        record = self._client._next(contents, model)
+        time.sleep(self._client.latency + self._client.chunk_latency * (len(record["text"]) // self._client.chunk_chars))
+        return self._client._complete(record, config)
+
+    def generate_content_stream(self, model: str, contents: Any, config: Any = None) -> Iterator[types.GenerateContentResponse]:
+        record = self._client._next(contents, model)
+        for delay, response in self._client._chunks(record, config):
+            time.sleep(delay)
+            yield response
+
+    def generate_images(self, model: str, prompt: str, config: Any = None) -> types.GenerateImagesResponse:
+        time.sleep(self._client.latency)
+        return self._client._images(prompt, config)
+
+    def count_tokens(self, model: str, contents: Any, config: Any = None) -> types.CountTokensResponse:
+        return types.CountTokensResponse(total_tokens=history_utils.estimate_text_tokens(_contents_text(contents)))
+
+
+class _AsyncModels:
+    def __init__(self, client: FakeClient):
+        self._client = client
+
+    async def generate_content(self, model: str, contents: Any, config: Any = None) -> types.GenerateContentResponse:
+        record = self._client._next(contents, model)
+        await asyncio.sleep(self._client.latency + self._client.chunk_latency * (len(record["text"]) // self._client.chunk_chars))
+        return self._client._complete(record, config)
+
+    async def generate_content_stream(self, model: str, contents: Any, config: Any = None):
+        record = self._client._next(contents, model)
+
+        async def stream():
+            for delay, response in self._client._chunks(record, config):
+                await asyncio.sleep(delay)
+                yield response
+        return stream()
+
+    async def generate_images(self, model: str, prompt: str, config: Any = None) -> types.GenerateImagesResponse:
+        await asyncio.sleep(self._client.latency)
+        return self._client._images(prompt, config)
+
+
+class _AsyncClient:
+    def __init__(self, client: FakeClient):
+        self.models = _AsyncModels(client)
+        self.caches = client.caches
+
+
+class _Caches:
+    """
+    Context caches are only named and remembered; their token count is reported back
+    as cached_content_token_count.
+    """
+
+    def __init__(self):
+        self.tokens: Dict[str, int] = {}
+        self._count = itertools.count(1)
+
+    def create(self, model: str, config: Any = None) -> types.CachedContent:
+        name = f"cachedContents/fake-{next(self._count)}"
+        self.tokens[name] = history_utils.estimate_text_tokens(_contents_text(getattr(config, "contents", None))
+                                                               + " " + _contents_text(getattr(config, "system_instruction", None)))
+        return types.CachedContent(name=name, model=model)
+
+    def update(self, name: str, config: Any = None) -> types.CachedContent:
+        return types.CachedContent(name=name)
+
+    def delete(self, name: str, config: Any = None) -> None:
+        self.tokens.pop(name, None)
+
+
+_client: Optional[FakeClient] = None
+_client_lock = threading.Lock()
+
+def get_client(responses_path: Optional[str] = None, **options) -> FakeClient:
+    """
+    Return the process-wide fake client, like client_utils.get_client() does for the real one.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                responses = load_responses(responses_path) if responses_path else None
+                _client = FakeClient(responses=responses, **options)
+    return _client
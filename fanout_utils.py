@@ -0,0 +1,110 @@
+"""
+Multi-model fan-out for AskGemini app.
+
+One prompt is streamed from several models at once through the async client
+(client.aio). The requests run as tasks on one process-wide event loop thread, so
+the async HTTP pool lives as long as the client does; progress is handed to the
+Streamlit script thread through a queue, because only that thread may draw.
+With first_wins, the other streams are cancelled (and their connections closed)
+as soon as one model has completed its answer.
+"""
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import asyncio
+import queue
+import threading
+import time
+from google.genai import types
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_lock = threading.Lock()
+
+def _get_loop() -> asyncio.AbstractEventLoop:
+    global _loop
+    if _loop is None:
+        with _loop_lock:
+            if _loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="fanout-loop", daemon=True).start()
+                _loop = loop
+    return _loop
+
+def _add_part(parts: List[types.Part], part: types.Part) -> None:
+    """
+    Merge streamed text parts, keeping thought signatures (as app.Collect_Response does).
+    """
+    if parts and parts[-1].text is not None and parts[-1].thought_signature is None:
+        parts[-1] = types.Part(text=parts[-1].text + part.text, thought_signature=part.thought_signature)
+    else:
+        parts.append(part)
+
+
+class FanOut:
+    """
+    Stream requests[key] = (model, contents, config) concurrently.
+
+    results[key] is filled as each finishes with text, parts, usage, seconds, error
+    and cancelled; winner is the key of the first successful answer.
+    """
+
+    def __init__(self, client: Any, requests: Dict[str, Tuple[str, list, Any]], first_wins: bool = False):
+        self.requests = requests
+        self.first_wins = first_wins
+        self.results: Dict[str, Dict[str, Any]] = {}
+        self.winner: Optional[str] = None
+        self.updates: "queue.Queue[Tuple[str, str, bool]]" = queue.Queue()
+        self.future = asyncio.run_coroutine_threadsafe(self._run(client), _get_loop())
+
+    async def _one(self, client: Any, key: str) -> Dict[str, Any]:
+        model, contents, config = self.requests[key]
+        start = time.perf_counter()
+        result = {"model": model, "text": "", "parts": [], "usage": None, "error": None, "cancelled": False}
+        try:
+            async for chunk in await client.aio.models.generate_content_stream(model=model, contents=contents, config=config):
+                if chunk.usage_metadata is not None:
+                    result["usage"] = chunk.usage_metadata
+                if not chunk.candidates or chunk.candidates[0].content is None:
+                    continue
+                for part in chunk.candidates[0].content.parts or []:
+                    if part.text is not None and not part.thought:
+                        result["text"] += part.text
+                        _add_part(result["parts"], part)
+                self.updates.put((key, result["text"], False))
+        except asyncio.CancelledError:
+            result["cancelled"] = True
+            raise
+        except Exception as ex:
+            result["error"] = f"{ex}"
+        finally:
+            result["seconds"] = time.perf_counter() - start
+            self.results[key] = result
+            if self.winner is None and result["error"] is None and not result["cancelled"]:
+                self.winner = key
+            self.updates.put((key, result["text"], True))
+        return result
+
+    async def _run(self, client: Any) -> None:
+        pending = {asyncio.create_task(self._one(client, key)) for key in self.requests}
+        try:
+            while pending:
+                _, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                if self.first_wins and self.winner is not None:
+                    break
+        finally:
+            # first answer won, or the whole fan-out was cancelled
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    def cancel(self) -> None:
+        self.future.cancel()
+
+    def stream(self, poll: float = 0.05) -> Iterator[Tuple[str, str, bool]]:
+        """
+        Yield (key, text so far, finished) on the calling thread until every request is done.
+        """
+        while True:
+            try:
+                yield self.updates.get(timeout=poll)
+            except queue.Empty:
+                if self.future.done() and self.updates.empty():
+                    break
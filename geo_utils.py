@@ -0,0 +1,81 @@
+"""
+Client identity for AskGemini app: client IP from the request and offline
+geolocation from a local MaxMind-format database (e.g. GeoLite2-City.mmdb).
+
+Lookups are local and memoized, so resolving a session's location never makes
+a network call.
+"""
+from typing import Dict, Mapping, Optional
+import ipaddress
+import threading
+import cache_utils
+import libs
+
+_reader = None
+_reader_path = None
+_reader_lock = threading.Lock()
+_locations = cache_utils.LRUCache(max_bytes=4 * 1024 * 1024, ttl=24 * 3600)
+
+def client_ip(headers: Optional[Mapping[str, str]], remote_ip: Optional[str], trusted_proxies: int = 1) -> str:
+    """
+    The client IP. Every proxy appends the address it received from to X-Forwarded-For,
+    so only the entries added by our own proxies can be trusted; anything further left
+    was sent by the client. The address is taken trusted_proxies hops from the right,
+    the socket peer being the last hop. X-Real-IP stands in for a missing
+    X-Forwarded-For. With trusted_proxies=0 the headers are ignored.
+    """
+    hops = []
+    if headers and trusted_proxies > 0:
+        forwarded = headers.get("X-Forwarded-For") or headers.get("x-forwarded-for") or ""
+        hops = [ip.strip() for ip in forwarded.split(",") if ip.strip()]
+        real_ip = headers.get("X-Real-IP") or headers.get("x-real-ip")
+        if not hops and real_ip:
+            hops = [real_ip.strip()]
+    hops.append(remote_ip or None)
+
+    ip = hops[-(trusted_proxies + 1)] if len(hops) > trusted_proxies else hops[0]
+    try:
+        return str(ipaddress.ip_address(ip)) if ip else "unknown_ip"
+    except ValueError:
+        return "unknown_ip"
+
+def _get_reader(db_path: str):
+    global _reader, _reader_path
+    if _reader is None or _reader_path != db_path:
+        with _reader_lock:
+            if _reader is None or _reader_path != db_path:
+                maxminddb = libs.lazy_import("maxminddb")
+                _reader = maxminddb.open_database(db_path)
+                _reader_path = db_path
+    return _reader
+
+def _name(record: Optional[dict]) -> Optional[str]:
+    if not record:
+        return None
+    return record.get("names", {}).get("en")
+
+def lookup(ip: str, db_path: Optional[str]) -> Optional[Dict[str, Optional[str]]]:
+    """
+    City/region/country of an IP from the local database, or None if unknown
+    (no database configured, private address, not found).
+    """
+    if not db_path or not ip:
+        return None
+    location = _locations.get(ip)
+    if location is not None:
+        return location or None
+
+    location = {}
+    try:
+        record = _get_reader(db_path).get(ip)
+        if record:
+            subdivisions = record.get("subdivisions") or [None]
+            location = {
+                "city": _name(record.get("city")),
+                "region": _name(subdivisions[0]),
+                "country": _name(record.get("country")),
+            }
+    except Exception as ex:
+        print(f"Geolocation lookup failed for {ip}: {ex!r}")
+    _locations.put(ip, location)    # negative results are memoized too
+    return location or None
@@ -0,0 +1,247 @@
+"""
+Chat history for AskGemini app.
+
+The history keeps every turn with its token size and builds the request contents
+from the newest turns that fit a per-model token budget. The uploaded document is
+pinned: it is sent once at the start of every request instead of being repeated in
+each turn, and it is never evicted. Evicted turns can be collapsed into a short
+summary so the model keeps some memory of them. The text of older turns can be
+kept zlib-compressed (compact) to bound a session's memory.
+"""
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import re
+import zlib
+from io import BytesIO
+from PIL import Image
+from google.genai import types
+
+# Default prompt token budgets per model; "default" applies to anything not listed.
+MODEL_TOKEN_BUDGETS = {
+    "gemini-2.5-flash": 64000,
+    "gemini-2.5-pro": 32000,
+    "gemini-3-pro-preview": 32000,
+    "gemini-2.5-flash-image": 16000,
+    "gemini-3-pro-image-preview": 16000,
+    "gemini-2.0-flash": 32000,
+    "default": 32000,
+}
+
+IMAGE_TOKENS = 258          # Gemini's cost of one image tile
+SUMMARY_CHARS_PER_TURN = 200
+
+_CJK = re.compile("[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uff00-\uffef]")
+
+def estimate_text_tokens(text: str) -> int:
+    """
+    Local token estimate: about one token per CJK character and per four other characters.
+    """
+    cjk = len(_CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+def image_part(image: Image.Image) -> types.Part:
+    """
+    Encode a PIL image into an inline-data Part.
+    """
+    with BytesIO() as buffer:
+        if image.mode in ("RGBA", "LA", "P"):
+            image.save(buffer, format="PNG")
+            mime_type = "image/png"
+        else:
+            image.save(buffer, format="JPEG", quality=90)
+            mime_type = "image/jpeg"
+        return types.Part.from_bytes(data=buffer.getvalue(), mime_type=mime_type)
+
+def to_part(part: Any) -> types.Part:
+    if isinstance(part, types.Part):
+        return part
+    if isinstance(part, Image.Image):
+        return image_part(part)
+    return types.Part.from_text(text=str(part))
+
+def estimate_part_tokens(part: types.Part) -> int:
+    if part.text is not None:
+        return estimate_text_tokens(part.text)
+    if part.inline_data is not None:
+        return IMAGE_TOKENS
+    return 0
+
+def turn_parts(turn: Dict[str, Any]) -> List[types.Part]:
+    """
+    Parts of a turn, unpacked if it was compacted.
+    """
+    if "packed" in turn:
+        return types.Content.model_validate_json(zlib.decompress(turn["packed"])).parts or []
+    return turn["parts"]
+
+def extractive_summary(turns: List[Dict[str, Any]]) -> str:
+    """
+    Cheap local summary of evicted turns: the opening of each text turn.
+    """
+    lines = []
+    for turn in turns:
+        text = " ".join(p.text for p in turn_parts(turn) if p.text).strip()
+        if text:
+            speaker = "User" if turn["role"] == "user" else "AI"
+            lines.append(f"{speaker}: {text[:SUMMARY_CHARS_PER_TURN]}")
+    return "\n".join(lines)
+
+
+class ChatHistory:
+    """
+    Token-budgeted sliding window over the chat turns.
+
+    Parameters
+    ----------
+    max_turns : int
+        Hard cap on the number of kept turns (besides the token budget)
+    summarize : bool
+        Collapse evicted turns into a summary sent after the pinned document
+    summarizer : callable
+        Function (list of turns) -> str used for the summary
+    """
+
+    def __init__(self, max_turns: Optional[int] = None, summarize: bool = False,
+                 summarizer: Callable[[List[Dict[str, Any]]], str] = extractive_summary):
+        self.max_turns = max_turns
+        self.summarize = summarize
+        self.summarizer = summarizer
+        self.turns: List[Dict[str, Any]] = []
+        self.document = ""
+        self.document_tokens = 0
+        self.summary = ""
+        self.scale = 1.0            # measured / estimated prompt tokens, learned from usage_metadata
+        self._last_estimate = 0
+
+    def set_document(self, text: str) -> None:
+        """
+        Pin the uploaded document (empty string to unpin).
+        """
+        text = text.strip() if text else ""
+        if text != self.document:
+            self.document = text
+            self.document_tokens = estimate_text_tokens(text)
+
+    def add_turn(self, role: str, parts: List[Any], tokens: Optional[int] = None) -> None:
+        parts = [to_part(p) for p in parts if p is not None]
+        if not parts:
+            return
+        if tokens is None:
+            tokens = sum(estimate_part_tokens(p) for p in parts)
+        self.turns.append({"role": role, "parts": parts, "tokens": tokens})
+
+    def record_usage(self, usage: Any, estimate: Optional[int] = None) -> None:
+        """
+        Calibrate the estimates from the response usage_metadata and store the exact
+        size of the model turn just added. estimate overrides the estimate of the last
+        build_contents, for answers to other contents (see inline_contents).
+        """
+        if usage is None:
+            return
+        estimate = estimate or self._last_estimate
+        if usage.prompt_token_count and estimate:
+            # cached tokens (context cache) are not part of the estimate
+            ratio = (usage.prompt_token_count - (usage.cached_content_token_count or 0)) / estimate
+            self.scale = min(4.0, max(0.25, 0.5 * self.scale + 0.5 * ratio))
+        if usage.candidates_token_count and self.turns and self.turns[-1]["role"] == "model":
+            self.turns[-1]["tokens"] = int(usage.candidates_token_count / max(self.scale, 0.1))
+
+    def window(self, budget: int, sys_prompt: str = "") -> List[Dict[str, Any]]:
+        """
+        Newest turns whose (scaled) token total fits the budget after the pinned parts.
+        The latest turn is always kept and the window always starts with a user turn.
+        The pinned document counts against the budget even when it is served from a context cache.
+        """
+        fixed = self.document_tokens + estimate_text_tokens(sys_prompt or "") + estimate_text_tokens(self.summary)
+        remaining = budget / self.scale - fixed
+        kept = []
+        for turn in reversed(self.turns):
+            if kept and (turn["tokens"] > remaining or (self.max_turns and len(kept) >= self.max_turns)):
+                break
+            kept.append(turn)
+            remaining -= turn["tokens"]
+        kept.reverse()
+        while len(kept) > 1 and kept[0]["role"] != "user":
+            kept.pop(0)
+        return kept
+
+    def build_contents(self, budget: int, sys_prompt: str = "", include_document: bool = True) -> List[types.Content]:
+        """
+        Build the request contents: pinned document, optional summary, then the window.
+        Turns that fall out of the window are evicted (and summarized if enabled).
+        Pass include_document=False when the document is already in a context cache.
+        """
+        kept = self.window(budget, sys_prompt)
+        self._evict(len(self.turns) - len(kept))
+        contents, self._last_estimate = self._contents(kept, sys_prompt, include_document)
+        return contents
+
+    def inline_contents(self, sys_prompt: str = "") -> Tuple[List[types.Content], int]:
+        """
+        The contents of the last build_contents with the document inline (for a model
+        that cannot use the context cache), and their estimated tokens. Nothing is
+        evicted and the calibration of record_usage is left alone.
+        """
+        return self._contents(self.turns, sys_prompt, True)
+
+    def _contents(self, kept: List[Dict[str, Any]], sys_prompt: str, include_document: bool) -> Tuple[List[types.Content], int]:
+        contents = []
+        if self.document and include_document:
+            contents.append(types.Content(role="user", parts=[types.Part.from_text(text=self.document)]))
+            contents.append(types.Content(role="model", parts=[types.Part.from_text(text="OK.")]))
+        if self.summary:
+            contents.append(types.Content(role="user", parts=[types.Part.from_text(text="Summary of our earlier conversation:\n" + self.summary)]))
+            contents.append(types.Content(role="model", parts=[types.Part.from_text(text="OK.")]))
+        for turn in kept:
+            contents.append(types.Content(role=turn["role"], parts=turn_parts(turn)))
+
+        estimate = estimate_text_tokens(self.summary) + sum(t["tokens"] for t in kept)
+        if include_document:
+            estimate += self.document_tokens + estimate_text_tokens(sys_prompt or "")
+        return contents, estimate
+
+    def _evict(self, count: int) -> None:
+        evicted = self.turns[:count]
+        if evicted:
+            if self.summarize:
+                summary = self.summarizer(evicted)
+                self.summary = (self.summary + "\n" + summary).strip() if self.summary else summary
+                self.summary = self.summary[-SUMMARY_CHARS_PER_TURN * 20:]
+            self.turns = self.turns[count:]
+
+    def drop_oldest(self, keep: int = 2) -> bool:
+        """
+        Evict the oldest user/model exchange (summarized if enabled), keeping at least
+        the newest keep turns. Returns False when there is nothing left to drop.
+        """
+        if len(self.turns) <= keep:
+            return False
+        count = 1
+        while count < len(self.turns) - keep and self.turns[count]["role"] != "user":
+            count += 1
+        self._evict(count)
+        return True
+
+    def compact(self, keep_recent: int = 4) -> None:
+        """
+        Keep the parts of text-only turns older than the newest keep_recent zlib-compressed.
+        Turns with images are left as they are: their bytes are already compressed.
+        """
+        for turn in self.turns[:max(0, len(self.turns) - keep_recent)]:
+            if "parts" in turn and all(p.inline_data is None for p in turn["parts"]):
+                content = types.Content(parts=turn.pop("parts"))
+                turn["packed"] = zlib.compress(content.model_dump_json(exclude_none=True).encode("utf-8"), 6)
+
+    def total_tokens(self) -> int:
+        return self.document_tokens + sum(t["tokens"] for t in self.turns)
+
+    def clear(self) -> None:
+        self.turns = []
+        self.document = ""
+        self.document_tokens = 0
+        self.summary = ""
+
+def token_budget(llm: str, overrides: Optional[Dict[str, int]] = None) -> int:
+    budgets = dict(MODEL_TOKEN_BUDGETS)
+    if overrides:
+        budgets.update(overrides)
+    return budgets.get(llm, budgets["default"])
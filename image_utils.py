@@ -0,0 +1,76 @@
+"""
+Image preparation for AskGemini app.
+
+Uploaded photos are sent to the model on every later turn, so they are prepared
+once: EXIF orientation is applied, the image is downsized to what the model can
+use, and it is re-encoded compactly. Roles that need more detail (e.g.
+'Radiologist') get a higher-fidelity profile.
+"""
+from typing import Dict, Tuple
+import hashlib
+from io import BytesIO
+from PIL import Image, ImageOps
+from google.genai import types
+import cache_utils
+
+# max_side: longest edge in pixels; quality: JPEG/WebP quality
+DEFAULT_PROFILE = {"max_side": 1536, "quality": 85}
+ROLE_PROFILES = {
+    "Radiologist": {"max_side": 3072, "quality": 95},
+}
+
+_prepared = cache_utils.LRUCache(max_bytes=64 * 1024 * 1024, size_fn=lambda entry: len(entry[0].inline_data.data))
+
+def profile_for_role(role: str) -> Dict[str, int]:
+    return ROLE_PROFILES.get(role, DEFAULT_PROFILE)
+
+def encode(image: Image.Image, quality: int) -> Tuple[bytes, str]:
+    """
+    Encode as JPEG, or as WebP when the image has transparency.
+    """
+    with BytesIO() as buffer:
+        if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+            image.save(buffer, format="WEBP", quality=quality, method=4)
+            mime_type = "image/webp"
+        else:
+            image.convert("RGB").save(buffer, format="JPEG", quality=quality, optimize=True)
+            mime_type = "image/jpeg"
+        return buffer.getvalue(), mime_type
+
+def prepare_image(data: bytes, max_side: int = DEFAULT_PROFILE["max_side"], quality: int = DEFAULT_PROFILE["quality"]) -> Tuple[types.Part, Dict[str, int]]:
+    """
+    Turn uploaded image bytes into a compact inline-data Part for the model.
+
+    Returns the Part and a report with the original/prepared sizes in bytes and pixels.
+    If re-encoding would not make the image smaller, the original bytes are kept.
+    """
+    data = bytes(data)
+    key = f"{max_side}-{quality}-{hashlib.sha256(data).hexdigest()}"
+    cached = _prepared.get(key)
+    if cached is not None:
+        return cached
+
+    image = Image.open(BytesIO(data))
+    original_format = (image.format or "").lower()
+    original_size = image.size
+    rotated = image.getexif().get(0x0112, 1) != 1     # EXIF orientation tag
+    image = ImageOps.exif_transpose(image)
+    if max(image.size) > max_side:
+        image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+
+    prepared, mime_type = encode(image, quality)
+    if len(prepared) >= len(data) and image.size == original_size and not rotated and original_format in ("jpeg", "png", "webp"):
+        prepared, mime_type = data, f"image/{original_format}"
+
+    report = {
+        "original_bytes": len(data),
+        "prepared_bytes": len(prepared),
+        "saved_bytes": len(data) - len(prepared),
+        "original_width": original_size[0],
+        "original_height": original_size[1],
+        "width": image.size[0],
+        "height": image.size[1],
+    }
+    entry = (types.Part.from_bytes(data=prepared, mime_type=mime_type), report)
+    _prepared.put(key, entry)
+    return entry
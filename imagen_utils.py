@@ -0,0 +1,63 @@
+"""
+Text-to-image generation (Imagen) for AskGemini app.
+
+Instead of one generate_images call for all pictures, each picture is requested
+separately and the requests run in parallel on a shared thread pool, so the
+first picture can be shown as soon as it lands and the total wait is that of the
+slowest single picture. Pictures are handed out as the encoded JPEG bytes the
+API returned; nothing is decoded here.
+"""
+from typing import Any, Iterator, Optional
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from google.genai import types
+
+IMAGEN_MODEL = "imagen-4.0-generate-001"
+
+_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="imagen")
+
+def build_config(mime_type: str = "image/jpeg", person_generation: str = "allow_adult") -> types.GenerateImagesConfig:
+    """
+    Config of one single-picture request.
+    """
+    return types.GenerateImagesConfig(number_of_images=1,
+                                      output_mime_type=mime_type,
+                                      person_generation=person_generation,
+                                      )
+
+def cache_key(prompt: str, npics: int, config: types.GenerateImagesConfig, model: str = IMAGEN_MODEL) -> str:
+    digest = hashlib.sha256()
+    for value in (model, prompt.strip(), str(npics), config.model_dump_json(exclude_none=True)):
+        digest.update(value.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+def generate(client: Any, prompt: str, npics: int, config: Optional[types.GenerateImagesConfig] = None,
+             model: str = IMAGEN_MODEL) -> Iterator[bytes]:
+    """
+    Request npics pictures in parallel and yield the bytes of each as it arrives.
+    Failed requests are skipped; if none succeeds, the first error is raised.
+    Requests not yet started are cancelled when the caller stops iterating.
+    """
+    config = (config or build_config()).model_copy(update={"number_of_images": 1})
+    futures = [_pool.submit(client.models.generate_images, model=model, prompt=prompt, config=config)
+               for _ in range(npics)]
+    delivered = 0
+    error = None
+    try:
+        for future in as_completed(futures):
+            try:
+                response = future.result()
+            except Exception as ex:
+                print(f"Imagen request failed: {ex!r}")
+                error = error or ex
+                continue
+            for generated_image in response.generated_images or []:
+                if generated_image.image is not None and generated_image.image.image_bytes:
+                    delivered += 1
+                    yield generated_image.image.image_bytes
+    finally:
+        for future in futures:
+            future.cancel()
+    if delivered == 0 and error is not None:
+        raise error
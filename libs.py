@@ -8,14 +8,50 @@
 # 13/09/2024| Tian-Qing Ye   | Add '个人社交名片生成器' role. System prompt from 作者: 一泽Eze
 # 14/09/2024| Tian-Qing Ye   | Impoved system messages
 ##################################################################
-from langchain_community.document_loaders import UnstructuredFileLoader
-from langchain_community.document_loaders import UnstructuredWordDocumentLoader
-from langchain_community.document_loaders import PyPDFLoader
-from langchain_community.document_loaders import UnstructuredPowerPointLoader
 import os
 import re
+import sys
+import time
 import base64
+import hashlib
+import importlib
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
 from tempfile import NamedTemporaryFile
+import cache_utils
+
+# Heavy dependencies (langchain loaders, gtts, langdetect, ...) are imported on first use
+# through lazy_import(), which also records how long each first import took.
+IMPORT_TIMES = {}
+
+def lazy_import(name: str, attr: str = None):
+    '''
+    Import a module (and optionally return one of its attributes) on first use,
+    recording the import time in IMPORT_TIMES and printing it.
+    '''
+    if name not in sys.modules:
+        start = time.perf_counter()
+        module = importlib.import_module(name)
+        IMPORT_TIMES[name] = time.perf_counter() - start
+        print(f"Lazy import of {name}: {IMPORT_TIMES[name] * 1000:.1f} ms")
+    else:
+        module = sys.modules[name]
+
+    if attr is None:
+        return module
+    return getattr(module, attr)
+
+def import_report() -> str:
+    '''
+    Return a breakdown of recorded import times, slowest first.
+    For a full per-module tree run: python -X importtime -m streamlit run app.py
+    '''
+    lines = [f"{seconds * 1000:10.1f} ms | {name}" for name, seconds in sorted(IMPORT_TIMES.items(), key=lambda kv: -kv[1])]
+    return "Import times:\n" + "\n".join(lines)
 
 set_sys_context = {
     '聊天伙伴':
@@ -275,6 +311,7 @@ def get_docx_data(filepath:str) -> str:
     '''
     #loader = UnstructuredWordDocumentLoader(filepath, mode="single")
     contents = ""
+    UnstructuredWordDocumentLoader = lazy_import("langchain_community.document_loaders", "UnstructuredWordDocumentLoader")
     loader = UnstructuredWordDocumentLoader(filepath)
     docs = loader.load()
     for doc in docs:
@@ -283,33 +320,151 @@ def get_docx_data(filepath:str) -> str:
 
     return contents
 
+def get_docx_data_from_buffer(data) -> str:
+    '''
+    File types: docx, parsed from bytes with python-docx (paragraphs, then tables)
+    '''
+    Document = lazy_import("docx", "Document")
+    document = Document(BytesIO(data))
+    blocks = [p.text for p in document.paragraphs if p.text.strip()]
+    for table in document.tables:
+        for row in table.rows:
+            cells = [cell.text.strip() for cell in row.cells]
+            if any(cells):
+                blocks.append(" | ".join(cells))
+
+    return "\n\n".join(blocks) + "\n\n"
+
 def get_ppt_data(filepath:str) -> str:
     '''
     File types: powerpoint document
     '''
+    UnstructuredPowerPointLoader = lazy_import("langchain_community.document_loaders", "UnstructuredPowerPointLoader")
     loader = UnstructuredPowerPointLoader(filepath, mode="single")
     docs = loader.load()
     doc = docs[0]
 
     return doc.page_content
 
+# PDF engine settings: pages per worker task, worker processes (None = cpu count)
+# and an optional cap on extracted characters (None = no cap).
+PDF_CHUNK_PAGES = 16
+PDF_WORKERS = None
+PDF_MAX_CHARS = None
+_pdf_pool = None
+_pdf_pool_lock = threading.Lock()
+
+def _get_pdf_pool():
+    global _pdf_pool
+    if _pdf_pool is None:
+        with _pdf_pool_lock:
+            if _pdf_pool is None:
+                # spawn, not fork: the Streamlit server process is multi-threaded
+                _pdf_pool = ProcessPoolExecutor(max_workers=PDF_WORKERS,
+                                                mp_context=multiprocessing.get_context("spawn"))
+    return _pdf_pool
+
+def _extract_pdf_pages(source, start: int, stop: int) -> list:
+    '''
+    Worker task: text of pages [start, stop) of a pdf given as bytes or as a file path.
+    '''
+    PdfReader = lazy_import("pypdf", "PdfReader")
+    reader = PdfReader(source if isinstance(source, str) else BytesIO(source))
+    return [reader.pages[i].extract_text() or "" for i in range(start, stop)]
+
+def _iter_pdf_page_texts(data: bytes, first_page: int, stop: int, workers: int):
+    if workers == 1 or stop - first_page <= PDF_CHUNK_PAGES:
+        for start in range(first_page, stop, PDF_CHUNK_PAGES):
+            yield from _extract_pdf_pages(data, start, min(start + PDF_CHUNK_PAGES, stop))
+        return
+
+    global _pdf_pool
+    ranges = [(start, min(start + PDF_CHUNK_PAGES, stop)) for start in range(first_page, stop, PDF_CHUNK_PAGES)]
+    in_flight = max(2, 2 * (workers or os.cpu_count() or 1))    # bounds the page texts held back for ordering
+    futures = deque()
+    next_page = first_page
+    # the workers read the pdf from a temp file: only its path is pickled with each task
+    with NamedTemporaryFile(suffix=".pdf", delete=False) as f:
+        f.write(data)
+        path = f.name
+    try:
+        pool = _get_pdf_pool()
+        for start, end in ranges:
+            futures.append(pool.submit(_extract_pdf_pages, path, start, end))
+            if len(futures) >= in_flight:
+                texts = futures.popleft().result()
+                next_page += len(texts)
+                yield from texts
+        while futures:
+            texts = futures.popleft().result()
+            next_page += len(texts)
+            yield from texts
+    except BrokenProcessPool as ex:
+        print(f"PDF worker pool failed ({ex}), extracting the remaining pages in-process")
+        with _pdf_pool_lock:
+            _pdf_pool = None
+        yield from _iter_pdf_page_texts(data, next_page, stop, 1)
+    finally:
+        for future in futures:
+            future.cancel()
+        try:
+            os.remove(path)
+        except OSError as ex:
+            print(f"Removing the pdf temp file failed: {ex!r}")
+
+def iter_pdf_pages(data, first_page: int = 0, last_page: int = None, max_chars: int = None, workers: int = None):
+    '''
+    Yield the text of each page of a pdf, in order. Pages are extracted in chunks
+    across a process pool; stops early once max_chars characters have been produced.
+
+    Parameters
+    ----------
+    data : bytes-like
+        The pdf file content
+    first_page, last_page : int
+        Zero-based page range [first_page, last_page); last_page None means to the end
+    max_chars : int
+        Stop after this many characters (the last page is truncated)
+    workers : int
+        1 to extract in-process; otherwise the shared pool is used
+    '''
+    data = bytes(data)
+    PdfReader = lazy_import("pypdf", "PdfReader")
+    n_pages = len(PdfReader(BytesIO(data)).pages)
+    stop = n_pages if last_page is None else min(last_page, n_pages)
+
+    total = 0
+    pages = _iter_pdf_page_texts(data, max(0, first_page), stop, workers if workers is not None else PDF_WORKERS)
+    try:
+        for text in pages:
+            if max_chars is not None and total + len(text) >= max_chars:
+                yield text[:max_chars - total]
+                return
+            total += len(text)
+            yield text
+    finally:
+        pages.close()
+
 def get_pdf_data(filepath:str) -> str:
     '''
     File types: pdf
     '''
-    contents = ""
-    loader = PyPDFLoader(filepath)
-    docs = loader.load()
-    for doc in docs:
-        #(f"docs: {doc}")
-        contents += doc.page_content + "\n\n"
+    with open(filepath, "rb") as f:
+        return get_pdf_data_from_buffer(f.read())
 
-    return contents
+def get_pdf_data_from_buffer(data, first_page: int = 0, last_page: int = None, max_chars: int = None) -> str:
+    '''
+    File types: pdf, parsed from bytes with pypdf
+    '''
+    if max_chars is None:
+        max_chars = PDF_MAX_CHARS
+    return "".join(page + "\n\n" for page in iter_pdf_pages(data, first_page, last_page, max_chars))
 
 def get_unstructured_data(filepath) -> str:
     '''
     File types: text, html
     '''
+    UnstructuredFileLoader = lazy_import("langchain_community.document_loaders", "UnstructuredFileLoader")
     loader = UnstructuredFileLoader(filepath, mode="single")
     docs = loader.load()
     doc = docs[0]
@@ -386,57 +541,99 @@ def Read_From_File(filepath:str) -> dict:
 
     return ret
 
+# Extracted contents keyed by SHA-256 of the uploaded bytes. Bump LOADER_VERSION
+# whenever extraction output changes so stale entries are not served.
+LOADER_VERSION = "2"
+EXTRACTION_CACHE = cache_utils.LRUCache(max_bytes=128 * 1024 * 1024)
+EXTRACTION_DISK_CACHE = None
+
+def configure_extraction_cache(max_bytes: int, disk_folder: str = None) -> None:
+    '''
+    Resize the in-memory extraction cache and optionally enable the on-disk tier.
+    '''
+    global EXTRACTION_CACHE, EXTRACTION_DISK_CACHE
+    EXTRACTION_CACHE = cache_utils.LRUCache(max_bytes=max_bytes)
+    EXTRACTION_DISK_CACHE = cache_utils.DiskCache(disk_folder) if disk_folder else None
+
+def extraction_cache_stats() -> dict:
+    stats = {"memory": EXTRACTION_CACHE.stats()}
+    if EXTRACTION_DISK_CACHE is not None:
+        stats["disk"] = EXTRACTION_DISK_CACHE.stats()
+    return stats
+
+def extraction_key(data, filename: str) -> str:
+    '''
+    Content address of an upload: loader version, file type and SHA-256 of the bytes.
+    '''
+    ext = filename.split(".")[-1].lower()
+    if ext == 'pdf' and PDF_MAX_CHARS is not None:
+        ext += f"{PDF_MAX_CHARS}"
+    return f"v{LOADER_VERSION}-{ext}-{hashlib.sha256(data).hexdigest()}"
+
 def GetContexts(uploaded_file):
+    '''
+    Extract the text (or base64 image) of an uploaded file, served from the extraction
+    cache when the same bytes were seen before.
+    '''
+    key = extraction_key(uploaded_file.getbuffer(), uploaded_file.name)
+    Content = EXTRACTION_CACHE.get(key)
+    if Content is None and EXTRACTION_DISK_CACHE is not None:
+        Content = EXTRACTION_DISK_CACHE.get(key)
+        if Content is not None:
+            EXTRACTION_CACHE.put(key, Content)
+    if Content is not None:
+        return Content, 0
+
+    Content, error = _Extract_Contexts(uploaded_file)
+    if error == 0:
+        EXTRACTION_CACHE.put(key, Content)
+        if EXTRACTION_DISK_CACHE is not None:
+            EXTRACTION_DISK_CACHE.put(key, Content)
+
+    return Content, error
 
+def _Extract_Contexts(uploaded_file):
+    '''
+    Parse the upload straight from its in-memory buffer. Only loaders that need a
+    real path (pptx) go through a temporary file.
+    '''
     Content = ""
     error = 0
-    tempFile = ""
     filepath = uploaded_file.name
+    ext = filepath.split(".")[-1].lower()
+    data = uploaded_file.getbuffer()
     try:
-        if filepath.split(".")[-1] in ['docx', 'DOCX']:
-            with NamedTemporaryFile(suffix="docx", delete=False) as temp:
-                temp.write(uploaded_file.getbuffer())
-                tempFile = temp.name
-                Content = get_docx_data(temp.name)
-        elif filepath.split(".")[-1] in ['pdf', 'PDF']:
-            with NamedTemporaryFile(suffix="pdf", delete=False) as temp:
-                temp.write(uploaded_file.getbuffer())
-                tempFile = temp.name
-                Content = get_pdf_data(temp.name)
-        elif filepath.split(".")[-1] in ['pptx', 'PPTX']:
-            with NamedTemporaryFile(suffix="pptx", delete=False) as temp:
-                temp.write(uploaded_file.getbuffer())
-                tempFile = temp.name
-                Content = get_ppt_data(temp.name)
-        elif filepath.split(".")[-1] in ['jpg', 'jpeg']:
-            with NamedTemporaryFile(suffix="jpg", delete=False) as temp:
-                temp.write(uploaded_file.getbuffer())
-                tempFile = temp.name
-                Content = encode_image(temp.name)
-        elif filepath.split(".")[-1] in ['png', 'PNG']:
-            with NamedTemporaryFile(suffix="png", delete=False) as temp:
-                temp.write(uploaded_file.getbuffer())
-                tempFile = temp.name
-                Content = encode_image(temp.name)
-        elif filepath.split(".")[-1] in ['webp', 'WEBP']:
-            with NamedTemporaryFile(suffix="webp", delete=False) as temp:
-                temp.write(uploaded_file.getbuffer())
-                tempFile = temp.name
-                Content = encode_image(temp.name)
+        if ext == 'docx':
+            Content = get_docx_data_from_buffer(data)
+        elif ext == 'pdf':
+            Content = get_pdf_data_from_buffer(data)
+        elif ext == 'pptx':
+            Content = _Load_Via_Temp_File(data, ext, get_ppt_data)
+        elif ext in ['jpg', 'jpeg', 'png', 'webp']:
+            Content = base64.b64encode(data).decode('utf-8')
         else:
-            with NamedTemporaryFile(suffix="txt", delete=False) as temp:
-                temp.write(uploaded_file.getbuffer())
-                tempFile = temp.name
-                Content = text_preprocessing(temp.name)
+            # universal newlines, as the old text-mode read; unlike its strict UTF-8 decode,
+            # undecodable bytes are replaced with U+FFFD instead of failing the upload
+            Content = bytes(data).decode('utf-8', errors='replace').replace('\r\n', '\n').replace('\r', '\n')
     except Exception as ex:
         print(f"Loading file content failed: {ex}")
         Content = f"Loading file content failed: {ex}"
         error = 1
 
-    if os.path.exists(tempFile):
+    return Content, error
+
+def _Load_Via_Temp_File(data, ext: str, loader) -> str:
+    '''
+    Write the bytes to a temporary file for loaders that only accept a path,
+    and always remove it afterwards.
+    '''
+    with NamedTemporaryFile(suffix="." + ext, delete=False) as temp:
+        temp.write(data)
+        tempFile = temp.name
+    try:
+        return loader(tempFile)
+    finally:
         try:
             os.remove(tempFile)
-        except Exception as ex:
+        except OSError:
             pass
-
-    return Content, error
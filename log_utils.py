@@ -0,0 +1,144 @@
+"""
+Audit log for AskGemini app.
+
+Events are JSON lines. AuditLogger.log() only appends a size-capped record to an
+in-memory buffer; a background thread writes the buffer out, rotates the file by
+size or age and gzips the rotated files.
+"""
+from typing import Optional, Dict, Any
+import atexit
+import gzip
+import json
+import os
+import shutil
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+MAX_FIELD_CHARS = 4000      # longer strings are truncated so every event stays small
+
+def _truncate(value: Any, limit: int = MAX_FIELD_CHARS) -> Any:
+    if isinstance(value, str) and len(value) > limit:
+        return value[:limit] + f"...[{len(value) - limit} chars truncated]"
+    return value
+
+
+class AuditLogger:
+    """
+    Buffered JSONL logger with size/time based rotation and gzip compression.
+
+    The buffer is bounded (buffer_size events); when it is full the oldest events
+    are dropped and counted rather than blocking the caller. Whatever is still
+    buffered is written by close(), which also runs at interpreter exit.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 10 * 1024 * 1024, rotate_seconds: float = 24 * 3600,
+                 backups: int = 10, flush_interval: float = 2.0, buffer_size: int = 10000):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.rotate_seconds = rotate_seconds
+        self.backups = backups
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self._buffer = deque(maxlen=buffer_size)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._write_lock = threading.Lock()     # the flusher thread and close() may both write
+        self._closed = False
+        self._opened_at = os.path.getmtime(path) if os.path.exists(path) else time.time()
+        self._thread = threading.Thread(target=self._run, name="audit-log", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def log(self, event: str, **fields) -> None:
+        """
+        Queue one event. Constant-time: no I/O, no lookups.
+        """
+        record = {"ts": datetime.now().isoformat(timespec="seconds"), "event": event}
+        for key, value in fields.items():
+            record[key] = _truncate(value)
+        with self._lock:
+            if len(self._buffer) == self._buffer.maxlen:
+                self.dropped += 1
+            self._buffer.append(record)
+            if len(self._buffer) >= self._buffer.maxlen // 2:
+                self._wakeup.set()
+
+    def flush(self) -> None:
+        """
+        Write all buffered events to disk, rotating first if needed.
+        """
+        with self._write_lock:
+            with self._lock:
+                records = list(self._buffer)
+                self._buffer.clear()
+            if not records:
+                return
+
+            lines = "".join(json.dumps(r, ensure_ascii=False, default=str) + "\n" for r in records)
+            try:
+                self._maybe_rotate()
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(lines)
+            except Exception as ex:
+                print(f"Writing audit log failed: {ex!r}")
+
+    def close(self) -> None:
+        """
+        Stop the flusher thread and write the events still buffered.
+        """
+        self._closed = True
+        self._wakeup.set()
+        self.flush()
+
+    def _maybe_rotate(self) -> None:
+        if not os.path.exists(self.path):
+            self._opened_at = time.time()
+            return
+        too_big = os.path.getsize(self.path) >= self.max_bytes
+        too_old = time.time() - self._opened_at >= self.rotate_seconds
+        if not (too_big or too_old):
+            return
+
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        rotated = f"{self.path}.{stamp}.gz"
+        with open(self.path, "rb") as src, gzip.open(rotated, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(self.path)
+        self._opened_at = time.time()
+
+        folder = os.path.dirname(self.path) or "."
+        prefix = os.path.basename(self.path) + "."
+        old = sorted(f for f in os.listdir(folder) if f.startswith(prefix) and f.endswith(".gz"))
+        for name in old[:-self.backups] if self.backups > 0 else old:
+            try:
+                os.remove(os.path.join(folder, name))
+            except OSError:
+                pass
+
+    def _run(self) -> None:
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+
+_logger: Optional[AuditLogger] = None
+_logger_lock = threading.Lock()
+
+def get_logger(path: str, **options) -> AuditLogger:
+    """
+    Return the process-wide audit logger, starting it on first use.
+    """
+    global _logger
+    if _logger is None:
+        with _logger_lock:
+            if _logger is None:
+                _logger = AuditLogger(path, **options)
+    return _logger
+
+def log_stats() -> Dict[str, int]:
+    if _logger is None:
+        return {"buffered": 0, "dropped": 0}
+    return {"buffered": len(_logger._buffer), "dropped": _logger.dropped}
@@ -0,0 +1,138 @@
+"""
+Per-session memory budget for AskGemini app.
+
+Every session keeps its chat messages, the chat history sent to the model, the
+uploaded document and images for as long as it lives; with hundreds of sessions
+per process that, not CPU, is what runs out first. This module measures the
+payload a session holds, packs old message text with zlib, evicts the oldest
+messages when a session is over its byte budget, and keeps a process-wide table
+of session sizes for the admin view and the metrics exporter.
+"""
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import sys
+import threading
+import time
+import zlib
+from pydantic import BaseModel
+from PIL import Image
+
+PACK_MIN_CHARS = 256        # shorter texts are not worth compressing
+SESSION_TTL = 3600          # forget sessions not reported for this long (seconds)
+
+
+class PackedText:
+    """
+    Text kept zlib-compressed; str() gives it back.
+    """
+    __slots__ = ("data",)
+
+    def __init__(self, text: str):
+        self.data = zlib.compress(text.encode("utf-8"), 6)
+
+    def __str__(self) -> str:
+        return zlib.decompress(self.data).decode("utf-8")
+
+
+def pack(text: Any) -> Any:
+    """
+    Compress a long string; anything else is returned unchanged.
+    """
+    if isinstance(text, str) and len(text) >= PACK_MIN_CHARS:
+        return PackedText(text)
+    return text
+
+def unpack(value: Any) -> Any:
+    return str(value) if isinstance(value, PackedText) else value
+
+
+def measure(value: Any, deep_types: Tuple[type, ...] = (), _seen: Optional[set] = None) -> int:
+    """
+    Approximate bytes held by a value: containers, pydantic models (genai types),
+    decoded PIL images and instances of deep_types are followed; objects shared by
+    reference are counted once. Anything else counts its shallow size only, so
+    process-wide objects a session merely points to (clients, caches) are not charged.
+    """
+    seen = set() if _seen is None else _seen
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value, 64)
+    if isinstance(value, PackedText):
+        size += sys.getsizeof(value.data)
+    elif isinstance(value, Image.Image):
+        size += value.width * value.height * len(value.getbands())
+    elif isinstance(value, dict):
+        size += sum(measure(k, deep_types, seen) + measure(v, deep_types, seen) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(measure(v, deep_types, seen) for v in value)
+    elif isinstance(value, BaseModel):
+        size += sum(measure(getattr(value, name), deep_types, seen) for name in type(value).model_fields)
+    elif deep_types and isinstance(value, deep_types):
+        size += measure(vars(value), deep_types, seen)
+    return size
+
+
+def compact_message(message: Dict[str, Any]) -> None:
+    """
+    Shrink a chat message that has been rendered (see app.Render_Message): the raw
+    parts (prompt, attached document and image) are dropped, since only the render
+    is shown again, and its text is packed.
+    """
+    render = message.get("render")
+    if render is None or message.get("compact"):
+        return
+    message["parts"] = None
+    render["text"] = pack(render["text"])
+    if render.get("columns"):
+        render["columns"] = [(header, pack(text)) for header, text in render["columns"]]
+    message["compact"] = True
+
+
+def enforce_budget(messages: List[Dict[str, Any]], budget: int, size_fn: Callable[[], int],
+                   render: Optional[Callable[[Dict[str, Any]], Any]] = None,
+                   keep_recent: int = 4, keep_min: int = 2) -> Dict[str, int]:
+    """
+    Compact all but the newest keep_recent messages (rendering them first with
+    render, if given), then drop the oldest messages (never the newest keep_min)
+    until size_fn() fits the budget. Returns the sizes before and after and the
+    number of messages evicted.
+    """
+    before = size_fn()
+    for message in messages[:max(0, len(messages) - keep_recent)]:
+        if render is not None and not message.get("compact"):
+            render(message)
+        compact_message(message)
+    size = size_fn()
+    evicted = 0
+    while size > budget and len(messages) > keep_min:
+        messages.pop(0)
+        evicted += 1
+        size = size_fn()
+    return {"before": before, "after": size, "evicted": evicted}
+
+
+_sessions: Dict[str, Dict[str, Any]] = {}
+_sessions_lock = threading.Lock()
+
+def report(session_id: str, user: str, size: int, **details) -> None:
+    """
+    Record the latest measured size of a session.
+    """
+    now = time.time()
+    with _sessions_lock:
+        _sessions[session_id] = {"user": user, "bytes": size, "updated": now, **details}
+        for key in [k for k, s in _sessions.items() if now - s["updated"] > SESSION_TTL]:
+            del _sessions[key]
+
+def sessions() -> List[Dict[str, Any]]:
+    """
+    Sizes of the sessions seen in the last SESSION_TTL seconds, largest first.
+    """
+    with _sessions_lock:
+        rows = [{"session": key[:8], **s} for key, s in _sessions.items()]
+    return sorted(rows, key=lambda row: row["bytes"], reverse=True)
+
+def session_stats() -> Dict[str, int]:
+    rows = sessions()
+    return {"sessions": len(rows), "bytes_total": sum(r["bytes"] for r in rows),
+            "bytes_max": max((r["bytes"] for r in rows), default=0)}
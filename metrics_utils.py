@@ -0,0 +1,241 @@
+"""
+Latency tracing and metrics for AskGemini app.
+
+Stages of a request are timed with span("stage"); durations are aggregated per
+stage into histograms (cumulative buckets for Prometheus plus a window of recent
+samples for p50/p95/p99). Spans opened inside trace() are also kept as a
+per-request breakdown. Everything is exported as Prometheus text, over HTTP
+and/or to a file, by background threads.
+"""
+from typing import Any, Callable, Dict, List, Optional
+import os
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PREFIX = "askgemini"
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+RECENT_SAMPLES = 2048   # samples kept per stage for percentiles
+RECENT_TRACES = 50
+
+_INVALID_NAME = re.compile(r"[^a-zA-Z0-9_:]")
+
+def _name(text: str) -> str:
+    """
+    A valid Prometheus metric name part: anything but [a-zA-Z0-9_:] becomes '_'.
+    """
+    return _INVALID_NAME.sub("_", str(text))
+
+def _label(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Histogram:
+    """
+    Latency histogram: Prometheus buckets over all samples, percentiles over recent ones.
+    """
+
+    def __init__(self, buckets: tuple = BUCKETS, window: int = RECENT_SAMPLES):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.recent = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float) -> None:
+        with self._lock:
+            self.count += 1
+            self.sum += seconds
+            self.recent.append(seconds)
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    self.counts[i] += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self.recent)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def summary(self) -> Dict[str, Any]:
+        return {"count": self.count, "mean": self.sum / self.count if self.count else None,
+                "p50": self.quantile(0.5), "p95": self.quantile(0.95), "p99": self.quantile(0.99)}
+
+
+class Registry:
+    """
+    Stage histograms, event counters, gauge callbacks and recent request traces.
+    """
+
+    def __init__(self):
+        self.histograms: Dict[str, Histogram] = {}
+        self.counters: Dict[tuple, float] = {}
+        self.gauges: Dict[str, Callable[[], Dict[str, Any]]] = {}
+        self.gauge_labels: Dict[str, str] = {}
+        self.traces = deque(maxlen=RECENT_TRACES)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float) -> None:
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(stage, Histogram())
+        histogram.observe(seconds)
+        spans = getattr(self._local, "spans", None)
+        if spans is not None:
+            spans.append((stage, seconds))
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def register_gauges(self, name: str, fn: Callable[[], Dict[str, Any]], label: Optional[str] = None) -> None:
+        """
+        fn returns a dict of numeric values, read at export time (e.g. a cache's stats()).
+        With label, the keys are label values of one gauge (e.g. label="model" exports
+        name{model="gemini-2.5-pro"}) rather than gauge names.
+        """
+        self.gauges[name] = fn
+        if label:
+            self.gauge_labels[name] = label
+
+    @contextmanager
+    def span(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    @contextmanager
+    def trace(self, name: str, **labels):
+        """
+        Time a whole request; spans on this thread inside it are kept as its breakdown.
+        """
+        outer = getattr(self._local, "spans", None)
+        self._local.spans = spans = []
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            total = time.perf_counter() - start
+            self._local.spans = outer
+            self.observe(name, total)
+            self.traces.append({"name": name, "at": time.time(), "seconds": total, "spans": spans, **labels})
+
+    def snapshot(self) -> Dict[str, Any]:
+        gauges = {}
+        for name, fn in list(self.gauges.items()):
+            try:
+                gauges[name] = fn()
+            except Exception as ex:
+                gauges[name] = {"error": repr(ex)}
+        return {
+            "stages": {stage: h.summary() for stage, h in sorted(self.histograms.items())},
+            "counters": {name + (str(dict(labels)) if labels else ""): value
+                         for (name, labels), value in sorted(self.counters.items())},
+            "gauges": gauges,
+            "traces": list(self.traces),
+        }
+
+    def prometheus_text(self) -> str:
+        lines = [f"# TYPE {PREFIX}_stage_seconds histogram"]
+        for stage, h in sorted(self.histograms.items()):
+            with h._lock:
+                counts, count, total = list(h.counts), h.count, h.sum
+            for bound, n in zip(h.buckets, counts):
+                lines.append(f'{PREFIX}_stage_seconds_bucket{{stage="{_label(stage)}",le="{bound}"}} {n}')
+            lines.append(f'{PREFIX}_stage_seconds_bucket{{stage="{_label(stage)}",le="+Inf"}} {count}')
+            lines.append(f'{PREFIX}_stage_seconds_sum{{stage="{_label(stage)}"}} {total}')
+            lines.append(f'{PREFIX}_stage_seconds_count{{stage="{_label(stage)}"}} {count}')
+
+        lines.append(f"# TYPE {PREFIX}_stage_seconds_recent gauge")
+        for stage, h in sorted(self.histograms.items()):
+            for q in (0.5, 0.95, 0.99):
+                value = h.quantile(q)
+                if value is not None:
+                    lines.append(f'{PREFIX}_stage_seconds_recent{{stage="{_label(stage)}",quantile="{q}"}} {value}')
+
+        names = sorted({name for name, _ in self.counters})
+        with self._lock:
+            counters = dict(self.counters)
+        for name in names:
+            lines.append(f"# TYPE {PREFIX}_{_name(name)}_total counter")
+            for (n, labels), value in sorted(counters.items()):
+                if n == name:
+                    label_text = ",".join(f'{_name(k)}="{_label(v)}"' for k, v in labels)
+                    lines.append(f"{PREFIX}_{_name(name)}_total{{{label_text}}} {value}" if label_text else f"{PREFIX}_{_name(name)}_total {value}")
+
+        for name, values in sorted(self.snapshot()["gauges"].items()):
+            label = self.gauge_labels.get(name)
+            for key, value in values.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    if label:
+                        lines.append(f'{PREFIX}_{_name(name)}{{{_name(label)}="{_label(key)}"}} {value}')
+                    else:
+                        lines.append(f"{PREFIX}_{_name(name)}_{_name(key)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+span = REGISTRY.span
+trace = REGISTRY.trace
+inc = REGISTRY.inc
+observe = REGISTRY.observe
+register_gauges = REGISTRY.register_gauges
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = REGISTRY.prometheus_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _write_file(path: str, interval: float) -> None:
+    while True:
+        time.sleep(interval)
+        tmp = f"{path}.tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(REGISTRY.prometheus_text())
+            os.replace(tmp, path)
+        except Exception as ex:
+            print(f"Writing metrics file failed: {ex!r}")
+
+def start_exporters(port: Optional[int] = None, path: Optional[str] = None, interval: float = 15,
+                    host: str = "127.0.0.1") -> List[str]:
+    """
+    Serve /metrics on host:port and/or rewrite path (e.g. for node_exporter's textfile
+    collector) every interval seconds. Call once per process. The endpoint has no
+    authentication, so it only listens on the loopback interface unless another
+    host is given explicitly.
+    """
+    started = []
+    if port:
+        try:
+            server = ThreadingHTTPServer((host, int(port)), _MetricsHandler)
+            threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+            started.append(f"http://{host}:{port}/metrics")
+        except OSError as ex:
+            print(f"Metrics endpoint on port {port} not started: {ex!r}")
+    if path:
+        threading.Thread(target=_write_file, args=(path, interval), name="metrics-file", daemon=True).start()
+        started.append(path)
+    return started
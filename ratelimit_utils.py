@@ -0,0 +1,247 @@
+"""
+Shared rate limiting and scheduling of model calls for AskGemini app.
+
+Every model has a requests-per-minute and a tokens-per-minute token bucket. The
+buckets live in memory (one process) or in a SQLite file shared by all app and
+batch processes on the host. Callers that cannot be admitted at once wait in a
+bounded per-model queue ordered by priority (registered users before trial
+users before batch jobs); when the queue is full, or the expected wait is
+longer than allowed, the request is shed with Overloaded instead of timing out.
+"""
+from typing import Callable, Dict, List, Optional, Tuple
+import bisect
+import itertools
+import sqlite3
+import threading
+import time
+
+PRIORITY_USER = 0
+PRIORITY_TRIAL = 1
+PRIORITY_BATCH = 2
+
+# model -> (requests per minute, tokens per minute)
+MODEL_LIMITS = {
+    "gemini-2.5-flash": (1000, 1_000_000),
+    "gemini-2.5-pro": (150, 2_000_000),
+    "gemini-3-pro-preview": (50, 1_000_000),
+    "imagen-4.0-generate-001": (20, 1_000_000),
+    "default": (100, 1_000_000),
+}
+
+# (key, amount, refill per second, capacity)
+Take = Tuple[str, float, float, float]
+
+
+class Overloaded(Exception):
+    """
+    The request was shed: the wait queue is full or the wait would be too long.
+    """
+
+
+def parse_limits(text: Optional[str]) -> Dict[str, Tuple[int, int]]:
+    """
+    Parse limits like "gemini-2.5-flash=1000/1000000, gemini-2.5-pro=150/2000000" (rpm/tpm).
+    """
+    limits = {}
+    for item in (text or "").split(","):
+        if "=" in item:
+            model, rates = item.split("=", 1)
+            rpm, _, tpm = rates.partition("/")
+            limits[model.strip()] = (int(rpm), int(tpm or MODEL_LIMITS["default"][1]))
+    return limits
+
+
+def _refill(level: float, updated: float, now: float, rate: float, capacity: float) -> float:
+    return min(capacity, level + (now - updated) * rate)
+
+
+class MemoryBuckets:
+    """
+    Token buckets of this process.
+    """
+
+    def __init__(self):
+        self._levels: Dict[str, Tuple[float, float]] = {}
+        self._lock = threading.Lock()
+
+    def take(self, takes: List[Take]) -> float:
+        """
+        Take every amount at once and return 0, or take nothing and return the seconds
+        until all amounts would be available.
+        """
+        with self._lock:
+            now = time.time()
+            levels = {key: _refill(*self._levels.get(key, (capacity, now)), now, rate, capacity)
+                      for key, _, rate, capacity in takes}
+            wait = max((amount - levels[key]) / rate for key, amount, rate, _ in takes)
+            for key, amount, _, _ in takes:
+                self._levels[key] = (levels[key] - (amount if wait <= 0 else 0), now)
+            return max(0.0, wait)
+
+    def adjust(self, key: str, amount: float, rate: float, capacity: float) -> None:
+        with self._lock:
+            now = time.time()
+            level = _refill(*self._levels.get(key, (capacity, now)), now, rate, capacity)
+            self._levels[key] = (min(capacity, level - amount), now)
+
+
+class SqliteBuckets:
+    """
+    Token buckets in a SQLite file, shared by every process that opens it.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, level REAL NOT NULL, updated REAL NOT NULL)")
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA busy_timeout=10000")
+        return conn
+
+    def _levels(self, conn: sqlite3.Connection, takes: List[Take], now: float) -> Dict[str, float]:
+        levels = {}
+        for key, _, rate, capacity in takes:
+            row = conn.execute("SELECT level, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+            levels[key] = _refill(*(row or (capacity, now)), now, rate, capacity)
+        return levels
+
+    def take(self, takes: List[Take]) -> float:
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            levels = self._levels(conn, takes, now)
+            wait = max((amount - levels[key]) / rate for key, amount, rate, _ in takes)
+            for key, amount, _, _ in takes:
+                conn.execute("INSERT OR REPLACE INTO buckets (key, level, updated) VALUES (?, ?, ?)",
+                             (key, levels[key] - (amount if wait <= 0 else 0), now))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return max(0.0, wait)
+
+    def adjust(self, key: str, amount: float, rate: float, capacity: float) -> None:
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            level = self._levels(conn, [(key, 0, rate, capacity)], now)[key]
+            conn.execute("INSERT OR REPLACE INTO buckets (key, level, updated) VALUES (?, ?, ?)",
+                         (key, min(capacity, level - amount), now))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+
+class Scheduler:
+    """
+    Admission control for model calls: per-model RPM/TPM buckets and a bounded
+    priority wait queue per model.
+
+    max_waiting: queue length per model; lower priorities may only fill
+    trial_share of it. max_wait: longest wait in seconds before shedding.
+    """
+
+    def __init__(self, limits: Optional[Dict[str, Tuple[int, int]]] = None, store=None,
+                 max_waiting: int = 50, max_wait: float = 60.0, trial_share: float = 0.5, poll: float = 0.25):
+        self.limits = dict(MODEL_LIMITS, **(limits or {}))
+        self.store = store or MemoryBuckets()
+        self.max_waiting = max_waiting
+        self.max_wait = max_wait
+        self.trial_share = trial_share
+        self.poll = poll
+        self.admitted = 0
+        self.shed = 0
+        self._queues: Dict[str, list] = {}
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+
+    def _limit(self, model: str) -> Tuple[int, int]:
+        return self.limits.get(model, self.limits["default"])
+
+    def _takes(self, model: str, tokens: int) -> List[Take]:
+        rpm, tpm = self._limit(model)
+        return [(f"{model}:rpm", 1, rpm / 60.0, rpm),
+                (f"{model}:tpm", min(tokens, tpm), tpm / 60.0, tpm)]
+
+    def admit(self, model: str, tokens: int, priority: int = PRIORITY_TRIAL,
+              on_wait: Optional[Callable[[int, float], None]] = None, max_wait: Optional[float] = None) -> float:
+        """
+        Block until the call may be sent and return the seconds waited. on_wait(position,
+        eta_seconds) is called while queued. Raises Overloaded when the request is shed.
+        """
+        max_wait = self.max_wait if max_wait is None else max_wait
+        limit = self.max_waiting if priority == PRIORITY_USER else max(1, int(self.max_waiting * self.trial_share))
+        ticket = (priority, next(self._seq))
+        with self._cond:
+            queue = self._queues.setdefault(model, [])
+            if len(queue) >= limit:
+                self.shed += 1
+                raise Overloaded(f"{model}: {len(queue)} requests waiting")
+            bisect.insort(queue, ticket)
+
+        start = time.monotonic()
+        rpm, _ = self._limit(model)
+        try:
+            while True:
+                with self._cond:
+                    position = queue.index(ticket)
+                wait = self.store.take(self._takes(model, tokens)) if position == 0 else None
+                if wait == 0:
+                    self.admitted += 1
+                    return time.monotonic() - start
+                eta = (wait or 0) + position * 60.0 / rpm
+                if time.monotonic() - start + eta > max_wait:
+                    self.shed += 1
+                    raise Overloaded(f"{model}: expected wait {eta:.0f}s")
+                if on_wait is not None:
+                    on_wait(position, eta)
+                with self._cond:
+                    self._cond.wait(min(wait or self.poll, self.poll))
+        finally:
+            with self._cond:
+                queue.remove(ticket)
+                self._cond.notify_all()
+
+    def settle(self, model: str, estimated: int, actual: Optional[int]) -> None:
+        """
+        Correct the TPM bucket once the real token count is known.
+        """
+        if actual is None or actual == estimated:
+            return
+        _, tpm = self._limit(model)
+        self.store.adjust(f"{model}:tpm", min(actual, tpm) - min(estimated, tpm), tpm / 60.0, tpm)
+
+    def refund(self, model: str, tokens: int = 0) -> None:
+        """
+        Give back the request slot and tokens of an admission whose call was never sent.
+        """
+        rpm, tpm = self._limit(model)
+        self.store.adjust(f"{model}:rpm", -1, rpm / 60.0, rpm)
+        if tokens:
+            self.store.adjust(f"{model}:tpm", -min(tokens, tpm), tpm / 60.0, tpm)
+
+    def penalize(self, model: str, seconds: float = 10.0) -> None:
+        """
+        After a 429 from the API: empty the request bucket so callers back off for a while.
+        """
+        rpm, _ = self._limit(model)
+        self.store.adjust(f"{model}:rpm", rpm + rpm / 60.0 * seconds, rpm / 60.0, rpm)
+
+    def waiting(self) -> Dict[str, int]:
+        """
+        Queue length per model.
+        """
+        with self._cond:
+            return {model: len(queue) for model, queue in self._queues.items()}
+
+    def stats(self) -> Dict[str, int]:
+        return {"waiting": sum(self.waiting().values()), "admitted": self.admitted, "shed": self.shed}
@@ -0,0 +1,73 @@
+"""
+Request building for AskGemini: system prompts from the role presets and the
+GenerateContentConfig for each kind of model call. Shared by the Streamlit app
+and the batch command line (batch.py), so both send identical requests.
+"""
+from typing import Optional, Tuple
+from google.genai import types
+import libs
+
+BASE_PROMPT = "You are a helpful assistant who can answer or handle all my queries!"
+
+SAFETY_SETTINGS = [
+    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
+]
+
+def system_prompt(role: str = "", extra: str = "") -> str:
+    """
+    System prompt of a role preset (libs.set_sys_context) plus any custom context;
+    BASE_PROMPT when both are (nearly) empty.
+    """
+    sys_msg = ""
+    for ctx in [libs.set_sys_context.get(role, ""), extra or ""]:
+        if ctx != "":
+            sys_msg += ctx + '\n'
+    if len(sys_msg.strip()) > 10:
+        return sys_msg
+    return BASE_PROMPT
+
+def build_config(sys_prompt: str = BASE_PROMPT, temperature: float = 0.7, search: bool = False,
+                 cached_content: Optional[str] = None, image_output: bool = False,
+                 timeout: Optional[float] = None) -> types.GenerateContentConfig:
+    """
+    Config of a generate_content call:
+    - image_output: text and image answer (image models), default temperature, no system prompt
+    - search: grounded with Google Search
+    - cached_content: the system instruction lives in the cache and may not be repeated
+    timeout (seconds) bounds the HTTP request.
+    """
+    if image_output:
+        config = types.GenerateContentConfig(response_modalities=['Text', 'Image'],
+                                             safety_settings=SAFETY_SETTINGS,
+                                             )
+    elif search:
+        config = types.GenerateContentConfig(response_modalities=['Text'],
+                                             system_instruction=sys_prompt,
+                                             temperature=temperature,
+                                             tools=[types.Tool(google_search=types.GoogleSearch())],
+                                             )
+    elif cached_content is not None:
+        config = types.GenerateContentConfig(response_modalities=['Text'],
+                                             cached_content=cached_content,
+                                             temperature=temperature,
+                                             )
+    else:
+        config = types.GenerateContentConfig(response_modalities=['Text'],
+                                             system_instruction=sys_prompt,
+                                             temperature=temperature,
+                                             )
+    if timeout:
+        config.http_options = types.HttpOptions(timeout=int(timeout * 1000))
+    return config
+
+def build_contents(prompt: str, document: str = "") -> list:
+    """
+    Contents of a single-turn request: the prompt, followed by a document if given.
+    """
+    parts = [types.Part.from_text(text=prompt)]
+    if document:
+        parts.append(types.Part.from_text(text=document))
+    return [types.Content(role="user", parts=parts)]
@@ -0,0 +1,189 @@
+"""
+Resilient model calls for AskGemini app.
+
+A request goes down a fallback chain of models (e.g. 3.0 Pro -> 2.5 Pro -> 2.5 flash).
+Each model gets a few retries with jittered exponential backoff on retryable errors
+(429, 5xx, timeouts), is skipped while its circuit breaker is open, and can
+optionally be hedged: if no answer arrives within hedge_after seconds, an
+identical request is started and the first answer wins. Breakers are process-wide,
+so one session's failures spare the others the wait.
+"""
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import httpx
+from google.genai import errors
+import ratelimit_utils
+
+RETRYABLE_CODES = {408, 429, 500, 502, 503, 504}
+FALLBACK_CHAINS = {
+    "gemini-3-pro-preview": ["gemini-2.5-pro", "gemini-2.5-flash"],
+    "gemini-2.5-pro": ["gemini-2.5-flash"],
+}
+
+_hedges = ThreadPoolExecutor(max_workers=16, thread_name_prefix="hedge")
+
+
+class CircuitOpenError(Exception):
+    """
+    Every model of the chain is failing; the request was not sent.
+    """
+
+
+def is_retryable(ex: BaseException) -> bool:
+    if isinstance(ex, errors.APIError):
+        return ex.code in RETRYABLE_CODES
+    return isinstance(ex, (httpx.TimeoutException, httpx.TransportError, TimeoutError, ConnectionError))
+
+def parse_chains(text: Optional[str]) -> Dict[str, List[str]]:
+    """
+    Parse chains like "gemini-3-pro-preview>gemini-2.5-pro>gemini-2.5-flash; gemini-2.5-pro>gemini-2.5-flash".
+    """
+    chains = {}
+    for chain in (text or "").split(";"):
+        models = [m.strip() for m in chain.split(">") if m.strip()]
+        if len(models) > 1:
+            chains[models[0]] = models[1:]
+    return chains
+
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive failures; after reset_seconds one trial
+    request is let through (half-open) and its outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_seconds: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_seconds:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half_open" and not self.trial_running:
+                self.trial_running = True
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def release(self) -> None:
+        with self._lock:
+            self.trial_running = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.trial_running or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.trial_running = False
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+def get_breaker(model: str, **options) -> CircuitBreaker:
+    with _breakers_lock:
+        breaker = _breakers.get(model)
+        if breaker is None:
+            breaker = _breakers[model] = CircuitBreaker(**options)
+        return breaker
+
+def breaker_states() -> Dict[str, str]:
+    with _breakers_lock:
+        return {model: breaker.state for model, breaker in _breakers.items()}
+
+
+def _hedged(fn: Callable[[str], Any], model: str, hedge_after: float) -> Tuple[Any, bool]:
+    """
+    Run fn(model); if it is still running after hedge_after seconds, start a second
+    copy and return the first successful result. The slower call is left to finish
+    in the background (a blocking HTTP call cannot be cancelled).
+    """
+    first = _hedges.submit(fn, model)
+    done, _ = wait([first], timeout=hedge_after)
+    if done:
+        return first.result(), False
+    pending = {first, _hedges.submit(fn, model)}
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                return future.result(), True
+            error = future.exception()
+    raise error
+
+
+def call(fn: Callable[[str], Any], model: str, fallbacks: Optional[List[str]] = None, retries: int = 2,
+         base_delay: float = 0.5, max_delay: float = 8.0, hedge_after: Optional[float] = None,
+         breaker_options: Optional[Dict[str, Any]] = None) -> Tuple[Any, Dict[str, Any]]:
+    """
+    Call fn(model) down the chain [model] + fallbacks and return (result, path), where
+    path records the model that served the answer, the attempts made and whether a
+    fallback or hedge was used. fn must be safe to run in a worker thread when
+    hedge_after is set. Non-retryable errors are raised at once.
+    """
+    chain = [model] + [m for m in (fallbacks if fallbacks is not None else FALLBACK_CHAINS.get(model, [])) if m != model]
+    path = {"model": None, "requested": model, "attempts": [], "fallback": False, "hedged": False}
+    last_error = None
+
+    for candidate in chain:
+        breaker = get_breaker(candidate, **(breaker_options or {}))
+        if not breaker.allow():
+            path["attempts"].append(f"{candidate}: circuit open")
+            continue
+        for attempt in range(retries + 1):
+            if attempt > 0:
+                delay = min(max_delay, base_delay * 2 ** (attempt - 1))
+                time.sleep(random.uniform(0, delay))     # full jitter
+            try:
+                if hedge_after:
+                    result, hedged = _hedged(fn, candidate, hedge_after)
+                else:
+                    result, hedged = fn(candidate), False
+            except ratelimit_utils.Overloaded:
+                breaker.release()           # shed before reaching the model: no verdict
+                raise
+            except Exception as ex:
+                last_error = ex
+                retryable = is_retryable(ex)
+                path["attempts"].append(f"{candidate}: {getattr(ex, 'code', None) or type(ex).__name__}")
+                if retryable:
+                    breaker.record_failure()
+                    if attempt < retries and breaker.state == "closed":
+                        continue
+                    break           # next model in the chain
+                breaker.record_success()    # the model answered; the request itself is bad
+                raise
+            except BaseException:
+                breaker.release()           # interrupted (e.g. a Streamlit rerun): no verdict
+                raise
+            breaker.record_success()
+            path["attempts"].append(f"{candidate}: ok")
+            path.update(model=candidate, fallback=candidate != model, hedged=hedged)
+            return result, path
+
+    if last_error is not None:
+        raise last_error
+    raise CircuitOpenError(f"All models unavailable: {', '.join(chain)}")
@@ -0,0 +1,149 @@
+"""
+Local BM25 retrieval over uploaded documents for AskGemini app.
+
+The extracted text is split into overlapping chunks once and indexed in memory
+(NumPy postings arrays, keyed by the document hash). Each question then sends only
+the top-k chunks, labelled for citation, instead of the whole document. Works fully
+offline; no embedding service is involved.
+"""
+from typing import Dict, List, Tuple
+import hashlib
+import re
+from collections import Counter
+import numpy as np
+import cache_utils
+
+CHUNK_CHARS = 1500
+CHUNK_OVERLAP = 200
+TOP_K = 6
+
+_WORD = re.compile(r"[a-z0-9]+|[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]+")
+_CJK = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]")
+
+def tokenize(text: str) -> List[str]:
+    """
+    Lower-cased latin words plus character bigrams for CJK runs.
+    """
+    tokens = []
+    for word in _WORD.findall(text.lower()):
+        if _CJK.match(word):
+            if len(word) == 1:
+                tokens.append(word)
+            else:
+                tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+        else:
+            tokens.append(word)
+    return tokens
+
+def chunk_text(text: str, size: int = CHUNK_CHARS, overlap: int = CHUNK_OVERLAP) -> List[Tuple[int, int]]:
+    """
+    Split text into overlapping (start, end) character spans, preferring to break at paragraph or line ends.
+    """
+    spans = []
+    start = 0
+    n = len(text)
+    while start < n:
+        end = min(start + size, n)
+        if end < n:
+            cut = max(text.rfind("\n\n", start + size // 2, end), text.rfind("\n", start + size // 2, end))
+            if cut > start:
+                end = cut
+        spans.append((start, end))
+        if end >= n:
+            break
+        start = max(end - overlap, start + 1)
+    return spans
+
+
+class BM25Index:
+    """
+    Okapi BM25 over a list of chunks, stored as term-sorted postings arrays.
+    """
+
+    def __init__(self, text: str, k1: float = 1.5, b: float = 0.75):
+        self.text = text
+        self.k1 = k1
+        self.b = b
+        self.spans = chunk_text(text)
+        self.vocab: Dict[str, int] = {}
+
+        term_ids, doc_ids, tfs = [], [], []
+        lengths = np.zeros(len(self.spans), dtype=np.float32)
+        for doc_id, (start, end) in enumerate(self.spans):
+            counts = Counter(tokenize(text[start:end]))
+            lengths[doc_id] = sum(counts.values())
+            for term, tf in counts.items():
+                term_ids.append(self.vocab.setdefault(term, len(self.vocab)))
+                doc_ids.append(doc_id)
+                tfs.append(tf)
+
+        term_ids = np.asarray(term_ids, dtype=np.int32)
+        order = np.argsort(term_ids, kind="stable")
+        self.doc_ids = np.asarray(doc_ids, dtype=np.int32)[order]
+        self.tfs = np.asarray(tfs, dtype=np.float32)[order]
+        df = np.bincount(term_ids, minlength=len(self.vocab))
+        self.offsets = np.concatenate(([0], np.cumsum(df))).astype(np.int64)
+
+        n_docs = max(len(self.spans), 1)
+        self.idf = np.log1p((n_docs - df + 0.5) / (df + 0.5)).astype(np.float32)
+        avgdl = lengths.mean() if len(lengths) else 1.0
+        self.norm = (k1 * (1 - b + b * lengths / max(avgdl, 1.0))).astype(np.float32)
+
+    def search(self, query: str, top_k: int = TOP_K) -> List[Tuple[int, float]]:
+        """
+        Return (chunk id, score) of the best matching chunks, best first.
+        """
+        scores = np.zeros(len(self.spans), dtype=np.float32)
+        for term in set(tokenize(query)):
+            term_id = self.vocab.get(term)
+            if term_id is None:
+                continue
+            lo, hi = self.offsets[term_id], self.offsets[term_id + 1]
+            docs = self.doc_ids[lo:hi]
+            tf = self.tfs[lo:hi]
+            scores[docs] += self.idf[term_id] * tf * (self.k1 + 1) / (tf + self.norm[docs])
+
+        k = min(top_k, len(scores))
+        if k == 0:
+            return []
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        return [(int(i), float(scores[i])) for i in best if scores[i] > 0]
+
+    def nbytes(self) -> int:
+        return len(self.text.encode("utf-8", errors="ignore")) + self.doc_ids.nbytes + self.tfs.nbytes \
+            + self.offsets.nbytes + self.idf.nbytes + self.norm.nbytes + 64 * len(self.vocab)
+
+
+_indexes = cache_utils.LRUCache(max_bytes=256 * 1024 * 1024, size_fn=lambda index: index.nbytes())
+
+def get_index(text: str) -> BM25Index:
+    """
+    Return the BM25 index of a document, building it once per distinct text.
+    """
+    key = hashlib.sha256(text.encode("utf-8", errors="ignore")).hexdigest()
+    index = _indexes.get(key)
+    if index is None:
+        index = BM25Index(text)
+        _indexes.put(key, index)
+    return index
+
+def retrieve(text: str, query: str, top_k: int = TOP_K) -> str:
+    """
+    Build the context for a question: the top-k chunks in document order, each labelled
+    [n] with its character range so the model can cite them. Wrapped in <CONTEXT> tags.
+    Falls back to the opening chunks when nothing matches.
+    """
+    index = get_index(text)
+    hits = index.search(query, top_k)
+    chunk_ids = sorted(i for i, _ in hits) or list(range(min(top_k, len(index.spans))))
+
+    blocks = []
+    for n, chunk_id in enumerate(chunk_ids, start=1):
+        start, end = index.spans[chunk_id]
+        blocks.append(f"[{n}] (chars {start}-{end})\n{text[start:end].strip()}")
+    return ("<CONTEXT>\nRelevant excerpts of the uploaded document. Cite them as [n] in your answer.\n\n"
+            + "\n\n".join(blocks) + "\n</CONTEXT>")
+
+def index_stats() -> Dict[str, float]:
+    return _indexes.stats()
@@ -0,0 +1,98 @@
+"""
+Text-to-speech for AskGemini app.
+
+Synthesis runs in background threads and only when asked for. Long answers are
+split at sentence boundaries into chunks that are synthesized in parallel and
+concatenated (MP3 frames can simply be joined). Finished audio is cached by
+(text hash, language).
+"""
+from typing import Optional
+import hashlib
+import re
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from io import BytesIO
+import cache_utils
+import libs
+import metrics_utils
+
+CHUNK_CHARS = 400           # characters per synthesized chunk
+DETECT_SAMPLE_CHARS = 1000  # language detection only looks at this much text
+SUPPORTED_LANGS = {"en": "en", "de": "de", "fr": "fr", "zh-cn": "zh-CN", "zh-tw": "zh-TW", "zh": "zh-CN"}
+
+_SENTENCE_END = re.compile(r"(?<=[.!?。！？；;\n])")
+
+_audio_cache = cache_utils.LRUCache(max_bytes=64 * 1024 * 1024, size_fn=len)
+_jobs = ThreadPoolExecutor(max_workers=4, thread_name_prefix="tts-job")
+_chunks = ThreadPoolExecutor(max_workers=8, thread_name_prefix="tts-chunk")
+_in_flight = {}
+_lock = threading.Lock()
+
+def detect_language(text: str) -> Optional[str]:
+    """
+    gTTS language code of the text, detected on a bounded sample with a seeded
+    detector (so the result is stable). None if the language is not supported.
+    """
+    langdetect = libs.lazy_import("langdetect")
+    langdetect.DetectorFactory.seed = 0
+    lang = langdetect.detect(text[:DETECT_SAMPLE_CHARS]).lower()
+    return SUPPORTED_LANGS.get(lang)
+
+def split_text(text: str, max_chars: int = CHUNK_CHARS) -> list:
+    """
+    Group sentences into chunks of at most max_chars (longer sentences are cut).
+    """
+    chunks = []
+    current = ""
+    for sentence in _SENTENCE_END.split(text):
+        while len(sentence) > max_chars:
+            chunks.append(sentence[:max_chars])
+            sentence = sentence[max_chars:]
+        if len(current) + len(sentence) > max_chars and current.strip():
+            chunks.append(current)
+            current = ""
+        current += sentence
+    if current.strip():
+        chunks.append(current)
+    return chunks
+
+def _synthesize_chunk(text: str, lang: str) -> bytes:
+    gTTS = libs.lazy_import("gtts", "gTTS")
+    with BytesIO() as sound_file:
+        gTTS(text=text, lang=lang).write_to_fp(sound_file)
+        return sound_file.getvalue()
+
+def synthesize(text: str) -> Optional[bytes]:
+    """
+    MP3 audio of the text, or None when its language is not supported.
+    """
+    lang = detect_language(text)
+    print("Language:", lang)
+    if lang is None:
+        return None
+
+    key = f"{lang}-{hashlib.sha256(text.encode('utf-8')).hexdigest()}"
+    audio = _audio_cache.get(key)
+    if audio is None:
+        with metrics_utils.span("tts"):
+            parts = list(_chunks.map(lambda chunk: _synthesize_chunk(chunk, lang), split_text(text)))
+            audio = b"".join(parts)
+        _audio_cache.put(key, audio)
+    return audio
+
+def synthesize_async(text: str) -> Future:
+    """
+    Start synthesis in the background; identical texts share one job.
+    """
+    key = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    with _lock:
+        future = _in_flight.get(key)
+        if future is None:
+            future = _jobs.submit(synthesize, text)
+            _in_flight[key] = future
+            future.add_done_callback(lambda _: _forget(key))
+    return future
+
+def _forget(key: str) -> None:
+    with _lock:
+        _in_flight.pop(key, None)
@@ -0,0 +1,180 @@
+"""
+Persistent usage ledger and quota store for AskGemini app.
+
+Per-user, per-day, per-model counters of queries and token usage live in a SQLite
+database in WAL mode, so they survive refreshes and restarts and are shared by every
+process on the host. Writes are aggregated in memory and flushed in one transaction
+by a background thread (and at interpreter exit); quota checks read the database
+plus the deltas not yet committed.
+"""
+from typing import Any, Dict, Optional, Tuple
+import atexit
+import sqlite3
+import threading
+from datetime import date
+
+FIELDS = ("queries", "prompt_tokens", "candidates_tokens", "cached_tokens", "thoughts_tokens", "total_tokens")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage_daily (
+    user TEXT NOT NULL,
+    day TEXT NOT NULL,
+    model TEXT NOT NULL,
+    queries INTEGER NOT NULL DEFAULT 0,
+    prompt_tokens INTEGER NOT NULL DEFAULT 0,
+    candidates_tokens INTEGER NOT NULL DEFAULT 0,
+    cached_tokens INTEGER NOT NULL DEFAULT 0,
+    thoughts_tokens INTEGER NOT NULL DEFAULT 0,
+    total_tokens INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user, day, model)
+);
+CREATE INDEX IF NOT EXISTS usage_daily_day ON usage_daily (day);
+"""
+
+UPSERT = f"""
+INSERT INTO usage_daily (user, day, model, {", ".join(FIELDS)}) VALUES (?, ?, ?, {", ".join("?" for _ in FIELDS)})
+ON CONFLICT (user, day, model) DO UPDATE SET {", ".join(f"{f} = {f} + excluded.{f}" for f in FIELDS)}
+"""
+
+def usage_breakdown(usage: Any) -> Dict[str, int]:
+    """
+    Token counts from a response usage_metadata (missing counts are 0).
+    """
+    if usage is None:
+        return {}
+    return {
+        "prompt_tokens": usage.prompt_token_count or 0,
+        "candidates_tokens": usage.candidates_token_count or 0,
+        "cached_tokens": usage.cached_content_token_count or 0,
+        "thoughts_tokens": usage.thoughts_token_count or 0,
+        "total_tokens": usage.total_token_count or 0,
+    }
+
+
+class UsageLedger:
+    """
+    Batched SQLite usage ledger. record() never touches the database.
+    """
+
+    def __init__(self, path: str, flush_interval: float = 1.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._pending: Dict[Tuple[str, str, str], Dict[str, int]] = {}
+        self._in_flight: Dict[Tuple[str, str, str], Dict[str, int]] = {}    # being written by flush()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._write_lock = threading.Lock()     # the flusher thread and close() may both write
+        self._closed = False
+        self._local = threading.local()
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executescript(SCHEMA)
+        finally:
+            conn.close()
+        self._thread = threading.Thread(target=self._run, name="usage-ledger", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=30000")
+        return conn
+
+    def _reader(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def record(self, user: str, model: str, usage: Any = None, queries: int = 1, **tokens) -> None:
+        """
+        Add one query (and its usage_metadata token breakdown) to today's counters.
+        Extra token counts can be passed as keyword arguments, e.g. total_tokens=1500.
+        """
+        delta = usage_breakdown(usage)
+        for field, value in tokens.items():
+            delta[field] = delta.get(field, 0) + value
+        delta["queries"] = queries
+        key = (user or "", date.today().isoformat(), model or "")
+        with self._lock:
+            counters = self._pending.setdefault(key, dict.fromkeys(FIELDS, 0))
+            for field, value in delta.items():
+                counters[field] += value
+
+    def flush(self) -> None:
+        with self._write_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                self._in_flight = pending
+            if not pending:
+                return
+            rows = [key + tuple(counters[f] for f in FIELDS) for key, counters in pending.items()]
+            try:
+                conn = self._reader()
+                with conn:
+                    conn.executemany(UPSERT, rows)
+            except Exception as ex:
+                print(f"Writing usage ledger failed: {ex!r}")
+                with self._lock:    # keep the deltas for the next attempt
+                    for key, counters in pending.items():
+                        merged = self._pending.setdefault(key, dict.fromkeys(FIELDS, 0))
+                        for field in FIELDS:
+                            merged[field] += counters[field]
+            finally:
+                with self._lock:
+                    self._in_flight = {}
+
+    def close(self) -> None:
+        """
+        Stop the flusher thread and write the records still pending.
+        """
+        self._closed = True
+        self._wakeup.set()
+        self.flush()
+
+    def today(self, user: str, day: Optional[str] = None) -> Dict[str, int]:
+        """
+        Today's totals for a user across all models, including records not yet committed.
+        The uncommitted deltas are taken before the database is read, so a flush
+        committing in between is counted twice rather than missed.
+        """
+        day = day or date.today().isoformat()
+        with self._lock:
+            uncommitted = [dict(counters) for pending in (self._pending, self._in_flight)
+                           for (p_user, p_day, _), counters in pending.items()
+                           if p_user == (user or "") and p_day == day]
+        row = self._reader().execute(
+            f"SELECT {', '.join(f'COALESCE(SUM({f}), 0)' for f in FIELDS)} FROM usage_daily WHERE user = ? AND day = ?",
+            (user or "", day)).fetchone()
+        totals = dict(zip(FIELDS, row))
+        for counters in uncommitted:
+            for field in FIELDS:
+                totals[field] += counters[field]
+        return totals
+
+    def queries_today(self, user: str) -> int:
+        return self.today(user)["queries"]
+
+    def _run(self) -> None:
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+
+_ledger: Optional[UsageLedger] = None
+_ledger_lock = threading.Lock()
+
+def get_ledger(path: str, **options) -> UsageLedger:
+    """
+    Return the process-wide usage ledger, opening it on first use.
+    """
+    global _ledger
+    if _ledger is None:
+        with _ledger_lock:
+            if _ledger is None:
+                _ledger = UsageLedger(path, **options)
+    return _ledger